@@ -4,34 +4,99 @@ Copyright (c) Meta Platforms, Inc. and affiliates.
 This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
+import io
 import os
-import sys
-from functools import partial
+import gc
+import math
+import signal
+import argparse
+import time
+import uuid
+import asyncio
+import logging
+import tempfile
+import threading
+from concurrent.futures import Future, InvalidStateError
 from http import HTTPStatus
-from fastapi import FastAPI, File, UploadFile
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Tuple
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart < 0.0.13
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
 from PIL import Image
+import torch
 from pathlib import Path
 import hashlib
 from fastapi.middleware.cors import CORSMiddleware
+import orjson
 import pypdfium2
-import torch
-from nougat import NougatModel
 from nougat.postprocessing import markdown_compatible, close_envs
-from nougat.utils.dataset import ImageDataset
-from nougat.utils.checkpoint import get_checkpoint
-from nougat.dataset.rasterize import rasterize_paper
-from nougat.utils.device import move_to_device, default_batch_size
-from tqdm import tqdm
+from nougat.utils.checkpoint import MODEL_TAG
+from nougat.dataset.rasterize import rasterize_paper_supervised
+from nougat.utils.device import default_batch_size
+from nougat.utils.registry import MemoryBudgetExceeded, ModelRegistry, ServedModel
+from nougat.utils.scheduler import PRIORITIES
+from nougat.utils.store import ResultStore
+from nougat.utils import telemetry
+from nougat.utils.telemetry import (
+    ESTIMATED_WAIT,
+    MODEL_MEMORY,
+    PAGES,
+    QUEUE_DEPTH,
+    SECONDS_PER_PAGE,
+    StageTimer,
+)
 
 
 SAVE_DIR = Path("./pdfs")
-BATCHSIZE = int(os.environ.get("NOUGAT_BATCHSIZE", default_batch_size()))
-NOUGAT_CHECKPOINT = get_checkpoint()
-if NOUGAT_CHECKPOINT is None:
-    print(
-        "Set environment variable 'NOUGAT_CHECKPOINT' with a path to the model checkpoint!"
-    )
-    sys.exit(1)
+# overrides the batch size of all models, otherwise each model uses its tuned batch size
+BATCHSIZE = (
+    int(os.environ["NOUGAT_BATCHSIZE"]) if os.environ.get("NOUGAT_BATCHSIZE") else None
+)
+USE_CUDA = (default_batch_size() if BATCHSIZE is None else BATCHSIZE) > 0
+RASTERIZE_TIMEOUT = float(os.environ.get("NOUGAT_RASTERIZE_TIMEOUT", 120))
+RASTERIZE_MAX_MEMORY = int(os.environ.get("NOUGAT_RASTERIZE_MAX_MEMORY", 4096)) * 2**20
+JOB_TTL = float(os.environ.get("NOUGAT_JOB_TTL", 3600))
+STORE_MAX_SIZE = int(os.environ.get("NOUGAT_STORE_MAX_SIZE", 4096)) * 2**20
+MAX_UPLOAD_SIZE = int(os.environ.get("NOUGAT_MAX_UPLOAD_SIZE", 256)) * 2**20
+UPLOAD_CHUNK_SIZE = 2**20
+MAX_QUEUE_WAIT = float(os.environ.get("NOUGAT_MAX_QUEUE_WAIT", 600))
+INTERACTIVE_PAGES = int(os.environ.get("NOUGAT_INTERACTIVE_PAGES", 16))
+DISCONNECT_POLL_INTERVAL = 1.0
+MODEL_MEMORY_BUDGET = int(os.environ.get("NOUGAT_MODEL_MEMORY", 0)) * 2**20
+BACKEND = os.environ.get("NOUGAT_BACKEND", "eager")
+
+
+def served_checkpoints() -> Dict[str, Optional[str]]:
+    """
+    The model tags to serve from `NOUGAT_MODELS`, a comma separated list of tags that can
+    name their checkpoint as `tag=path`. The first tag is the default. Without it, the
+    checkpoint in `NOUGAT_CHECKPOINT` or the default tag is served.
+    """
+    if not os.environ.get("NOUGAT_MODELS"):
+        return {MODEL_TAG: os.environ.get("NOUGAT_CHECKPOINT")}
+    checkpoints = {}
+    for entry in os.environ["NOUGAT_MODELS"].split(","):
+        tag, _, path = entry.strip().partition("=")
+        if tag:
+            checkpoints[tag] = path or None
+    return checkpoints
+
 
 app = FastAPI(title="Nougat API")
 origins = ["http://localhost", "http://127.0.0.1"]
@@ -43,20 +108,68 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-model = None
+registry: ModelRegistry = None
+# set in the workers of `serve_forked`, which don't share their jobs
+FORKED = False
+JOBS: Dict[str, "Job"] = {}
+# (md5, model, page) -> pages that are currently being converted
+INFLIGHT: Dict[Tuple[str, str, int], "InflightPage"] = {}
+INFLIGHT_LOCK = threading.Lock()
+store = ResultStore(SAVE_DIR / "results.sqlite3", max_size=STORE_MAX_SIZE)
 
 
 @app.on_event("startup")
-async def load_model(
-    checkpoint: str = NOUGAT_CHECKPOINT,
-):
-    global model, BATCHSIZE
-    if model is None:
-        model = NougatModel.from_pretrained(checkpoint)
-        model = move_to_device(model, cuda=BATCHSIZE > 0)
-        if BATCHSIZE <= 0:
-            BATCHSIZE = 1
-        model.eval()
+async def load_model():
+    """Load the default model, the other ones are loaded by their first request."""
+    global registry
+    if registry is None:
+        registry = create_registry()
+    registry.release(await run_in_threadpool(registry.acquire))
+
+
+def create_registry() -> ModelRegistry:
+    return ModelRegistry(
+        served_checkpoints(),
+        batch_size=None if BATCHSIZE is None else max(BATCHSIZE, 1),
+        memory_budget=MODEL_MEMORY_BUDGET,
+        max_wait=MAX_QUEUE_WAIT,
+        cuda=USE_CUDA,
+        backend=BACKEND,
+    )
+
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    if registry is not None:
+        registry.close()
+
+
+class LimitUploadSize:
+    """
+    Reject uploads that announce a size above the limit before their body is read. Uploads
+    without a Content-Length are stopped by `receive_upload` once they exceed the limit.
+
+    Implemented as a plain ASGI middleware, because middlewares based on
+    `BaseHTTPMiddleware` hide client disconnects from the endpoints.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            length = HTTPConnection(scope).headers.get("content-length")
+            if length is not None and length.isdigit() and int(length) > MAX_UPLOAD_SIZE:
+                response = JSONResponse(
+                    {"detail": f"The upload exceeds {MAX_UPLOAD_SIZE // 2**20} MB."},
+                    status_code=HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(LimitUploadSize)
 
 
 @app.get("/")
@@ -69,104 +182,1051 @@ def root():
     return response
 
 
-@app.post("/predict/")
+def model_status(served: Optional[ServedModel]) -> Dict:
+    if served is None:
+        return {"loaded": False}
+    return {
+        "loaded": True,
+        "memory": served.size,
+        "queue_depth": served.scheduler.pending,
+        "queue_depth_by_priority": served.scheduler.pending_by_priority(),
+        "outstanding_pages": served.admission.outstanding,
+        "seconds_per_page": served.scheduler.seconds_per_page,
+        "estimated_wait": served.admission.estimated_wait,
+        "max_wait": served.admission.max_wait,
+    }
+
+
+@app.get("/status")
+def status():
+    """
+    Load of the server, per model tag. Responds with status 503 while new requests for the
+    default model would be rejected, so that load balancers can route away early.
+    """
+    content = {
+        "default_model": registry.default,
+        "memory": registry.memory,
+        "memory_budget": registry.memory_budget,
+        "models": {tag: model_status(registry.get(tag)) for tag in registry.tags},
+    }
+    served = registry.get(registry.default)
+    return JSONResponse(
+        content,
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE
+        if served is not None and served.admission.saturated
+        else HTTPStatus.OK,
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    """Metrics in the Prometheus text format."""
+    for tag in registry.tags:
+        served = registry.get(tag)
+        if served is None:
+            for priority in PRIORITIES:
+                QUEUE_DEPTH.set(0, model=tag, priority=priority)
+            ESTIMATED_WAIT.set(0, model=tag)
+            MODEL_MEMORY.set(0, model=tag)
+            continue
+        for priority, depth in served.scheduler.pending_by_priority().items():
+            QUEUE_DEPTH.set(depth, model=tag, priority=priority)
+        ESTIMATED_WAIT.set(served.admission.estimated_wait, model=tag)
+        SECONDS_PER_PAGE.set(served.scheduler.seconds_per_page, model=tag)
+        MODEL_MEMORY.set(served.size, model=tag)
+    return PlainTextResponse(
+        telemetry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+def format_page(output: Dict) -> str:
+    """Convert the model output of a page to markdown and append a disclaimer for repetitions."""
+    disclaimer = ""
+    if output["repeats"] is not None:
+        if output["repeats"] > 0:
+            disclaimer = (
+                "\n\n+++ ==WARNING: Truncated because of repetitions==\n%s\n+++\n\n"
+            )
+        else:
+            disclaimer = "\n\n+++ ==ERROR: No output for this page==\n%s\n+++\n\n"
+        rest = close_envs(output["repetition"]).strip()
+        if len(rest) > 0:
+            disclaimer = disclaimer % rest
+        else:
+            disclaimer = ""
+    return markdown_compatible(output["prediction"]) + disclaimer
+
+
+def chain_future(source: Future, target: Future):
+    """Resolve `target` with the outcome of `source`."""
+
+    def copy(source: Future):
+        try:
+            if source.cancelled():
+                target.cancel()
+            elif source.exception() is not None:
+                target.set_exception(source.exception())
+            else:
+                target.set_result(source.result())
+        except InvalidStateError:
+            # the target was already failed by its job
+            pass
+
+    source.add_done_callback(copy)
+
+
+class InflightPage:
+    """
+    A page that is being converted, shared by all jobs that need it.
+
+    Args:
+        future (Future): Resolves to the model output of the page, or None if the page
+            could not be rendered.
+        task (Future): The page in the inference scheduler, once it is submitted.
+        owner (Job): The job that rasterizes and submits the page.
+        jobs (List[Job]): The jobs that wait for the page.
+    """
+
+    def __init__(self, owner: "Job"):
+        self.future: Future = Future()
+        self.task: Optional[Future] = None
+        self.owner = owner
+        self.jobs: List["Job"] = []
+
+
+class Job:
+    """
+    Conversion of a PDF document submitted to the API.
+
+    The pages that are not cached are rasterized and handed to the inference scheduler,
+    which batches them together with the pages of all other jobs.
+
+    Args:
+        path (Path): The spooled PDF file. It is deleted when the job is finished.
+        md5 (str): The md5 of the PDF file.
+        pages (List[int]): The pages to convert, starting at 0.
+        served (ServedModel): The model that converts the pages. The job holds it until it
+            is finished.
+        admitted (int): Number of pages reserved with the admission controller of the model.
+            They are released as the pages are finished.
+        on_text (Callable[[str], None], optional): Receives the generated text token by token.
+            Called from the inference thread.
+        priority (str): The scheduling class of the pages.
+        client (str): Identifies the client for fair queuing.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        md5: str,
+        pages: List[int],
+        served: ServedModel,
+        admitted: int = 0,
+        on_text: Callable[[str], None] = None,
+        priority: str = "bulk",
+        client: str = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.md5 = md5
+        self.pages = pages
+        self.served = served
+        self.model = served.tag
+        self.admitted = admitted
+        self.on_text = on_text
+        self.priority = priority
+        self.client = client
+        self.index = {page: i for i, page in enumerate(self.pages)}
+        self.predictions: List[Optional[str]] = [None] * len(self.pages)
+        self.failed: List[int] = []
+        self.inflight: Dict[int, InflightPage] = {}
+        self.owned: List[int] = []
+        # set when the job stops waiting for its pages, its threads stop submitting them
+        self.cancelled = False
+        # threads rasterizing and submitting pages, the job is cleaned up once they return
+        self.workers: List[asyncio.Future] = []
+        self.thumb = None
+        self.status = "queued"
+        self.error = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+        self.progress = asyncio.Condition()
+
+    def prepare(self):
+        """Load cached pages, rasterize the others and submit them for inference."""
+        timer = StageTimer()
+        cached = store.get_pages(self.md5, self.pages, self.model)
+        for page, markdown in cached.items():
+            self.predictions[self.index[page]] = markdown
+        PAGES.inc(len(cached), status="cached")
+        timer.lap("store")
+        # pages of the same document that another request is converting right now are not
+        # computed again, this job waits for the result of the other one
+        with INFLIGHT_LOCK:
+            if self.cancelled:
+                return
+            for i, page in enumerate(self.pages):
+                if self.predictions[i] is not None:
+                    continue
+                key = (self.md5, self.model, page)
+                if key not in INFLIGHT:
+                    INFLIGHT[key] = InflightPage(self)
+                    self.owned.append(page)
+                INFLIGHT[key].jobs.append(self)
+                self.inflight[page] = INFLIGHT[key]
+            owned = list(self.owned)
+        self.convert(owned)
+
+    def convert(self, pages: List[int]):
+        """Rasterize `pages`, which this job owns, and submit them for inference."""
+        timer = StageTimer()
+        images = store.get_images(self.md5, pages)
+        render_pages = [page for page in pages if page not in images]
+        timer.lap("store")
+        rendered = rasterize_paper_supervised(
+            self.path,
+            pages=render_pages,
+            timeout=RASTERIZE_TIMEOUT,
+            max_memory=RASTERIZE_MAX_MEMORY,
+        )
+        timer.lap("rasterize")
+        rendered = {
+            page: image.getvalue()
+            for page, image in zip(render_pages, rendered)
+            if image is not None
+        }
+        store.put_images(self.md5, rendered)
+        images.update(rendered)
+        timer.lap("store")
+        for page in pages:
+            image_tensor = None
+            if page in images:
+                if self.thumb is None:
+                    self.thumb = images[page]
+                image_tensor = self.served.model.encoder.prepare_input(
+                    Image.open(io.BytesIO(images[page])), random_padding=False
+                )
+            inflight = self.inflight[page]
+            with INFLIGHT_LOCK:
+                # a cancelled job handed its pages over to the other jobs waiting for them
+                if self.cancelled or inflight.owner is not self:
+                    continue
+                if image_tensor is None:
+                    PAGES.inc(status="failed")
+                    inflight.future.set_result(None)
+                    continue
+                inflight.task = self.served.scheduler.submit(
+                    image_tensor,
+                    self.on_text,
+                    priority=self.priority,
+                    client=self.client,
+                )
+            chain_future(inflight.task, inflight.future)
+        timer.lap("preprocess")
+
+    def adopt(self, page: int):
+        """
+        Take over a page whose owner was cancelled before it submitted the page. Called
+        from the event loop with `INFLIGHT_LOCK` held.
+        """
+        self.inflight[page].owner = self
+        self.owned.append(page)
+        self.workers.append(asyncio.ensure_future(self.convert_adopted(page)))
+
+    async def convert_adopted(self, page: int):
+        try:
+            await run_in_threadpool(self.convert, [page])
+        except Exception as e:
+            logging.exception(e)
+            with INFLIGHT_LOCK:
+                inflight = self.inflight[page]
+                if inflight.owner is self and not inflight.future.done():
+                    inflight.future.set_exception(
+                        RuntimeError(f"Conversion of page {page + 1} failed.")
+                    )
+
+    async def notify(self):
+        async with self.progress:
+            self.progress.notify_all()
+
+    async def run(self):
+        try:
+            worker = asyncio.ensure_future(run_in_threadpool(self.prepare))
+            self.workers.append(worker)
+            # the thread can't be interrupted, it stops submitting once the job is detached
+            await asyncio.shield(worker)
+            self.status = "running"
+            await self.notify()
+            for page, inflight in self.inflight.items():
+                # shielded, cancelling this job must not cancel the page for other jobs
+                output = await asyncio.shield(asyncio.wrap_future(inflight.future))
+                if output is None:
+                    # pages that could not be rendered are marked and not cached, so they are retried next time
+                    self.failed.append(page)
+                    self.predictions[self.index[page]] = (
+                        f"\n\n[MISSING_PAGE_FAIL:{page + 1}]\n\n"
+                    )
+                else:
+                    self.predictions[self.index[page]] = format_page(output)
+                self.release(1)
+                await self.notify()
+            await run_in_threadpool(self.save)
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.error = "The job was cancelled."
+            self.status = "cancelled"
+            raise
+        except Exception as e:
+            logging.exception(e)
+            self.error = str(e)
+            self.status = "failed"
+        finally:
+            self.detach()
+            # completes even if the job is cancelled again while it waits
+            await asyncio.shield(asyncio.ensure_future(self.close()))
+
+    async def close(self):
+        """Release the model and the PDF once the threads of the job have returned."""
+        if len(self.workers) > 0:
+            await asyncio.wait(self.workers)
+        self.finished = time.time()
+        self.release(self.admitted)
+        registry.release(self.served)
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self.thumb = None
+        await self.notify()
+
+    def cancel(self):
+        """Stop the job, e.g. because its client disconnected."""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def detach(self):
+        """
+        Stop waiting for the pages of this job. Pages this job didn't submit yet are
+        handed over to another job that waits for them. Pages that no other job waits for
+        are removed from the inference queue, or ended at the next decoding step.
+        """
+        abandoned = []
+        with INFLIGHT_LOCK:
+            self.cancelled = True
+            for page, inflight in self.inflight.items():
+                inflight.jobs.remove(self)
+                unsubmitted = (
+                    inflight.owner is self
+                    and inflight.task is None
+                    and not inflight.future.done()
+                )
+                if len(inflight.jobs) > 0:
+                    if unsubmitted:
+                        inflight.jobs[0].adopt(page)
+                    continue
+                # the page is stored by now, later requests read it from the store
+                del INFLIGHT[(self.md5, self.model, page)]
+                if inflight.task is not None and not inflight.future.done():
+                    abandoned.append(inflight.task)
+        for task in abandoned:
+            self.served.scheduler.cancel(task)
+
+    def release(self, pages: int):
+        pages = min(pages, self.admitted)
+        self.admitted -= pages
+        self.served.admission.release(pages)
+
+    async def stream(self) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Yield the markdown of every page in page order as soon as it is available.
+
+        Yields:
+            Tuple[int, str]: The page number, starting at 1, and the markdown of the page.
+        """
+        i = 0
+        while True:
+            async with self.progress:
+                await self.progress.wait_for(
+                    lambda: self.finished is not None
+                    or (i < len(self.predictions) and self.predictions[i] is not None)
+                )
+            while i < len(self.predictions) and self.predictions[i] is not None:
+                yield self.pages[i] + 1, self.predictions[i]
+                i += 1
+            if self.finished is not None:
+                break
+
+    def save(self):
+        timer = StageTimer()
+        if self.thumb is not None and store.get_thumbnail(self.md5) is None:
+            thumb = Image.open(io.BytesIO(self.thumb))
+            thumb.thumbnail((400, 400))
+            buffer = io.BytesIO()
+            thumb.convert("RGB").save(buffer, format="JPEG")
+            store.put_thumbnail(self.md5, buffer.getvalue())
+        store.put_pages(
+            self.md5,
+            {
+                page: self.predictions[self.index[page]]
+                for page in self.owned
+                if page not in self.failed
+            },
+            self.model,
+        )
+        self.result = "".join(self.predictions).strip()
+        timer.lap("store")
+
+    def info(self) -> Dict:
+        response = {
+            "id": self.id,
+            "status": self.status,
+            "model": self.model,
+            "priority": self.priority,
+            "pages": len(self.pages),
+            "completed": sum(p is not None for p in self.predictions),
+        }
+        if self.status == "done":
+            response["result"] = self.result
+        elif self.status == "failed":
+            response["error"] = self.error
+        return response
+
+
+async def receive_websocket_upload(websocket: WebSocket) -> Tuple[Path, str]:
+    """
+    Write a PDF sent as binary WebSocket messages to a temporary file, computing its md5
+    on the way. The upload ends with an empty binary message.
+
+    Every message is written as it arrives, so the upload is never held in memory as a
+    whole, and it is rejected as soon as it exceeds `MAX_UPLOAD_SIZE`.
+
+    Returns:
+        Tuple[Path, str]: The temporary file and the md5 of its content.
+    """
+    timer = StageTimer()
+    md5 = hashlib.md5()
+    size = 0
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as out:
+        path = Path(out.name)
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                chunk = message.get("bytes")
+                if chunk is None:
+                    raise HTTPException(
+                        HTTPStatus.BAD_REQUEST, "Send the PDF as binary messages."
+                    )
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(
+                        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        f"The upload exceeds {MAX_UPLOAD_SIZE // 2**20} MB.",
+                    )
+                md5.update(chunk)
+                out.write(chunk)
+        except BaseException:
+            out.close()
+            path.unlink()
+            raise
+    timer.lap("upload")
+    return path, md5.hexdigest()
+
+
+class UploadParser:
+    """
+    Stream the file of one field of a multipart/form-data body to a file as the body
+    arrives, computing its md5 on the way.
+
+    Args:
+        boundary (bytes): The multipart boundary from the Content-Type header.
+        field (str): Name of the form field with the file.
+        out (BinaryIO): Receives the content of the file.
+    """
+
+    def __init__(self, boundary: bytes, field: str, out: BinaryIO):
+        self.field = field.encode()
+        self.out = out
+        self.md5 = hashlib.md5()
+        self.found = False
+        self.writing = False
+        self.header = b""
+        self.value = b""
+        self.disposition = b""
+        self.parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self.on_part_begin,
+                "on_header_field": self.on_header_field,
+                "on_header_value": self.on_header_value,
+                "on_header_end": self.on_header_end,
+                "on_headers_finished": self.on_headers_finished,
+                "on_part_data": self.on_part_data,
+            },
+        )
+
+    def on_part_begin(self):
+        self.disposition = b""
+        self.writing = False
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.value += data[start:end]
+
+    def on_header_end(self):
+        if self.header.lower() == b"content-disposition":
+            self.disposition = self.value
+        self.header = b""
+        self.value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.disposition)
+        # only the first part of the field is kept
+        self.writing = not self.found and options.get(b"name") == self.field
+        self.found = self.found or self.writing
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.writing:
+            chunk = data[start:end]
+            self.md5.update(chunk)
+            self.out.write(chunk)
+
+    def write(self, chunk: bytes):
+        self.parser.write(chunk)
+
+    def finalize(self):
+        self.parser.finalize()
+
+
+async def receive_upload(request: Request, field: str = "file") -> Tuple[Path, str]:
+    """
+    Stream the PDF in the form field `field` of a multipart request to a temporary file.
+
+    The body is parsed as it is received, so the upload is written once, its md5 is
+    computed while it arrives and it is rejected as soon as the body exceeds
+    `MAX_UPLOAD_SIZE`, whether or not the client announced its size.
+
+    Returns:
+        Tuple[Path, str]: The temporary file and the md5 of its content.
+    """
+    timer = StageTimer()
+    _, options = parse_options_header(request.headers.get("content-type", ""))
+    if b"boundary" not in options:
+        raise HTTPException(
+            HTTPStatus.UNSUPPORTED_MEDIA_TYPE, "Upload the PDF as multipart/form-data."
+        )
+    size = 0
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as out:
+        path = Path(out.name)
+        try:
+            upload = UploadParser(options[b"boundary"], field, out)
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(
+                        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        f"The upload exceeds {MAX_UPLOAD_SIZE // 2**20} MB.",
+                    )
+                upload.write(chunk)
+            upload.finalize()
+            if not upload.found:
+                raise HTTPException(
+                    HTTPStatus.UNPROCESSABLE_ENTITY,
+                    f"The form field '{field}' is missing.",
+                )
+        except MultipartParseError as e:
+            out.close()
+            path.unlink()
+            raise HTTPException(HTTPStatus.BAD_REQUEST, f"Invalid multipart body: {e}")
+        except BaseException:
+            out.close()
+            path.unlink()
+            raise
+    timer.lap("upload")
+    return path, upload.md5.hexdigest()
+
+
+# the upload is read by `receive_upload`, this only documents it in the OpenAPI schema
+UPLOAD_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+
+def client_id(connection: HTTPConnection) -> str:
+    """The `X-Client-Id` header, or the address of the client."""
+    if "x-client-id" in connection.headers:
+        return connection.headers["x-client-id"]
+    return connection.client.host if connection.client is not None else None
+
+
+def requested_pages(path: Path, start: int = None, stop: int = None) -> List[int]:
+    """
+    The pages to convert, starting at 0. `start` and `stop` count from 1 and are
+    inclusive, a missing bound is the first or the last page and `stop` is clamped to the
+    number of pages, so that only pages of the document are admitted.
+
+    Raises:
+        HTTPException: If the range contains no page of the document.
+    """
+    pdf = pypdfium2.PdfDocument(str(path))
+    count = len(pdf)
+    pdf.close()
+    first = 1 if start is None else start
+    last = count if stop is None else min(stop, count)
+    if first < 1 or first > last:
+        raise HTTPException(
+            HTTPStatus.BAD_REQUEST,
+            f"The pages {start}-{stop} are not in the document, it has {count} pages.",
+        )
+    return list(range(first - 1, last))
+
+
+async def submit_job(
+    path: Path,
+    md5: str,
+    start: int = None,
+    stop: int = None,
+    on_text: Callable[[str], None] = None,
+    priority: str = None,
+    client: str = None,
+    model: str = None,
+) -> Job:
+    """
+    Admit a conversion job and start it.
+
+    The model tag selects the model, it is loaded if necessary. The cost of the job are
+    its pages that are not stored yet for that model. If the model can't take them without
+    exceeding `NOUGAT_MAX_QUEUE_WAIT`, or the model can't be loaded because the other
+    models are busy, the request is rejected with status 503 and a `Retry-After` header.
+    Without an explicit priority, jobs of at most `NOUGAT_INTERACTIVE_PAGES` pages are
+    interactive and larger ones are bulk work.
+    """
+    served = None
+    try:
+        if priority is not None and priority not in PRIORITIES:
+            raise HTTPException(
+                HTTPStatus.BAD_REQUEST,
+                f"Unknown priority {priority}. Choose from {PRIORITIES}.",
+            )
+        try:
+            pages = await run_in_threadpool(requested_pages, path, start, stop)
+        except pypdfium2.PdfiumError as e:
+            raise HTTPException(HTTPStatus.BAD_REQUEST, str(e))
+        try:
+            served = await run_in_threadpool(registry.acquire, model)
+        except ValueError as e:
+            raise HTTPException(HTTPStatus.BAD_REQUEST, str(e))
+        except MemoryBudgetExceeded as e:
+            raise HTTPException(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                str(e),
+                headers={"Retry-After": str(math.ceil(e.retry_after))},
+            )
+        cost = len(pages) - await run_in_threadpool(
+            store.count_pages, md5, pages, served.tag
+        )
+        retry_after = served.admission.admit(cost)
+        if retry_after is not None:
+            raise HTTPException(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                "The server is busy, try again later.",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+    except BaseException:
+        if served is not None:
+            registry.release(served)
+        path.unlink()
+        raise
+    now = time.time()
+    for job_id, job in list(JOBS.items()):
+        if job.finished is not None and now - job.finished > JOB_TTL:
+            del JOBS[job_id]
+    if priority is None:
+        priority = "interactive" if cost <= INTERACTIVE_PAGES else "bulk"
+    job = Job(path, md5, pages, served, cost, on_text, priority, client)
+    JOBS[job.id] = job
+    job.task = asyncio.create_task(job.run())
+    return job
+
+
+def jobs_available():
+    """
+    Reject the `/jobs` endpoints in forked workers: a job only exists in the worker that
+    created it, requests for it would reach other workers that can't find it.
+    """
+    if FORKED:
+        raise HTTPException(
+            HTTPStatus.NOT_IMPLEMENTED,
+            "Jobs are not available when the server runs several workers, use /predict/ "
+            "or /predict/stream.",
+        )
+
+
+@app.post(
+    "/jobs",
+    status_code=HTTPStatus.ACCEPTED,
+    openapi_extra=UPLOAD_BODY,
+    dependencies=[Depends(jobs_available)],
+)
+async def create_job(
+    request: Request,
+    start: int = None,
+    stop: int = None,
+    priority: str = None,
+    model: str = None,
+) -> Dict:
+    """
+    Submit a PDF document for conversion without waiting for the result.
+
+    Args:
+        request (Request): The request, with the PDF file in the form field `file`.
+        start (int, optional): The starting page number for prediction.
+        stop (int, optional): The ending page number for prediction.
+        priority (str, optional): The scheduling class, "interactive" or "bulk".
+        model (str, optional): The model tag, one of `NOUGAT_MODELS`.
+
+    Returns:
+        Dict: The job id and status. Poll `GET /jobs/{id}` for the result.
+    """
+    path, md5 = await receive_upload(request)
+    job = await submit_job(
+        path,
+        md5,
+        start,
+        stop,
+        priority=priority,
+        client=client_id(request),
+        model=model,
+    )
+    return job.info()
+
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(jobs_available)])
+async def get_job(job_id: str) -> Dict:
+    """
+    Status of a conversion job. Finished jobs contain the extracted text in Markdown
+    format and are kept for `NOUGAT_JOB_TTL` seconds.
+    """
+    if job_id not in JOBS:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}")
+    return JOBS[job_id].info()
+
+
+async def server_sent_events(job: Job, cancel: bool = False) -> AsyncIterator[bytes]:
+    try:
+        async for page, markdown in job.stream():
+            yield b"event: page\ndata: %s\n\n" % orjson.dumps(
+                {"page": page, "markdown": markdown}
+            )
+        if job.status == "done":
+            yield b"event: done\ndata: %s\n\n" % orjson.dumps({"id": job.id})
+        else:
+            yield b"event: error\ndata: %s\n\n" % orjson.dumps(
+                {"id": job.id, "error": job.error}
+            )
+    finally:
+        # the stream is closed early when the client disconnects
+        if cancel:
+            job.cancel()
+
+
+def event_stream(job: Job, cancel: bool = False) -> StreamingResponse:
+    """
+    Stream the pages of `job` as server-sent events.
+
+    Args:
+        job (Job): The job.
+        cancel (bool): Whether to cancel the job when the client disconnects.
+    """
+    return StreamingResponse(
+        server_sent_events(job, cancel),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/jobs/{job_id}/stream", dependencies=[Depends(jobs_available)])
+async def stream_job(job_id: str) -> StreamingResponse:
+    """
+    Stream the pages of a conversion job as server-sent events. See `/predict/stream`.
+    """
+    if job_id not in JOBS:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}")
+    return event_stream(JOBS[job_id])
+
+
+@app.delete("/jobs/{job_id}", dependencies=[Depends(jobs_available)])
+async def cancel_job(job_id: str) -> Dict:
+    """
+    Cancel a conversion job. Its pages are dropped from the inference queue or ended at
+    the next decoding step, unless another request needs them too.
+    """
+    if job_id not in JOBS:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Unknown job {job_id}")
+    job = JOBS[job_id]
+    job.cancel()
+    if job.task is not None:
+        await asyncio.wait({job.task})
+    return job.info()
+
+
+@app.post("/predict/stream", openapi_extra=UPLOAD_BODY)
+async def predict_stream(
+    request: Request,
+    start: int = None,
+    stop: int = None,
+    priority: str = None,
+    model: str = None,
+) -> StreamingResponse:
+    """
+    Perform predictions on a PDF document and stream the pages as server-sent events.
+
+    Every page is sent in page order as soon as it is finished, as a `page` event with the
+    page number and the markdown including the repetition disclaimer. The stream ends
+    with a `done` event, or an `error` event if the conversion failed. The conversion is
+    cancelled when the client disconnects.
+
+    Args:
+        request (Request): The request, with the PDF file in the form field `file`.
+        start (int, optional): The starting page number for prediction.
+        stop (int, optional): The ending page number for prediction.
+        priority (str, optional): The scheduling class, "interactive" or "bulk".
+        model (str, optional): The model tag, one of `NOUGAT_MODELS`.
+    """
+    path, md5 = await receive_upload(request)
+    job = await submit_job(
+        path,
+        md5,
+        start,
+        stop,
+        priority=priority,
+        client=client_id(request),
+        model=model,
+    )
+    return event_stream(job, cancel=True)
+
+
+async def wait_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+@app.websocket("/predict/page")
+async def predict_page(websocket: WebSocket, page: int, model: str = None):
+    """
+    Convert a single page and stream the text while it is generated.
+
+    The client sends the PDF file in binary messages of at most 16 MiB each (the message
+    size limit of uvicorn) and ends the upload with an empty binary message. Uploads
+    larger than `MAX_UPLOAD_SIZE` are answered with an error. The server answers with
+    `{"type": "token", "text": ...}` messages as the decoder generates tokens and finishes
+    with the postprocessed markdown in `{"type": "page", "page": ..., "markdown": ...}`,
+    or `{"type": "error", "error": ...}`. The streamed text is not postprocessed, only the
+    final message is. The conversion is cancelled when the client disconnects.
+
+    Args:
+        page (int): The page number, starting at 1.
+        model (str, optional): The model tag, one of `NOUGAT_MODELS`.
+    """
+    await websocket.accept()
+    job = None
+    disconnected = None
+    try:
+        path, md5 = await receive_websocket_upload(websocket)
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+        job = await submit_job(
+            path,
+            md5,
+            page,
+            page,
+            on_text=lambda text: loop.call_soon_threadsafe(tokens.put_nowait, text),
+            priority="interactive",
+            client=client_id(websocket),
+            model=model,
+        )
+        disconnected = asyncio.ensure_future(wait_disconnect(websocket))
+        while not job.task.done():
+            token = asyncio.ensure_future(tokens.get())
+            await asyncio.wait(
+                {token, job.task, disconnected}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected.done():
+                token.cancel()
+                job.cancel()
+                return
+            if not token.done():
+                token.cancel()
+                break
+            await websocket.send_json({"type": "token", "text": token.result()})
+        while not tokens.empty():
+            await websocket.send_json({"type": "token", "text": tokens.get_nowait()})
+        if job.status == "done":
+            await websocket.send_json(
+                {"type": "page", "page": page, "markdown": job.predictions[0]}
+            )
+        else:
+            await websocket.send_json({"type": "error", "error": job.error})
+        await websocket.close()
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "error": e.detail})
+        await websocket.close()
+    except WebSocketDisconnect:
+        if job is not None:
+            job.cancel()
+    finally:
+        if disconnected is not None:
+            disconnected.cancel()
+
+
+async def wait_or_cancel(job: Job, request: Request) -> bool:
+    """
+    Wait for `job` to finish, and cancel it if the client disconnects first.
+
+    Returns:
+        bool: Whether the job finished.
+    """
+    while True:
+        done, _ = await asyncio.wait({job.task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if len(done) > 0:
+            return True
+        if await request.is_disconnected():
+            job.cancel()
+            return False
+
+
+@app.post("/predict/", openapi_extra=UPLOAD_BODY)
 async def predict(
-    file: UploadFile = File(...), start: int = None, stop: int = None
+    request: Request,
+    start: int = None,
+    stop: int = None,
+    priority: str = None,
+    model: str = None,
 ) -> str:
     """
     Perform predictions on a PDF document and return the extracted text in Markdown format.
 
     Args:
-        file (UploadFile): The uploaded PDF file to process.
+        request (Request): The request, with the PDF file in the form field `file`.
         start (int, optional): The starting page number for prediction.
         stop (int, optional): The ending page number for prediction.
+        priority (str, optional): The scheduling class, "interactive" or "bulk".
+        model (str, optional): The model tag, one of `NOUGAT_MODELS`.
 
     Returns:
         str: The extracted text in Markdown format.
     """
-    pdfbin = file.file.read()
-    pdf = pypdfium2.PdfDocument(pdfbin)
-    md5 = hashlib.md5(pdfbin).hexdigest()
-    save_path = SAVE_DIR / md5
-
-    if start is not None and stop is not None:
-        pages = list(range(start - 1, stop))
-    else:
-        pages = list(range(len(pdf)))
-    predictions = [""] * len(pages)
-    dellist = []
-    if save_path.exists():
-        for computed in (save_path / "pages").glob("*.mmd"):
-            try:
-                idx = int(computed.stem) - 1
-                if idx in pages:
-                    i = pages.index(idx)
-                    print("skip page", idx + 1)
-                    predictions[i] = computed.read_text(encoding="utf-8")
-                    dellist.append(idx)
-            except Exception as e:
-                print(e)
-    compute_pages = pages.copy()
-    for el in dellist:
-        compute_pages.remove(el)
-    images = rasterize_paper(pdf, pages=compute_pages)
-    global model
-
-    dataset = ImageDataset(
-        images,
-        partial(model.encoder.prepare_input, random_padding=False),
+    path, md5 = await receive_upload(request)
+    job = await submit_job(
+        path,
+        md5,
+        start,
+        stop,
+        priority=priority,
+        client=client_id(request),
+        model=model,
     )
+    if not await wait_or_cancel(job, request):
+        # nobody is left to receive the response
+        return ""
+    if job.status == "failed":
+        raise HTTPException(HTTPStatus.INTERNAL_SERVER_ERROR, job.error)
+    return job.result
 
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=BATCHSIZE,
-        pin_memory=True,
-        shuffle=False,
-    )
 
-    for idx, sample in tqdm(enumerate(dataloader), total=len(dataloader)):
-        if sample is None:
-            continue
-        model_output = model.inference(image_tensors=sample)
-        for j, output in enumerate(model_output["predictions"]):
-            if model_output["repeats"][j] is not None:
-                if model_output["repeats"][j] > 0:
-                    disclaimer = "\n\n+++ ==WARNING: Truncated because of repetitions==\n%s\n+++\n\n"
-                else:
-                    disclaimer = (
-                        "\n\n+++ ==ERROR: No output for this page==\n%s\n+++\n\n"
-                    )
-                rest = close_envs(model_output["repetitions"][j]).strip()
-                if len(rest) > 0:
-                    disclaimer = disclaimer % rest
-                else:
-                    disclaimer = ""
-            else:
-                disclaimer = ""
+def serve_forked(host: str, port: int, workers: int):
+    """
+    Load the default model once and fork `workers` processes that serve the API on a
+    shared socket. The workers share the weights copy-on-write, so more workers for
+    rasterization and postprocessing don't multiply the memory of the model. Every worker
+    runs its own inference scheduler with an equal share of the CPU threads. Workers that
+    exit unexpectedly are replaced. Jobs would only be known to the worker that created
+    them, so the `/jobs` endpoints are disabled.
+    """
+    import uvicorn
 
-            predictions[pages.index(compute_pages[idx * BATCHSIZE + j])] = (
-                markdown_compatible(output) + disclaimer
-            )
+    global registry, FORKED
+    registry = create_registry()
+    registry.preload()
+    FORKED = True
+    config = uvicorn.Config(app, host=host, port=port)
+    sock = config.bind_socket()
+    threads = max(1, torch.get_num_threads() // workers)
+    # keep the garbage collector from writing to the pages of the loaded objects
+    gc.freeze()
 
-    (save_path / "pages").mkdir(parents=True, exist_ok=True)
-    pdf.save(save_path / "doc.pdf")
-    if len(images) > 0:
-        thumb = Image.open(images[0])
-        thumb.thumbnail((400, 400))
-        thumb.save(save_path / "thumb.jpg")
-    for idx, page_num in enumerate(pages):
-        (save_path / "pages" / ("%02d.mmd" % (page_num + 1))).write_text(
-            predictions[idx], encoding="utf-8"
-        )
-    final = "".join(predictions).strip()
-    (save_path / "doc.mmd").write_text(final, encoding="utf-8")
-    return final
+    def fork() -> int:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            torch.set_num_threads(threads)
+            uvicorn.Server(config).run(sockets=[sock])
+            os._exit(0)
+        return pid
+
+    pids = [fork() for _ in range(workers)]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while len(pids) > 0:
+        pid, status = os.wait()
+        pids.remove(pid)
+        if not stopping:
+            logging.warning(f"Worker {pid} exited with status {status}, restarting.")
+            pids.append(fork())
+    sock.close()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Nougat API server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Bind address.")
+    parser.add_argument("--port", type=int, default=8503, help="Port.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("NOUGAT_WORKERS", 1)),
+        help="Number of worker processes. With more than one, the model is loaded once and the workers are forked from the loading process.",
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and USE_CUDA and torch.cuda.is_available():
+        parser.error(
+            "Forked workers can't use CUDA. Set NOUGAT_BATCHSIZE=0 to run them on the CPU."
+        )
+    if args.workers > 1:
+        serve_forked(args.host, args.port, args.workers)
+        return
     import uvicorn
 
-    uvicorn.run("app:app", port=8503)
+    uvicorn.run("app:app", host=args.host, port=args.port)
 
 
 if __name__ == "__main__":
@@ -4,12 +4,37 @@ Copyright (c) 2022-present NAVER Corp.
 MIT License
 Copyright (c) Meta Platforms, Inc. and affiliates.
 """
-from .model import NougatConfig, NougatModel
-from .utils.dataset import NougatDataset
+import importlib
+from typing import TYPE_CHECKING
+
 from ._version import __version__
 
+if TYPE_CHECKING:
+    from .model import NougatConfig, NougatModel
+    from .utils.dataset import NougatDataset
+
+# The model pulls in torch, timm and transformers, so the public classes are imported
+# on first access. Tools like the metrics or the rasterizer don't pay for them.
+_LAZY_IMPORTS = {
+    "NougatConfig": ".model",
+    "NougatModel": ".model",
+    "NougatDataset": ".utils.dataset",
+}
+
 __all__ = [
     "NougatConfig",
     "NougatModel",
     "NougatDataset",
 ]
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
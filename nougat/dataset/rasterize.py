@@ -6,12 +6,21 @@ LICENSE file in the root directory of this source tree.
 """
 import argparse
 import logging
+import multiprocessing
+from multiprocessing.connection import wait
 import pypdfium2
 from pathlib import Path
 from tqdm import tqdm
 import io
+import time
+from collections import deque
 from typing import Optional, List, Union
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 logging.getLogger("pypdfium2").setLevel(logging.WARNING)
 
 
@@ -61,6 +70,155 @@ def rasterize_paper(
         return pils
 
 
+def _limit_memory(max_memory: int):
+    """Limit the address space of this process to its current size plus `max_memory` bytes."""
+    if resource is None:
+        return
+    current = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmSize:"):
+                    current = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    limit = current + max_memory
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _raster_worker(conn, pdf: Union[str, bytes], dpi: int, max_memory: Optional[int]):
+    if max_memory:
+        _limit_memory(max_memory)
+    try:
+        doc = pypdfium2.PdfDocument(pdf)
+    except Exception as e:
+        logging.error(e)
+        doc = None
+    while True:
+        page = conn.recv()
+        if page is None:
+            break
+        try:
+            image = doc[page].render(scale=dpi / 72).to_pil()
+            page_bytes = io.BytesIO()
+            image.save(page_bytes, "bmp")
+            conn.send_bytes(page_bytes.getvalue())
+        except Exception as e:
+            logging.error(e)
+            conn.send_bytes(b"")
+
+
+class _RasterProcess:
+    def __init__(self, ctx, pdf, dpi: int, max_memory: Optional[int]):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_raster_worker, args=(child_conn, pdf, dpi, max_memory), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.page = None
+        self.deadline = None
+
+    def submit(self, page: int, timeout: float):
+        self.page = page
+        self.deadline = time.monotonic() + timeout
+        self.conn.send(page)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+def rasterize_paper_supervised(
+    pdf: Union[Path, bytes],
+    dpi: int = 96,
+    pages: Optional[List[int]] = None,
+    timeout: float = 120,
+    max_memory: Optional[int] = None,
+    processes: int = 1,
+) -> List[Optional[io.BytesIO]]:
+    """
+    Rasterize a PDF file in supervised subprocesses.
+
+    Every page is rendered by a worker process that is killed if the page takes longer than
+    `timeout` seconds or needs more than `max_memory` bytes, so a single malformed page can't
+    stall the whole pipeline.
+
+    Args:
+        pdf (Union[Path, bytes]): The path to the PDF file or its content.
+        dpi (int, optional): The output DPI. Defaults to 96.
+        pages (Optional[List[int]], optional): The pages to rasterize. If None, all pages will be rasterized. Defaults to None.
+        timeout (float, optional): Maximum seconds per page. Defaults to 120.
+        max_memory (Optional[int], optional): Maximum additional memory per worker in bytes. Defaults to None.
+        processes (int, optional): Number of worker processes. Defaults to 1.
+
+    Returns:
+        List[Optional[io.BytesIO]]: The rendered images in the order of `pages`. Pages that
+        could not be rendered are None.
+    """
+    if isinstance(pdf, Path):
+        pdf = str(pdf)
+    if pages is None:
+        try:
+            pages = range(len(pypdfium2.PdfDocument(pdf)))
+        except Exception as e:
+            logging.error(e)
+            return []
+    results = {}
+    todo = deque(pages)
+    ctx = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+    idle = [
+        _RasterProcess(ctx, pdf, dpi, max_memory)
+        for _ in range(max(1, min(processes, len(todo))))
+    ]
+    busy = {}
+    while len(todo) > 0 or len(busy) > 0:
+        while len(todo) > 0 and len(idle) > 0:
+            worker = idle.pop()
+            worker.submit(todo.popleft(), timeout)
+            busy[worker.conn] = worker
+        next_deadline = min(worker.deadline for worker in busy.values())
+        for conn in wait(list(busy), max(0, next_deadline - time.monotonic())):
+            worker = busy.pop(conn)
+            try:
+                data = conn.recv_bytes()
+                results[worker.page] = io.BytesIO(data) if data else None
+            except EOFError:
+                # worker died, most likely because it ran out of memory
+                logging.warning(f"Rasterizing page {worker.page + 1} crashed.")
+                worker.kill()
+                if len(todo) == 0:
+                    continue
+                worker = _RasterProcess(ctx, pdf, dpi, max_memory)
+            idle.append(worker)
+        now = time.monotonic()
+        for conn, worker in list(busy.items()):
+            if now > worker.deadline:
+                logging.warning(
+                    f"Rasterizing page {worker.page + 1} timed out after {timeout}s."
+                )
+                del busy[conn]
+                worker.kill()
+                if len(todo) > 0:
+                    idle.append(_RasterProcess(ctx, pdf, dpi, max_memory))
+    for worker in idle:
+        worker.close()
+    return [results.get(page) for page in pages]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--pdfs", nargs="+", type=Path, help="PDF files", required=True)
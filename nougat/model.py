@@ -4,10 +4,14 @@ Copyright (c) 2022-present NAVER Corp.
 MIT License
 Copyright (c) Meta Platforms, Inc. and affiliates.
 """
+import inspect
 import logging
 import math
 import os
-from typing import List, Optional, Union
+import pickle
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, List, Optional, Union
 from collections import defaultdict
 from pathlib import Path
 
@@ -22,6 +26,8 @@ from PIL import ImageOps
 from timm.models.swin_transformer import SwinTransformer
 from torchvision.transforms.functional import resize, rotate
 from transformers import (
+    LogitsProcessor,
+    LogitsProcessorList,
     PreTrainedTokenizerFast,
     StoppingCriteria,
     StoppingCriteriaList,
@@ -29,8 +35,18 @@ from transformers import (
     MBartForCausalLM,
 )
 from transformers.file_utils import ModelOutput
-from transformers.modeling_utils import PretrainedConfig, PreTrainedModel
+from transformers.modeling_utils import (
+    PretrainedConfig,
+    PreTrainedModel,
+    no_init_weights,
+)
 from nougat.postprocessing import postprocess
+from nougat.utils.checkpoint import (
+    PYTORCH_WEIGHTS,
+    SAFETENSORS_WEIGHTS,
+    load_safetensors,
+)
+from nougat.utils.telemetry import StageTimer
 from nougat.transforms import train_transform, test_transform
 
 
@@ -474,6 +490,112 @@ class StoppingCriteriaScores(StoppingCriteria):
         return all(self.stopped.values()) and len(self.stopped) > 0
 
 
+class TokenStreamer(StoppingCriteria):
+    """
+    Passes the text of every generated token to a callback while `generate` is running.
+
+    Implemented as a stopping criterion that never stops, because it is called after every
+    decoding step in all supported `transformers` versions. Tokens are detokenized
+    incrementally: only a short window of tokens is decoded per step and text is held back
+    while it ends in an incomplete character.
+
+    Args:
+        tokenizer (PreTrainedTokenizerFast): The decoder tokenizer.
+        callback (Callable[[int, str], None]): Called with the row in the batch and the new text.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerFast, callback: Callable):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.callback = callback
+        self.tokens = defaultdict(list)
+        self.prefix_offset = defaultdict(int)
+        self.read_offset = defaultdict(int)
+        self.finished = set()
+
+    def _decode(self, b: int) -> str:
+        tokens = self.tokens[b]
+        prefix = self.tokenizer.decode(
+            tokens[self.prefix_offset[b] : self.read_offset[b]],
+            skip_special_tokens=True,
+        )
+        text = self.tokenizer.decode(
+            tokens[self.prefix_offset[b] :], skip_special_tokens=True
+        )
+        if len(text) > len(prefix) and not text.endswith("\ufffd"):
+            self.prefix_offset[b] = self.read_offset[b]
+            self.read_offset[b] = len(tokens)
+            return text[len(prefix) :]
+        return ""
+
+    @torch.no_grad()
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        for b, token in enumerate(input_ids[:, -1].tolist()):
+            if b in self.finished:
+                continue
+            if token in (self.tokenizer.eos_token_id, self.tokenizer.pad_token_id):
+                self.finished.add(b)
+                continue
+            self.tokens[b].append(token)
+            text = self._decode(b)
+            if len(text) > 0:
+                self.callback(b, text)
+        return False
+
+
+class EndCancelledRows(LogitsProcessor):
+    """
+    Forces the end of the sequence in rows of the batch that are no longer needed, so they
+    stop decoding at the next step and the batch finishes as soon as the other rows do.
+
+    Args:
+        eos_token_id (int): The end of sequence token.
+        cancelled (Callable[[int], bool]): Called with the row in the batch before every step.
+    """
+
+    def __init__(self, eos_token_id: int, cancelled: Callable[[int], bool]):
+        self.eos_token_id = eos_token_id
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        rows = [b for b in range(len(scores)) if self.cancelled(b)]
+        if len(rows) > 0:
+            scores[rows] = -float("inf")
+            scores[rows, self.eos_token_id] = 0
+        return scores
+
+
+# torch>=2.1 can assign loaded tensors to the parameters instead of copying them
+LOAD_ASSIGN = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+_EMPTY_WEIGHTS_LOCK = threading.Lock()
+
+
+@contextmanager
+def empty_weights():
+    """
+    Create the parameters of the modules built by this thread in this context on the meta
+    device, so that they are neither allocated nor initialized. Load the weights with
+    `load_state_dict(..., assign=True)` afterwards. Buffers are created as usual, because
+    modules like the SwinTransformer compute them in their constructor.
+    """
+    register_parameter = nn.Module.register_parameter
+    thread = threading.get_ident()
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and threading.get_ident() == thread:
+            module._parameters[name] = nn.Parameter(
+                param.to("meta"), requires_grad=param.requires_grad
+            )
+
+    with _EMPTY_WEIGHTS_LOCK:
+        nn.Module.register_parameter = register_empty_parameter
+        try:
+            yield
+        finally:
+            nn.Module.register_parameter = register_parameter
+
+
 def batch(l, b=15):
     subs = []
     for i in range(len(l) - b):
@@ -517,6 +639,33 @@ class NougatModel(PreTrainedModel):
             name_or_path=self.config.name_or_path,
             hidden_dimension=self.config.hidden_dimension,
         )
+        # exported graphs used by `inference`, see `set_backend`
+        self.graphs = None
+
+    def set_backend(
+        self, backend: str, checkpoint: Optional[Union[str, os.PathLike]] = None
+    ):
+        """
+        Select how `inference` runs the model. "eager" runs the modules, "export" runs
+        graphs of the encoder and of a cached decoder step exported with `torch.export`
+        for the current device and precision. The graphs are stored in the checkpoint;
+        if there are none, the model is exported and verified to decode the same tokens
+        first. Move the model before selecting the backend.
+
+        Args:
+            backend (str): "eager" or "export".
+            checkpoint (Optional[os.PathLike]): The checkpoint directory. Defaults to the
+                directory the model was loaded from.
+        """
+        from nougat.utils.export import BACKENDS, load_or_export
+
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}. Choose from {BACKENDS}.")
+        self.graphs = None
+        if backend == "export":
+            self.graphs = load_or_export(
+                Path(checkpoint or self.config.name_or_path), self
+            )
 
     def forward(
         self,
@@ -550,6 +699,8 @@ class NougatModel(PreTrainedModel):
         image_tensors: Optional[torch.Tensor] = None,
         return_attentions: bool = False,
         early_stopping: bool = True,
+        streamer: Optional[Callable[[int, str], None]] = None,
+        cancelled: Optional[Callable[[int], bool]] = None,
     ):
         """
         Generate a token sequence in an auto-regressive manner.
@@ -558,6 +709,11 @@ class NougatModel(PreTrainedModel):
             image: input document image (PIL.Image)
             image_tensors: (1, num_channels, height, width)
                 convert prompt to tensor if image_tensor is not fed
+            streamer: called with the index in the batch and the decoded text of every new token.
+                The text is not postprocessed and may contain repetitions that are removed
+                from the final prediction.
+            cancelled: called with the index in the batch before every decoding step. Rows for
+                which it returns True are ended at that step.
         """
         output = {
             "predictions": list(),
@@ -577,7 +733,16 @@ class NougatModel(PreTrainedModel):
 
         image_tensors = image_tensors.to(self.device)
 
-        last_hidden_state = self.encoder(image_tensors)
+        timer = StageTimer()
+        graphs = self.graphs
+        encoder = self.encoder if graphs is None else graphs.encoder
+        last_hidden_state = encoder(image_tensors)
+        # the decoder can run in a different precision than the encoder
+        last_hidden_state = last_hidden_state.to(self.decoder.model.dtype)
+        if last_hidden_state.is_cuda:
+            # kernels run asynchronously, wait for them to attribute the time correctly
+            torch.cuda.synchronize(last_hidden_state.device)
+        timer.lap("encode")
 
         encoder_outputs = ModelOutput(
             last_hidden_state=last_hidden_state, attentions=None
@@ -589,24 +754,37 @@ class NougatModel(PreTrainedModel):
             )
 
         # get decoder output
-        decoder_output = self.decoder.model.generate(
-            encoder_outputs=encoder_outputs,
-            min_length=1,
-            max_length=self.config.max_length,
-            pad_token_id=self.decoder.tokenizer.pad_token_id,
-            eos_token_id=self.decoder.tokenizer.eos_token_id,
-            use_cache=True,
-            bad_words_ids=[
-                [self.decoder.tokenizer.unk_token_id],
-            ],
-            return_dict_in_generate=True,
-            output_scores=True,
-            output_attentions=return_attentions,
-            do_sample=False,
-            stopping_criteria=StoppingCriteriaList(
-                [StoppingCriteriaScores()] if early_stopping else []
-            ),
-        )
+        with nullcontext() if graphs is None else graphs.decoding(self.decoder.model):
+            decoder_output = self.decoder.model.generate(
+                encoder_outputs=encoder_outputs,
+                min_length=1,
+                max_length=self.config.max_length,
+                pad_token_id=self.decoder.tokenizer.pad_token_id,
+                eos_token_id=self.decoder.tokenizer.eos_token_id,
+                use_cache=True,
+                bad_words_ids=[
+                    [self.decoder.tokenizer.unk_token_id],
+                ],
+                return_dict_in_generate=True,
+                output_scores=True,
+                output_attentions=return_attentions,
+                do_sample=False,
+                logits_processor=LogitsProcessorList(
+                    [EndCancelledRows(self.decoder.tokenizer.eos_token_id, cancelled)]
+                    if cancelled is not None
+                    else []
+                ),
+                # the streamer goes first, the criteria are evaluated lazily
+                stopping_criteria=StoppingCriteriaList(
+                    (
+                        [TokenStreamer(self.decoder.tokenizer, streamer)]
+                        if streamer is not None
+                        else []
+                    )
+                    + ([StoppingCriteriaScores()] if early_stopping else [])
+                ),
+            )
+        timer.lap("decode")
         output["repetitions"] = decoder_output.sequences.clone()
         output["sequences"] = decoder_output.sequences.clone()
         batch_size = len(decoder_output.sequences)
@@ -658,6 +836,7 @@ class NougatModel(PreTrainedModel):
             ),
             markdown_fix=False,
         )
+        timer.lap("postprocess")
 
         if return_attentions:
             output["attentions"] = {
@@ -680,10 +859,22 @@ class NougatModel(PreTrainedModel):
         Args:
             model_path:
                 Name of a pretrained model name either registered in huggingface.co. or saved in local.
+                Local checkpoints with a `model.safetensors` file are memory-mapped.
         """
-        model = super(NougatModel, cls).from_pretrained(
-            model_path, *model_args, **kwargs
-        )
+        checkpoint = Path(os.fsdecode(model_path))
+        model = None
+        if "state_dict" not in kwargs and not kwargs.get(
+            "ignore_mismatched_sizes", False
+        ):
+            model = cls._from_checkpoint(checkpoint, *model_args, **kwargs)
+        if model is None:
+            weights = checkpoint / SAFETENSORS_WEIGHTS
+            if weights.exists() and "state_dict" not in kwargs:
+                # resized models are loaded by transformers
+                kwargs["state_dict"] = load_safetensors(weights)
+            model = super(NougatModel, cls).from_pretrained(
+                model_path, *model_args, **kwargs
+            )
 
         # truncate or interpolate position embeddings of decoder
         max_length = kwargs.get("max_length", model.config.max_position_embeddings)
@@ -700,3 +891,81 @@ class NougatModel(PreTrainedModel):
             model.config.max_position_embeddings = max_length
 
         return model
+
+    @classmethod
+    def _from_checkpoint(cls, checkpoint: Path, *model_args, **kwargs):
+        """
+        Build the model from the config of a local `checkpoint` with empty parameters and
+        use the tensors of its weight file as the parameters. `model.safetensors` is
+        memory-mapped, `pytorch_model.bin` too if torch supports it.
+
+        Returns:
+            Optional[NougatModel]: The model, or None if the checkpoint has to be loaded by
+            transformers.
+        """
+        if (checkpoint / SAFETENSORS_WEIGHTS).exists():
+            state_dict = load_safetensors(checkpoint / SAFETENSORS_WEIGHTS)
+        elif LOAD_ASSIGN and (checkpoint / PYTORCH_WEIGHTS).exists():
+            try:
+                state_dict = torch.load(
+                    checkpoint / PYTORCH_WEIGHTS,
+                    map_location="cpu",
+                    mmap=True,
+                    weights_only=True,
+                )
+            except (RuntimeError, pickle.UnpicklingError) as e:
+                # e.g. checkpoints in the legacy format can't be memory-mapped
+                logging.debug(f"Can't memory-map {checkpoint / PYTORCH_WEIGHTS}: {e}")
+                return None
+        else:
+            return None
+        config, _ = cls.config_class.from_pretrained(
+            checkpoint, return_unused_kwargs=True, **kwargs
+        )
+        # a local checkpoint, don't download the pretrained encoder and decoder
+        config.name_or_path = str(checkpoint)
+        if not LOAD_ASSIGN:
+            with no_init_weights():
+                model = cls(config, *model_args)
+            keys = model.load_state_dict(state_dict, strict=False)
+        else:
+            with no_init_weights(), empty_weights():
+                model = cls(config, *model_args)
+            keys = model.load_state_dict(state_dict, strict=False, assign=True)
+        cls._check_keys(model, checkpoint, keys.missing_keys, keys.unexpected_keys)
+        return model.eval()
+
+    @staticmethod
+    def _check_keys(
+        model: nn.Module,
+        checkpoint: Path,
+        missing_keys: List[str],
+        unexpected_keys: List[str],
+    ):
+        """
+        Raise if the weights of `checkpoint` don't match the model. Only buffers, which the
+        modules compute in their constructor, and output embeddings tied to the input
+        embeddings may be missing; the tied embeddings are tied again.
+
+        Raises:
+            RuntimeError: If other weights are missing or the checkpoint has unknown weights.
+        """
+        tolerated = {name for name, _ in model.named_buffers()}
+        tied = []
+        for prefix, module in model.named_modules():
+            if isinstance(module, PreTrainedModel) and module.config.tie_word_embeddings:
+                keys = [
+                    f"{prefix}.{key}" if prefix else key
+                    for key in module._tied_weights_keys or []
+                ]
+                tolerated.update(keys)
+                if any(key in missing_keys for key in keys):
+                    tied.append(module)
+        missing = [key for key in missing_keys if key not in tolerated]
+        if len(missing) > 0 or len(unexpected_keys) > 0:
+            raise RuntimeError(
+                f"The weights of {checkpoint} don't match the model. "
+                f"Missing: {missing}. Unexpected: {unexpected_keys}."
+            )
+        for module in tied:
+            module.tie_weights()
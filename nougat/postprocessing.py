@@ -5,20 +5,34 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-from typing import Union, List
+from typing import FrozenSet, Union, List
 import re
 import os
 import numpy as np
-from nltk.corpus import words
 from multiprocessing import Pool
-from functools import partial
-from rapidfuzz.fuzz import ratio as ratio_perc
+from functools import lru_cache, partial
 
 
 def ratio(*args, **kwargs):
+    from rapidfuzz.fuzz import ratio as ratio_perc
+
     return ratio_perc(*args, **kwargs) / 100
 
 
+@lru_cache(maxsize=1)
+def english_words() -> FrozenSet[str]:
+    """
+    The words of the nltk `words` corpus. nltk is imported on the first call, because it
+    takes a while and most of the postprocessing doesn't need it.
+
+    Raises:
+        LookupError: If the corpus is not downloaded.
+    """
+    from nltk.corpus import words
+
+    return frozenset(words.words())
+
+
 reference_pattern = re.compile(r"^\* \[\d+\]", flags=re.M)
 
 
@@ -437,7 +451,7 @@ def postprocess_single(generation: str, markdown_fix: bool = True) -> str:
     else:
         try:
             last_word = generation.split(" ")[-1]
-            if last_word in words.words():
+            if last_word in english_words():
                 generation += " "
         except LookupError:
             # add space just in case. Will split words but better than concatenating them
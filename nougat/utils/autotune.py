@@ -0,0 +1,416 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import copy
+import time
+import logging
+import argparse
+import platform
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import orjson
+import torch
+from PIL import Image, ImageDraw
+
+from nougat.utils.checkpoint import MODEL_TAG, get_checkpoint
+from nougat.utils.replicas import available_cores
+from nougat.utils.workqueue import atomic_write
+
+SAMPLE_TEXT = (
+    "We consider the problem of estimating the parameters of a model from noisy "
+    "observations and show that the estimator converges at the optimal rate. "
+)
+
+
+def cache_path() -> Path:
+    """The file with the tuned configurations, `NOUGAT_AUTOTUNE_CACHE` or in the torch hub directory."""
+    if os.environ.get("NOUGAT_AUTOTUNE_CACHE"):
+        return Path(os.environ["NOUGAT_AUTOTUNE_CACHE"])
+    return Path(torch.hub.get_dir()) / "nougat-autotune.json"
+
+
+def machine_id() -> str:
+    """Identifies the host and the device the model runs on."""
+    if torch.cuda.is_available():
+        device = torch.cuda.get_device_name(0)
+    else:
+        device = f"{platform.machine()} {len(available_cores())} cores"
+    return f"{platform.node()}/{device}"
+
+
+def precision(bf16: bool) -> str:
+    return "bfloat16" if bf16 else "float32"
+
+
+def module_dtype(module: torch.nn.Module) -> torch.dtype:
+    return next(module.parameters()).dtype
+
+
+def load_cached(model_tag: str, key: str) -> Optional[Dict]:
+    """A measurement of `model_tag` on this machine stored with `save_cached`."""
+    try:
+        cache = orjson.loads(cache_path().read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    return cache.get(machine_id(), {}).get(model_tag, {}).get(key)
+
+
+def save_cached(model_tag: str, key: str, value: Dict):
+    path = cache_path()
+    try:
+        cache = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        cache = {}
+    machine = cache.setdefault(machine_id(), {})
+    machine.setdefault(model_tag, {})[key] = value
+    path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(path, orjson.dumps(cache, option=orjson.OPT_INDENT_2))
+
+
+def load_tuning(model_tag: str, bf16: bool = True) -> Optional[Dict]:
+    """
+    The configuration tuned for `model_tag` on this machine.
+
+    Returns:
+        Optional[Dict]: The "batch_size", "threads" (None on GPUs), "pages_per_second" and
+        "peak_memory" in bytes, or None if the model was not tuned on this machine.
+    """
+    return load_cached(model_tag, precision(bf16))
+
+
+def save_tuning(model_tag: str, bf16: bool, tuning: Dict):
+    save_cached(model_tag, precision(bf16), tuning)
+
+
+def synthetic_pages(model, batch_size: int) -> torch.Tensor:
+    """Pages of plain text prepared like the rendered pages of a PDF."""
+    width, height = 612, 792
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    words = (SAMPLE_TEXT * 8).split()
+    for i, y in enumerate(range(60, height - 60, 14)):
+        start = (i * 11) % (len(words) - 14)
+        draw.text((60, y), " ".join(words[start : start + 14]), fill="black")
+    image = model.encoder.prepare_input(page, random_padding=False)
+    return torch.stack([image] * batch_size)
+
+
+def decode(model, image_tensors: torch.Tensor, steps: int) -> float:
+    """Encode the pages and decode exactly `steps` tokens. Returns the elapsed seconds."""
+    from transformers.file_utils import ModelOutput
+
+    start = time.perf_counter()
+    last_hidden_state = model.encoder(image_tensors).to(module_dtype(model.decoder))
+    model.decoder.model.generate(
+        encoder_outputs=ModelOutput(last_hidden_state=last_hidden_state, attentions=None),
+        min_length=steps,
+        max_length=steps,
+        pad_token_id=model.decoder.tokenizer.pad_token_id,
+        eos_token_id=model.decoder.tokenizer.eos_token_id,
+        use_cache=True,
+        return_dict_in_generate=True,
+        output_scores=True,
+        do_sample=False,
+    )
+    if model.device.type == "cuda":
+        torch.cuda.synchronize(model.device)
+    return time.perf_counter() - start
+
+
+def _best_time(fn, repeat: int) -> float:
+    fn()  # warm up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _generate(decoder, last_hidden_state: torch.Tensor, steps: int):
+    from transformers.file_utils import ModelOutput
+
+    decoder.model.generate(
+        encoder_outputs=ModelOutput(last_hidden_state=last_hidden_state, attentions=None),
+        min_length=steps,
+        max_length=steps,
+        pad_token_id=decoder.tokenizer.pad_token_id,
+        eos_token_id=decoder.tokenizer.eos_token_id,
+        use_cache=True,
+        do_sample=False,
+    )
+
+
+def benchmark_precision(model, steps: int = 16, repeat: int = 1) -> Dict[str, Dict]:
+    """
+    Time the encoder on a page and the decoder per token in float32 and bfloat16 on CPU.
+    The model is not modified, the other precision runs on a copy.
+
+    Returns:
+        Dict[str, Dict]: Seconds of the "encoder" and the "decoder" by precision.
+    """
+    image_tensors = synthetic_pages(model, 1)
+    timings = {"encoder": {}, "decoder": {}}
+    with torch.inference_mode():
+        last_hidden_state = model.encoder(image_tensors.to(module_dtype(model.encoder)))
+        for dtype in (torch.float32, torch.bfloat16):
+            name = precision(dtype == torch.bfloat16)
+            encoder = model.encoder
+            if module_dtype(encoder) != dtype:
+                encoder = copy.deepcopy(encoder).to(dtype)
+            timings["encoder"][name] = _best_time(
+                lambda: encoder(image_tensors.to(dtype)), repeat
+            )
+            del encoder
+            decoder = model.decoder
+            if module_dtype(decoder) != dtype:
+                decoder = copy.deepcopy(decoder).to(dtype)
+            hidden = last_hidden_state.to(dtype)
+            timings["decoder"][name] = (
+                _best_time(lambda: _generate(decoder, hidden, steps), repeat) / steps
+            )
+            del decoder
+    return timings
+
+
+def benchmark_threads(
+    model, candidates: Sequence[int], steps: int = 16, repeat: int = 1
+) -> Dict[int, float]:
+    """
+    Time the decoder per token with each number of intra-op threads.
+
+    Returns:
+        Dict[int, float]: Seconds per token by number of threads.
+    """
+    image_tensors = synthetic_pages(model, 1).to(module_dtype(model.encoder))
+    initial_threads = torch.get_num_threads()
+    timings = {}
+    try:
+        with torch.inference_mode():
+            last_hidden_state = model.encoder(image_tensors)
+            last_hidden_state = last_hidden_state.to(module_dtype(model.decoder))
+            for threads in candidates:
+                torch.set_num_threads(threads)
+                timings[threads] = (
+                    _best_time(
+                        lambda: _generate(model.decoder, last_hidden_state, steps),
+                        repeat,
+                    )
+                    / steps
+                )
+    finally:
+        torch.set_num_threads(initial_threads)
+    return timings
+
+
+def peak_memory(model) -> int:
+    """Peak memory in bytes, of the GPU since the last reset or of the process on CPU."""
+    if model.device.type == "cuda":
+        return torch.cuda.max_memory_allocated(model.device)
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def calibrate(
+    model,
+    batch_size: int,
+    steps: int = 32,
+    page_tokens: int = 1024,
+    repeat: int = 2,
+) -> Dict:
+    """
+    Measure the throughput of the model at `batch_size` with the current number of threads.
+
+    Decodes of `steps` and `2 * steps` tokens separate the cost per token from the fixed
+    cost of a batch (encoder, setup), which extrapolate to pages of `page_tokens` tokens.
+    On GPUs, the peak memory is extrapolated to the maximum length of the model in the same
+    way, because the cache and the scores grow with every token.
+
+    Returns:
+        Dict: The "batch_size", "threads", "pages_per_second" and "peak_memory" in bytes.
+    """
+    image_tensors = synthetic_pages(model, batch_size)
+    image_tensors = image_tensors.to(next(model.parameters()).dtype).to(model.device)
+    cuda = model.device.type == "cuda"
+    with torch.inference_mode():
+        decode(model, image_tensors, 2)  # warm up
+        timings = []
+        peaks = []
+        for length in (steps, 2 * steps):
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(model.device)
+            timings.append(
+                min(decode(model, image_tensors, length) for _ in range(repeat))
+            )
+            peaks.append(peak_memory(model))
+    per_token = max(timings[1] - timings[0], 0) / steps
+    fixed = max(timings[0] - per_token * steps, 0)
+    memory = peaks[1]
+    if cuda:
+        memory_per_token = max(peaks[1] - peaks[0], 0) / steps
+        memory += int(memory_per_token * (model.config.max_length - 2 * steps))
+    return {
+        "batch_size": batch_size,
+        "threads": None if cuda else torch.get_num_threads(),
+        "pages_per_second": batch_size / (fixed + per_token * page_tokens),
+        "peak_memory": memory,
+    }
+
+
+def autotune(
+    model,
+    max_batch_size: int = 64,
+    threads: Optional[List[int]] = None,
+    memory_fraction: float = 0.9,
+    **kwargs,
+) -> Dict:
+    """
+    Find the batch size and, on CPU, the number of threads with the highest throughput.
+
+    For every number of threads the batch size is doubled until the throughput improves by
+    less than 5%, the memory doesn't suffice or `max_batch_size` is reached.
+
+    Args:
+        model (NougatModel): The model on the device it runs on.
+        max_batch_size (int): Largest batch size to try.
+        threads (Optional[List[int]]): CPU only: numbers of threads to try. Defaults to the
+            powers of two up to the available cores.
+        memory_fraction (float): GPU only: fraction of the memory the extrapolated peak may use.
+        **kwargs: Passed to `calibrate`.
+
+    Returns:
+        Dict: The best result of `calibrate` and all "results".
+    """
+    cuda = model.device.type == "cuda"
+    if cuda:
+        threads = [torch.get_num_threads()]
+        memory_limit = torch.cuda.get_device_properties(model.device).total_memory
+        memory_limit *= memory_fraction
+    elif threads is None:
+        cores = len(available_cores())
+        threads = sorted({2**i for i in range(cores.bit_length())} | {cores})
+    initial_threads = torch.get_num_threads()
+    results = []
+    try:
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            best = None
+            batch_size = 1
+            while batch_size <= max_batch_size:
+                try:
+                    result = calibrate(model, batch_size, **kwargs)
+                except RuntimeError as e:
+                    if "out of memory" not in str(e):
+                        raise
+                    logging.info(f"Batch size {batch_size} ran out of memory.")
+                    break
+                finally:
+                    if cuda:
+                        torch.cuda.empty_cache()
+                logging.info(
+                    f"threads {result['threads']}, batch size {batch_size}: "
+                    f"{result['pages_per_second']:.3f} pages/s, "
+                    f"peak memory {result['peak_memory'] / 2**20:.0f} MB"
+                )
+                if cuda and result["peak_memory"] > memory_limit:
+                    break
+                results.append(result)
+                if best is not None and result["pages_per_second"] < 1.05 * best:
+                    # a plateau, larger batches only add latency and memory
+                    break
+                best = max(best or 0, result["pages_per_second"])
+                batch_size *= 2
+    finally:
+        torch.set_num_threads(initial_threads)
+    if len(results) == 0:
+        raise RuntimeError("Not even a single page fits into the memory.")
+    tuning = dict(max(results, key=lambda r: r["pages_per_second"]))
+    tuning["results"] = results
+    return tuning
+
+
+def main():
+    from nougat import NougatModel
+    from nougat.utils.device import move_to_device
+
+    parser = argparse.ArgumentParser(
+        description="Find the fastest batch size and number of threads on this machine. "
+        "`nougat` and the API use the result for the model tag automatically."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        "-c",
+        type=Path,
+        default=None,
+        help="Path to checkpoint directory.",
+    )
+    parser.add_argument(
+        "--model", "-m", type=str, default=MODEL_TAG, help="Model tag to tune."
+    )
+    parser.add_argument(
+        "--full-precision",
+        action="store_true",
+        help="Tune the model in float32 instead of bfloat16, like `nougat --full-precision`.",
+    )
+    parser.add_argument(
+        "--max-batch-size", type=int, default=64, help="Largest batch size to try."
+    )
+    parser.add_argument(
+        "--threads",
+        type=str,
+        default=None,
+        help="CPU only: comma separated numbers of threads to try. Defaults to the powers of two up to the available cores.",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=32,
+        help="Tokens per calibration decode. More are slower but more accurate.",
+    )
+    parser.add_argument(
+        "--page-tokens",
+        type=int,
+        default=1024,
+        help="Typical number of tokens per page the throughput is estimated for.",
+    )
+    parser.add_argument(
+        "--memory-fraction",
+        type=float,
+        default=0.9,
+        help="GPU only: fraction of the memory the batch may use at the maximum length.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    checkpoint = get_checkpoint(args.checkpoint, model_tag=args.model)
+    model = NougatModel.from_pretrained(checkpoint)
+    model = move_to_device(model, bf16=not args.full_precision, model_tag=args.model)
+    model.eval()
+    tuning = autotune(
+        model,
+        max_batch_size=args.max_batch_size,
+        threads=[int(t) for t in args.threads.split(",")] if args.threads else None,
+        memory_fraction=args.memory_fraction,
+        steps=args.steps,
+        page_tokens=args.page_tokens,
+    )
+    tuning["time"] = time.time()
+    save_tuning(args.model, not args.full_precision, tuning)
+    threads = f", {tuning['threads']} threads" if tuning["threads"] else ""
+    print(
+        f"{args.model} on {machine_id()}: batch size {tuning['batch_size']}{threads}, "
+        f"{tuning['pages_per_second']:.3f} pages/s. Saved to {cache_path()}."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,71 +4,320 @@ Copyright (c) Meta Platforms, Inc. and affiliates.
 This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
-from typing import Optional
+from typing import Callable, Dict, List, Optional
+import argparse
+import hashlib
+import logging
 import requests
 import os
+import re
+import threading
 import tqdm
-import io
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import orjson
 import torch
 
 BASE_URL = "https://github.com/facebookresearch/nougat/releases/download"
 MODEL_TAG = "0.1.0-small"
+PYTORCH_WEIGHTS = "pytorch_model.bin"
+SAFETENSORS_WEIGHTS = "model.safetensors"
 
 
-# source: https://stackoverflow.com/a/71459251
-def download_as_bytes_with_progress(url: str, name: str = None) -> bytes:
-    """
-    Download a file from a URL and return the contents as bytes, with progress bar.
+CHECKPOINT_FILES = [
+    "config.json",
+    PYTORCH_WEIGHTS,
+    "special_tokens_map.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+]
+CHUNK_SIZE = 32 * 2**20
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 5
 
-    Args:
-        url: The URL of the file to download.
-        name: The name of the file to save to. If None, the filename will be the same as the URL.
+
+class DownloadError(RuntimeError):
+    pass
+
+
+class RangesNotSupported(DownloadError):
+    """The server announced range requests but answered one with the whole file."""
+
+
+def base_url() -> str:
+    """The release URL, `NOUGAT_BASE_URL` for mirrors, defaults to the GitHub releases."""
+    return os.environ.get("NOUGAT_BASE_URL", BASE_URL).rstrip("/")
+
+
+def download_session(workers: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """A session with a connection pool for `workers` threads that retries failed requests."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=DOWNLOAD_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def published_checksums(session: requests.Session, model_tag: str) -> Dict[str, str]:
+    """
+    The sha256 checksums of the release files, from a `SHA256SUMS` file next to them (as
+    in `sha256sum` output) or the digests GitHub publishes for release assets.
 
     Returns:
-        bytes: The contents of the file.
-    """
-    resp = requests.get(url, stream=True, allow_redirects=True)
-    total = int(resp.headers.get("content-length", 0))
-    bio = io.BytesIO()
-    if name is None:
-        name = url
-    with tqdm.tqdm(
-        desc=name,
-        total=total,
-        unit="b",
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for chunk in resp.iter_content(chunk_size=65536):
-            bar.update(len(chunk))
-            bio.write(chunk)
-    return bio.getvalue()
-
-
-def download_checkpoint(checkpoint: Path, model_tag: str = MODEL_TAG):
+        Dict[str, str]: File name to hex digest, empty if no checksums are published.
+    """
+    try:
+        response = session.get(f"{base_url()}/{model_tag}/SHA256SUMS", timeout=30)
+        if response.ok:
+            checksums = {}
+            for line in response.text.splitlines():
+                digest, _, name = line.strip().partition(" ")
+                if name:
+                    checksums[name.strip().lstrip("*")] = digest.lower()
+            return checksums
+        match = re.match(
+            r"https://github\.com/([^/]+)/([^/]+)/releases/download$", base_url()
+        )
+        if match is None:
+            return {}
+        response = session.get(
+            f"https://api.github.com/repos/{match[1]}/{match[2]}/releases/tags/{model_tag}",
+            headers={"Accept": "application/vnd.github+json"},
+            timeout=30,
+        )
+        if not response.ok:
+            return {}
+        return {
+            asset["name"]: asset["digest"].split(":", 1)[1].lower()
+            for asset in response.json().get("assets", [])
+            if (asset.get("digest") or "").startswith("sha256:")
+        }
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Could not get the checksums of {model_tag}: {e}")
+        return {}
+
+
+class _Download:
+    """
+    A file downloaded in ranges of `CHUNK_SIZE` bytes. Every range is written to its own
+    `<name>.part<index>` file, so an interrupted download resumes where every range
+    stopped. Without range support the file is fetched in one piece.
+    """
+
+    def __init__(self, session: requests.Session, url: str, path: Path):
+        self.session = session
+        self.url = url
+        self.path = path
+        response = session.head(url, allow_redirects=True, timeout=30)
+        response.raise_for_status()
+        length = response.headers.get("content-length")
+        self.size = int(length) if length is not None else None
+        ranges = response.headers.get("accept-ranges", "").lower() == "bytes"
+        if self.size is not None and ranges:
+            self.ranges = [
+                (start, min(start + CHUNK_SIZE, self.size) - 1)
+                for start in range(0, self.size, CHUNK_SIZE)
+            ]
+        else:
+            self.ranges = [None]
+
+    def part(self, index: int) -> Path:
+        return self.path.with_name(f"{self.path.name}.part{index}")
+
+    def done(self) -> int:
+        """Number of bytes downloaded before."""
+        return sum(
+            self.part(i).stat().st_size
+            for i in range(len(self.ranges))
+            if self.part(i).exists()
+        )
+
+    def fetch(self, index: int, progress: Callable[[int], None]):
+        """Download the range `index`, or what is missing of it."""
+        part = self.part(index)
+        byte_range = self.ranges[index]
+        for _ in range(DOWNLOAD_RETRIES):
+            offset = part.stat().st_size if part.exists() else 0
+            if byte_range is None or offset > byte_range[1] - byte_range[0] + 1:
+                # start over, a download without ranges can't be resumed
+                if offset > 0:
+                    progress(-offset)
+                    part.unlink()
+                offset = 0
+            headers = {}
+            if byte_range is not None:
+                start, end = byte_range
+                if offset == end - start + 1:
+                    return
+                headers["Range"] = f"bytes={start + offset}-{end}"
+            try:
+                with self.session.get(
+                    self.url, headers=headers, stream=True, timeout=60
+                ) as response:
+                    response.raise_for_status()
+                    if byte_range is not None and response.status_code != 206:
+                        raise RangesNotSupported(f"{self.url} doesn't support ranges.")
+                    with open(part, "ab") as f:
+                        for chunk in response.iter_content(chunk_size=2**20):
+                            f.write(chunk)
+                            progress(len(chunk))
+                if byte_range is None or part.stat().st_size == end - start + 1:
+                    return
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                logging.warning(f"Retrying {self.path.name} ({e}).")
+        raise DownloadError(f"Failed to download {self.url}.")
+
+    def without_ranges(self, progress: Callable[[int], None]):
+        """Fetch the file in one piece from now on, for servers that ignore ranges."""
+        for i in range(len(self.ranges)):
+            if self.part(i).exists():
+                progress(-self.part(i).stat().st_size)
+                self.part(i).unlink()
+        self.ranges = [None]
+
+    def finish(self, sha256: Optional[str]):
+        """Join the ranges, verify the size and checksum and move the file into place."""
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        digest = hashlib.sha256()
+        with open(tmp, "wb") as f:
+            for i in range(len(self.ranges)):
+                with open(self.part(i), "rb") as part:
+                    for block in iter(lambda: part.read(2**20), b""):
+                        digest.update(block)
+                        f.write(block)
+        for i in range(len(self.ranges)):
+            self.part(i).unlink()
+        size = tmp.stat().st_size
+        if (self.size is not None and size != self.size) or (
+            sha256 is not None and digest.hexdigest() != sha256
+        ):
+            tmp.unlink()
+            raise DownloadError(
+                f"{self.path.name} is corrupted (size {size}, sha256 {digest.hexdigest()}), "
+                "download it again."
+            )
+        os.replace(tmp, self.path)
+
+
+def download_checkpoint(
+    checkpoint: Path,
+    model_tag: str = MODEL_TAG,
+    files: Optional[List[str]] = None,
+    workers: int = DOWNLOAD_WORKERS,
+):
     """
     Download the Nougat model checkpoint.
 
-    This function downloads the Nougat model checkpoint from GitHub.
+    The files are downloaded from `base_url()` in parallel ranges over a pooled session.
+    Interrupted downloads resume from the partial files. Every file is verified against
+    the published sha256 checksums, if there are any, and its size.
 
     Args:
         checkpoint (Path): The path to the checkpoint.
         model_tag (str): The model tag to download. Default is "0.1.0-small".
+        files (Optional[List[str]]): The files to download. Defaults to all.
+        workers (int): Number of parallel requests.
+
+    Raises:
+        DownloadError: If a file can't be downloaded or is corrupted.
     """
     print("downloading nougat checkpoint version", model_tag, "to path", checkpoint)
-    files = [
-        "config.json",
-        "pytorch_model.bin",
-        "special_tokens_map.json",
-        "tokenizer.json",
-        "tokenizer_config.json",
-    ]
-    for file in files:
-        download_url = f"{BASE_URL}/{model_tag}/{file}"
-        binary_file = download_as_bytes_with_progress(download_url, file)
-        if len(binary_file) > 15:  # sanity check
-            (checkpoint / file).write_bytes(binary_file)
+    files = files or CHECKPOINT_FILES
+    with download_session(workers) as session:
+        checksums = published_checksums(session, model_tag)
+        if len(checksums) == 0:
+            logging.warning(
+                f"No checksums published for {model_tag}, only the file sizes are verified."
+            )
+        downloads = [
+            _Download(session, f"{base_url()}/{model_tag}/{file}", checkpoint / file)
+            for file in files
+        ]
+        total = None
+        if all(download.size is not None for download in downloads):
+            total = sum(download.size for download in downloads)
+        lock = threading.Lock()
+        with tqdm.tqdm(
+            desc=model_tag,
+            total=total,
+            initial=sum(download.done() for download in downloads),
+            unit="b",
+            unit_scale=True,
+            unit_divisor=1024,
+        ) as bar:
+
+            def progress(n: int):
+                with lock:
+                    bar.update(n)
+
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [
+                    (download, executor.submit(download.fetch, i, progress))
+                    for download in downloads
+                    for i in range(len(download.ranges))
+                ]
+                unranged = []
+                for download, future in futures:
+                    try:
+                        future.result()
+                    except RangesNotSupported:
+                        if download not in unranged:
+                            unranged.append(download)
+                for download in unranged:
+                    logging.warning(
+                        f"{download.url} ignores ranges, downloading it in one piece."
+                    )
+                    download.without_ranges(progress)
+                    download.fetch(0, progress)
+        errors = []
+        for download in downloads:
+            try:
+                download.finish(checksums.get(download.path.name))
+            except DownloadError as e:
+                errors.append(str(e))
+        if len(errors) > 0:
+            raise DownloadError(" ".join(errors))
+
+
+def missing_files(checkpoint: Path) -> List[str]:
+    """The files of `CHECKPOINT_FILES` the checkpoint lacks, the weights can be safetensors."""
+    missing = []
+    for file in CHECKPOINT_FILES:
+        if file == PYTORCH_WEIGHTS and (checkpoint / SAFETENSORS_WEIGHTS).exists():
+            continue
+        if not (checkpoint / file).exists():
+            missing.append(file)
+    return missing
+
+
+def checkpoint_id(checkpoint: Path) -> Optional[str]:
+    """
+    Identifies the weights of a local checkpoint by a hash of the name, size and
+    modification time of its weight file, so that it changes when the weights are replaced
+    without reading the whole file. None if the checkpoint has no weight file.
+    """
+    for name in (SAFETENSORS_WEIGHTS, PYTORCH_WEIGHTS):
+        try:
+            stat = (Path(checkpoint) / name).stat()
+        except OSError:
+            continue
+        identity = f"{name}:{stat.st_size}:{stat.st_mtime_ns}"
+        return hashlib.sha256(identity.encode()).hexdigest()[:16]
+    return None
 
 
 def torch_hub(model_tag: Optional[str] = MODEL_TAG) -> Path:
@@ -86,12 +335,13 @@ def get_checkpoint(
     checkpoint_path: Optional[os.PathLike] = None,
     model_tag: str = MODEL_TAG,
     download: bool = True,
+    workers: int = DOWNLOAD_WORKERS,
 ) -> Path:
     """
     Get the path to the Nougat model checkpoint.
 
     This function retrieves the path to the Nougat model checkpoint. If the checkpoint does not
-    exist or is empty, it can optionally download the checkpoint.
+    exist or lacks files, it can optionally download them.
 
     Args:
         checkpoint_path (Optional[os.PathLike]): The path to the checkpoint. If not provided,
@@ -100,6 +350,7 @@ def get_checkpoint(
         model_tag (str): The model tag to download. Default is "0.1.0-small".
         download (bool): Whether to download the checkpoint if it doesn't exist or is empty.
             Default is True.
+        workers (int): Number of parallel requests of the download.
 
     Returns:
         Path: The path to the Nougat model checkpoint.
@@ -109,11 +360,148 @@ def get_checkpoint(
     )
     if checkpoint.exists() and checkpoint.is_file():
         checkpoint = checkpoint.parent
-    if download and (not checkpoint.exists() or len(os.listdir(checkpoint)) < 5):
+    if download and (not checkpoint.exists() or len(missing_files(checkpoint)) > 0):
         checkpoint.mkdir(parents=True, exist_ok=True)
-        download_checkpoint(checkpoint, model_tag=model_tag or MODEL_TAG)
+        download_checkpoint(
+            checkpoint,
+            model_tag=model_tag or MODEL_TAG,
+            files=missing_files(checkpoint),
+            workers=workers,
+        )
     return checkpoint
 
 
+def _import_safetensors():
+    try:
+        import safetensors.torch
+    except ImportError:
+        raise ImportError(
+            'The safetensors format needs the safetensors package. Install it with `pip install "nougat-ocr[safetensors]"`.'
+        )
+    return safetensors
+
+
+def save_safetensors(
+    state_dict: Dict[str, torch.Tensor],
+    path: os.PathLike,
+    dtype: Optional[torch.dtype] = None,
+):
+    """
+    Save a state dict in the safetensors format.
+
+    Tensors that share their memory, like tied embeddings, are stored once and the other
+    names are recorded as aliases in the metadata, so `load_safetensors` restores them.
+
+    Args:
+        state_dict (Dict[str, torch.Tensor]): The weights.
+        path (os.PathLike): The output file.
+        dtype (Optional[torch.dtype]): Convert the floating point tensors to this type.
+    """
+    safetensors = _import_safetensors()
+    tensors = {}
+    aliases = {}
+    stored = {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if key in stored:
+            aliases[name] = stored[key]
+            continue
+        stored[key] = name
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.contiguous()
+    safetensors.torch.save_file(
+        tensors,
+        str(path),
+        metadata={"format": "pt", "aliases": orjson.dumps(aliases).decode()},
+    )
+
+
+def load_safetensors(path: os.PathLike) -> Dict[str, torch.Tensor]:
+    """
+    Load a state dict saved by `save_safetensors`. The tensors are memory-mapped from the
+    file, so they are only read when they are used and processes that load the same
+    file share the page cache.
+
+    Args:
+        path (os.PathLike): The safetensors file.
+
+    Returns:
+        Dict[str, torch.Tensor]: The weights, including the aliased names.
+    """
+    safetensors = _import_safetensors()
+    state_dict = {}
+    with safetensors.safe_open(str(path), framework="pt") as f:
+        for name in f.keys():
+            state_dict[name] = f.get_tensor(name)
+        metadata = f.metadata() or {}
+    for name, target in orjson.loads(metadata.get("aliases", "{}")).items():
+        state_dict[name] = state_dict[target]
+    return state_dict
+
+
+def convert_checkpoint(checkpoint: Path, dtype: Optional[torch.dtype] = None) -> Path:
+    """
+    Convert the `pytorch_model.bin` weights of a checkpoint to `model.safetensors`, which
+    `NougatModel.from_pretrained` prefers.
+
+    Args:
+        checkpoint (Path): The checkpoint directory.
+        dtype (Optional[torch.dtype]): Store the weights in this type, e.g. `torch.bfloat16`
+            to halve the size if the model is only used in half precision.
+
+    Returns:
+        Path: The safetensors file.
+    """
+    state_dict = torch.load(checkpoint / PYTORCH_WEIGHTS, map_location="cpu")
+    path = checkpoint / SAFETENSORS_WEIGHTS
+    save_safetensors(state_dict, path, dtype=dtype)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download a Nougat checkpoint and optionally convert it to safetensors."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        "-c",
+        type=Path,
+        default=None,
+        help="Path to the checkpoint directory.",
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        type=str,
+        default=MODEL_TAG,
+        help=f"Model tag to download. Default {MODEL_TAG}.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help=f"Number of parallel download connections. Default {DOWNLOAD_WORKERS}.",
+    )
+    parser.add_argument(
+        "--safetensors",
+        action="store_true",
+        help="Convert the weights to model.safetensors for memory-mapped loading.",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "bfloat16", "float16"],
+        default=None,
+        help="Store the converted weights in this type.",
+    )
+    args = parser.parse_args()
+    checkpoint = get_checkpoint(
+        args.checkpoint, model_tag=args.model, workers=max(args.workers, 1)
+    )
+    if args.safetensors:
+        dtype = getattr(torch, args.dtype) if args.dtype else None
+        print("converted weights to", convert_checkpoint(checkpoint, dtype=dtype))
+
+
 if __name__ == "__main__":
-    get_checkpoint()
+    main()
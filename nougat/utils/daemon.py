@@ -0,0 +1,184 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import time
+import signal
+import socket
+import logging
+import tempfile
+import threading
+import socketserver
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+import orjson
+
+
+def default_socket_path() -> Path:
+    """
+    Get the path of the Unix socket the nougat daemon listens on.
+
+    The path can be overwritten with the environment variable "NOUGAT_SOCKET".
+    """
+    default = Path(tempfile.gettempdir()) / f"nougat-{os.getuid()}.sock"
+    return Path(os.environ.get("NOUGAT_SOCKET", default))
+
+
+def send_message(sock: socket.socket, message: Dict):
+    sock.sendall(orjson.dumps(message) + b"\n")
+
+
+def read_messages(sock: socket.socket) -> Iterator[Dict]:
+    """Read newline delimited JSON messages from a socket until it is closed."""
+    with sock.makefile("rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+
+def daemon_available(socket_path: Optional[Path] = None) -> bool:
+    """Check whether a nougat daemon is accepting connections on `socket_path`."""
+    socket_path = Path(socket_path or default_socket_path())
+    if not socket_path.exists():
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(socket_path))
+            send_message(sock, {"type": "ping"})
+            return any(m.get("status") == "ok" for m in read_messages(sock))
+    except OSError:
+        return False
+
+
+def submit_job(job: Dict, socket_path: Optional[Path] = None) -> Iterator[Dict]:
+    """
+    Send a conversion job to a running daemon and yield its replies.
+
+    Every finished document is reported as soon as it is written. The last message
+    has the status "done" or "error".
+    """
+    socket_path = Path(socket_path or default_socket_path())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        send_message(sock, dict(job, type="job"))
+        sock.shutdown(socket.SHUT_WR)
+        yield from read_messages(sock)
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            message = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            send_message(self.request, {"status": "error", "error": "invalid job"})
+            return
+        if message.get("type") == "ping":
+            send_message(self.request, {"status": "ok", "pid": os.getpid()})
+            return
+        try:
+            for reply in self.server.run_job(message):
+                send_message(self.request, reply)
+            send_message(self.request, {"status": "done"})
+        except BrokenPipeError:
+            logging.info("Client disconnected.")
+        except Exception as e:
+            logging.exception(e)
+            send_message(self.request, {"status": "error", "error": str(e)})
+
+
+class NougatDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server keeping a loaded model around and running conversion jobs on it.
+
+    Jobs are received over a Unix socket and optionally by watching an input directory
+    for new PDF files. Only one job runs at a time, the others wait for the model.
+
+    Args:
+        handler (Callable): Function that takes a job dictionary and yields one reply per
+            finished document.
+        socket_path (Path): Path of the Unix socket to listen on.
+        watch (Optional[Path]): Directory to watch for new PDF files.
+        watch_out (Optional[Path]): Output directory for the watched files. Defaults to `watch`.
+        poll_interval (float): Seconds between scans of the watched directory.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        handler: Callable[[Dict], Iterator[Dict]],
+        socket_path: Optional[Path] = None,
+        watch: Optional[Path] = None,
+        watch_out: Optional[Path] = None,
+        poll_interval: float = 2.0,
+    ):
+        self.socket_path = Path(socket_path or default_socket_path())
+        if daemon_available(self.socket_path):
+            raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+        if self.socket_path.exists():
+            # stale socket of a daemon that was killed
+            self.socket_path.unlink()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(self.socket_path), _JobHandler)
+        os.chmod(self.socket_path, 0o600)
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.watch = watch
+        self.watch_out = watch_out or watch
+        self.poll_interval = poll_interval
+
+    def run_job(self, job: Dict) -> Iterator[Dict]:
+        with self.lock:
+            yield from self.handler(job)
+
+    def watch_folder(self):
+        """Convert PDFs appearing in the watched directory once their size stops changing."""
+        seen = {}
+        done = set()
+        while True:
+            ready = []
+            for pdf in sorted(self.watch.glob("*.pdf")):
+                stat = pdf.stat()
+                key = (str(pdf), stat.st_size, stat.st_mtime)
+                if key in done:
+                    continue
+                if seen.get(str(pdf)) == key:
+                    ready.append(pdf)
+                    done.add(key)
+                seen[str(pdf)] = key
+            if ready:
+                logging.info(f"Found {len(ready)} new files in {self.watch}.")
+                job = {"pdf": [str(p) for p in ready], "out": str(self.watch_out)}
+                try:
+                    for reply in self.run_job(job):
+                        logging.info(f"Converted {reply.get('name')}.")
+                except Exception as e:
+                    logging.exception(e)
+            time.sleep(self.poll_interval)
+
+    def serve(self):
+        if self.watch is not None:
+            self.watch.mkdir(parents=True, exist_ok=True)
+            self.watch_out.mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self.watch_folder, daemon=True).start()
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        logging.info(f"Nougat daemon listening on {self.socket_path}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
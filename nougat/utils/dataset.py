@@ -4,13 +4,14 @@ Copyright (c) 2022-present NAVER Corp.
 MIT License
 Copyright (c) Meta Platforms, Inc. and affiliates.
 """
+
 import logging
 import os
 from math import prod
 from pathlib import Path
 from functools import partial
 import random
-from typing import Dict, Tuple, Callable
+from typing import Dict, Set, Tuple, Callable
 from PIL import Image, UnidentifiedImageError
 from typing import List, Optional
 
@@ -58,6 +59,8 @@ class ImageDataset(torch.utils.data.Dataset):
             pass
 
     def __getitem__(self, idx):
+        if self.img_list[idx] is None:
+            return
         try:
             img = Image.open(self.img_list[idx])
             return self.prepare(img)
@@ -75,51 +78,67 @@ class LazyDataset(Dataset):
     Args:
         pdf (str): Path to the PDF document.
         prepare (Callable): A preparation function to process the images.
+        pages (Optional[List[int]]): The pages to process. If None, all pages are used.
+        size (Optional[int]): Number of pages in the document, if already known.
+        rasterize (Callable): Function rendering the pages, `rasterize_paper` by default.
+        md5 (Optional[str]): The md5 of the PDF, recorded with its pages.
 
     Attributes:
         name (str): Name of the PDF document.
+        failed_pages (Set[int]): Positions of the pages that could not be rendered.
     """
 
-    def __init__(self, pdf, prepare: Callable, pages: Optional[List[int]] = None):
+    def __init__(
+        self,
+        pdf,
+        prepare: Callable,
+        pages: Optional[List[int]] = None,
+        size: Optional[int] = None,
+        rasterize: Callable = rasterize_paper,
+        md5: Optional[str] = None,
+    ):
         super().__init__()
         self.prepare = prepare
         self.name = str(pdf)
-        self.init_fn = partial(rasterize_paper, pdf, pages=pages)
+        self.md5 = md5
+        self.init_fn = partial(rasterize, pdf, pages=pages)
         self.dataset = None
-        self.size = len(pypdf.PdfReader(pdf).pages) if pages is None else len(pages)
+        self.failed_pages: Set[int] = set()
+        if pages is not None:
+            self.size = len(pages)
+        elif size is not None:
+            self.size = size
+        else:
+            self.size = len(pypdf.PdfReader(pdf).pages)
 
     def __len__(self):
         return self.size
 
     def __getitem__(self, i):
         if i == 0 or self.dataset is None:
-            self.dataset = ImageDataset(self.init_fn(), self.prepare)
+            images = self.init_fn()
+            self.failed_pages = {j for j, img in enumerate(images) if img is None}
+            self.dataset = ImageDataset(images, self.prepare)
         if i <= self.size and i >= 0:
-            return self.dataset[i], self.name if i == self.size - 1 else ""
+            image = self.dataset[i] if i < len(self.dataset) else None
+            if image is None:
+                self.failed_pages.add(i)
+            return image, self.name if i == self.size - 1 else ""
         else:
             raise IndexError
 
     @staticmethod
     def ignore_none_collate(batch):
+        """
+        Collate the pages that could be loaded. The positions of the other pages are
+        recorded in `failed_pages` of their dataset.
+        """
         if batch is None:
             return None, None
-        try:
-            _batch = []
-            for i, x in enumerate(batch):
-                image, name = x
-                if image is not None:
-                    _batch.append(x)
-                elif name:
-                    if i > 0:
-                        _batch[-1] = (_batch[-1][0], name)
-                    elif len(batch) > 1:
-                        _batch.append((batch[1][0] * 0, name))
-            if len(_batch) == 0:
-                return None, None
-            return torch.utils.data.dataloader.default_collate(_batch)
-        except AttributeError:
-            pass
-        return None, None
+        batch = [x for x in batch if x[0] is not None]
+        if len(batch) == 0:
+            return None, None
+        return torch.utils.data.dataloader.default_collate(batch)
 
 
 class SciPDFDataset(Dataset):
@@ -6,9 +6,33 @@ LICENSE file in the root directory of this source tree.
 """
 import torch
 import logging
+from typing import Dict, Optional, Set
 
+from nougat.utils.autotune import (
+    benchmark_precision,
+    benchmark_threads,
+    load_cached,
+    load_tuning,
+    precision,
+    save_cached,
+)
+from nougat.utils.replicas import available_cores
 
-def default_batch_size():
+# instruction set extensions that speed up inference on CPU
+CPU_FEATURES = ["avx512_bf16", "amx_bf16", "amx_tile", "avx512_vnni", "avx_vnni"]
+# bfloat16 matrix multiplications run natively with any of these, otherwise they are emulated
+BF16_FEATURES = {"avx512_bf16", "amx_bf16"}
+
+
+def default_batch_size(model_tag: Optional[str] = None, bf16: bool = True):
+    """
+    The batch size tuned for `model_tag` on this machine with `python -m nougat.utils.autotune`,
+    otherwise a guess from the GPU memory.
+    """
+    tuning = load_tuning(model_tag, bf16) if model_tag else None
+    if tuning is not None:
+        logging.info(f"Using the tuned batch size {tuning['batch_size']} for {model_tag}.")
+        return tuning["batch_size"]
     if torch.cuda.is_available():
         batch_size = int(
             torch.cuda.get_device_properties(0).total_memory / 1024 / 1024 / 1000 * 0.3
@@ -25,14 +49,125 @@ def default_batch_size():
     return batch_size
 
 
-def move_to_device(model, bf16: bool = True, cuda: bool = True):
+def cpu_features() -> Set[str]:
+    """The features of `CPU_FEATURES` the CPU supports. Only detected on Linux."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split()) & set(CPU_FEATURES)
+    except OSError:
+        pass
+    return set()
+
+
+def physical_cores() -> int:
+    """Number of physical cores among the available cores, without hyper-threads."""
+    available = set(available_cores())
+    cores = set()
+    processor = physical_id = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "processor":
+                    processor = int(value)
+                elif key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id" and processor in available:
+                    cores.add((physical_id, value.strip()))
+    except (OSError, ValueError):
+        pass
+    return len(cores) or len(available)
+
+
+def cpu_plan(model, bf16: bool = True, model_tag: Optional[str] = None) -> Dict:
+    """
+    Choose the precision of the encoder and the decoder and the number of threads for
+    inference on this CPU.
+
+    bfloat16 is only considered if the CPU supports it natively (AVX512-BF16 or AMX);
+    emulated bfloat16 is slower than float32. Then a short benchmark picks the faster
+    precision for each module, and for the decoder whether threads on all logical cores or
+    only on the physical cores are faster. Operators are not run in parallel, so one
+    inter-op thread suffices. The plan is cached per machine, `model_tag` and the weights
+    the model was loaded from. Without a tag or a local checkpoint there is nothing to cache
+    the plan for, then it is chosen from the CPU features alone without a benchmark.
+
+    Args:
+        model (NougatModel): The model on the CPU.
+        bf16 (bool): Whether bfloat16 may be used.
+        model_tag (Optional[str]): Cache the plan for this tag.
+
+    Returns:
+        Dict: The "encoder" and "decoder" precision, the intra-op "threads", the
+        "interop_threads" and the detected CPU "features".
+    """
+    from nougat.utils.checkpoint import checkpoint_id
+
+    weights = checkpoint_id(model.config.name_or_path or "")
+    key = f"cpu-{precision(bf16)}-{weights}" if model_tag and weights else None
+    plan = load_cached(model_tag, key) if key else None
+    if plan is not None:
+        return plan
+    features = cpu_features()
+    plan = {
+        "encoder": "float32",
+        "decoder": "float32",
+        "threads": torch.get_num_threads(),
+        "interop_threads": 1,
+        "features": sorted(features),
+    }
+    if key is None:
+        if bf16 and features & BF16_FEATURES:
+            plan["encoder"] = plan["decoder"] = "bfloat16"
+        return plan
+    if bf16 and features & BF16_FEATURES:
+        timings = benchmark_precision(model)
+        for module in ("encoder", "decoder"):
+            plan[module] = min(timings[module], key=timings[module].get)
+        plan["seconds"] = timings
+    candidates = sorted({physical_cores(), len(available_cores())})
+    if len(candidates) > 1:
+        model.decoder.to(getattr(torch, plan["decoder"]))
+        timings = benchmark_threads(model, candidates)
+        plan["threads"] = min(timings, key=timings.get)
+    save_cached(model_tag, key, plan)
+    return plan
+
+
+def move_to_device(
+    model, bf16: bool = True, cuda: bool = True, model_tag: Optional[str] = None
+):
+    """
+    Move the model to the GPU, if there is one, in bfloat16 unless `bf16` is False. On CPU
+    the precision of the encoder and decoder and the threads are chosen by `cpu_plan`,
+    the number of threads tuned for `model_tag` takes precedence.
+    """
     try:
         if torch.backends.mps.is_available():
             return model.to("mps")
     except AttributeError:
         pass
-    if bf16:
-        model = model.to(torch.bfloat16)
     if cuda and torch.cuda.is_available():
-        model = model.to("cuda")
+        if bf16:
+            model = model.to(torch.bfloat16)
+        return model.to("cuda")
+    plan = cpu_plan(model, bf16, model_tag)
+    model.encoder.to(getattr(torch, plan["encoder"]))
+    model.decoder.to(getattr(torch, plan["decoder"]))
+    tuning = load_tuning(model_tag, bf16) if model_tag else None
+    threads = tuning["threads"] if tuning and tuning["threads"] else plan["threads"]
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(plan["interop_threads"])
+    except RuntimeError:
+        # can only be set once, before any inter-op work started
+        pass
+    features = ", ".join(plan["features"]) or "none"
+    logging.info(
+        f"CPU features: {features}. Running the encoder in {plan['encoder']} and the "
+        f"decoder in {plan['decoder']}, threads: {threads}."
+    )
     return model
@@ -0,0 +1,422 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import sys
+import time
+import logging
+import argparse
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import orjson
+import torch
+import torch.nn as nn
+
+from nougat.utils.autotune import module_dtype, synthetic_pages
+from nougat.utils.checkpoint import MODEL_TAG, get_checkpoint
+from nougat.utils.workqueue import atomic_write
+
+BACKENDS = ["eager", "export"]
+EXPORT_DIR = "exported"
+ENCODER_GRAPH = "encoder.pt2"
+DECODER_GRAPH = "decoder_step.pt2"
+METADATA = "export.json"
+
+
+def _window_reverse(windows: torch.Tensor, window_size: int, H: int, W: int):
+    # timm computes the batch size with int(), which fixes it to the example's
+    B = windows.shape[0] // (H * W // window_size // window_size)
+    x = windows.view(
+        B, H // window_size, W // window_size, window_size, window_size, -1
+    )
+    return x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
+
+
+@contextmanager
+def symbolic_batch():
+    """
+    Let `torch.export` keep the batch size of the Swin encoder symbolic. The replacement
+    computes the same, so models used by other threads in the meantime are not affected.
+    """
+    import timm.models.swin_transformer as swin
+
+    window_reverse = swin.window_reverse
+    swin.window_reverse = _window_reverse
+    try:
+        yield
+    finally:
+        swin.window_reverse = window_reverse
+
+
+class DecoderStep(nn.Module):
+    """
+    One cached decoding step of the MBart decoder: the logits of the next token and the
+    updated key/value cache, given the cache of the previous tokens.
+    """
+
+    def __init__(self, decoder: nn.Module):
+        super().__init__()
+        self.model = decoder
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        encoder_hidden_states: torch.Tensor,
+        past_key_values: Tuple[Tuple[torch.Tensor, ...], ...],
+    ):
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        return output.logits, output.past_key_values
+
+
+def export_graphs(model) -> Tuple["torch.export.ExportedProgram", ...]:
+    """
+    Export the encoder and a cached decoder step of `model` with `torch.export`, in the
+    device and precision the model is in. The batch size and the number of cached tokens
+    are dynamic. The first decoder step, which fills the cross-attention cache, runs
+    eagerly once per batch.
+
+    Returns:
+        Tuple[ExportedProgram, ExportedProgram]: The encoder and the decoder step.
+    """
+    from torch.export import Dim, export
+
+    batch = Dim("batch", min=1)
+    past = Dim("past", min=1)
+    # sizes 0 and 1 are specialized, the examples have two pages and two cached tokens
+    image_tensors = synthetic_pages(model, 2).to(
+        model.device, module_dtype(model.encoder)
+    )
+    with torch.no_grad(), symbolic_batch():
+        encoder = export(model.encoder, (image_tensors,), dynamic_shapes=({0: batch},))
+        hidden = model.encoder(image_tensors).to(module_dtype(model.decoder))
+        input_ids = torch.full(
+            (2, 1), model.decoder.tokenizer.bos_token_id, device=model.device
+        )
+        mask = torch.ones(2, 3, dtype=torch.long, device=model.device)
+        past_key_values = None
+        for length in (1, 2):
+            past_key_values = model.decoder.model(
+                input_ids=input_ids,
+                attention_mask=mask[:, :length],
+                encoder_hidden_states=hidden,
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).past_key_values
+        cache = {0: batch, 2: past}
+        decoder = export(
+            DecoderStep(model.decoder.model),
+            (input_ids, mask, hidden, past_key_values),
+            dynamic_shapes=(
+                {0: batch},
+                {0: batch, 1: past + 1},
+                {0: batch},
+                tuple((cache, cache, {0: batch}, {0: batch}) for _ in past_key_values),
+            ),
+        )
+    return encoder, decoder
+
+
+def _bind(program: "torch.export.ExportedProgram", module: nn.Module) -> nn.Module:
+    """
+    The runnable graph of `program` with the parameters and buffers of `module`, which
+    it was exported from, so the weights are not held twice.
+    """
+    tensors = dict(module.named_parameters(remove_duplicate=False))
+    tensors.update(module.named_buffers(remove_duplicate=False))
+    for name, tensor in program.state_dict.items():
+        if name not in tensors or tensors[name].shape != tensor.shape:
+            raise ValueError(f"The graph doesn't match the model at {name}.")
+        program.state_dict[name] = tensors[name]
+    return program.module()
+
+
+class ExportedGraphs:
+    """
+    The exported encoder and decoder step of a model, used by `NougatModel.inference`
+    instead of the modules.
+
+    Args:
+        encoder (nn.Module): The encoder graph.
+        decoder_step (nn.Module): The graph of a cached decoder step.
+    """
+
+    def __init__(self, encoder: nn.Module, decoder_step: nn.Module):
+        self.encoder = encoder
+        self.decoder_step = decoder_step
+
+    @classmethod
+    def bind(cls, model, encoder, decoder_step) -> "ExportedGraphs":
+        """The graphs of the exported programs with the weights of `model`."""
+        return cls(
+            _bind(encoder, model.encoder),
+            _bind(decoder_step, DecoderStep(model.decoder.model)),
+        )
+
+    @contextmanager
+    def decoding(self, decoder: nn.Module):
+        """
+        Run the cached steps of `decoder.generate` with the decoder graph. Steps without
+        cache or that return attentions run eagerly.
+        """
+        from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
+
+        eager = decoder.forward
+
+        def forward(
+            input_ids=None,
+            attention_mask=None,
+            encoder_hidden_states=None,
+            past_key_values=None,
+            output_attentions=None,
+            output_hidden_states=None,
+            **kwargs,
+        ):
+            if past_key_values is None or output_attentions or output_hidden_states:
+                return eager(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    encoder_hidden_states=encoder_hidden_states,
+                    past_key_values=past_key_values,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    **kwargs,
+                )
+            logits, past_key_values = self.decoder_step(
+                input_ids, attention_mask, encoder_hidden_states, past_key_values
+            )
+            return CausalLMOutputWithCrossAttentions(
+                logits=logits, past_key_values=past_key_values
+            )
+
+        decoder.forward = forward
+        try:
+            yield
+        finally:
+            del decoder.forward
+
+
+def graph_dir(checkpoint: Path, model) -> Path:
+    """Where the graphs of `model` in its current device and precision are stored."""
+    encoder = str(module_dtype(model.encoder)).replace("torch.", "")
+    decoder = str(module_dtype(model.decoder)).replace("torch.", "")
+    return Path(checkpoint) / EXPORT_DIR / f"{model.device.type}-{encoder}-{decoder}"
+
+
+def metadata(model) -> Dict:
+    return {
+        "torch": torch.__version__,
+        "device": model.device.type,
+        "encoder_dtype": str(module_dtype(model.encoder)),
+        "decoder_dtype": str(module_dtype(model.decoder)),
+    }
+
+
+def save_graphs(path: Path, model, encoder, decoder_step, verification: Dict):
+    """Save the exported programs of `model` and how they were verified to `path`."""
+    path.mkdir(parents=True, exist_ok=True)
+    torch.export.save(encoder, str(path / ENCODER_GRAPH))
+    torch.export.save(decoder_step, str(path / DECODER_GRAPH))
+    atomic_write(
+        path / METADATA,
+        orjson.dumps(
+            dict(metadata(model), verification=verification),
+            option=orjson.OPT_INDENT_2,
+        ),
+    )
+
+
+def load_graphs(path: Path, model) -> Optional[ExportedGraphs]:
+    """
+    Load the graphs saved to `path` by `save_graphs`.
+
+    Returns:
+        Optional[ExportedGraphs]: The graphs, or None if there are none or they were
+        exported with another torch version, device or precision.
+    """
+    try:
+        saved = orjson.loads((path / METADATA).read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if any(saved.get(key) != value for key, value in metadata(model).items()):
+        logging.info(f"The graphs in {path} were exported for a different setup.")
+        return None
+    try:
+        return ExportedGraphs.bind(
+            model,
+            torch.export.load(str(path / ENCODER_GRAPH)),
+            torch.export.load(str(path / DECODER_GRAPH)),
+        )
+    except (OSError, RuntimeError, ValueError) as e:
+        logging.warning(f"Could not load the graphs in {path}: {e}")
+        return None
+
+
+def _generate(model, image_tensors: torch.Tensor, steps: int, graphs=None):
+    from transformers.file_utils import ModelOutput
+
+    encoder = model.encoder if graphs is None else graphs.encoder
+    last_hidden_state = encoder(image_tensors).to(module_dtype(model.decoder))
+    decoder = model.decoder
+    with nullcontext() if graphs is None else graphs.decoding(decoder.model):
+        return decoder.model.generate(
+            encoder_outputs=ModelOutput(
+                last_hidden_state=last_hidden_state, attentions=None
+            ),
+            min_length=steps,
+            max_length=steps,
+            pad_token_id=decoder.tokenizer.pad_token_id,
+            eos_token_id=decoder.tokenizer.eos_token_id,
+            use_cache=True,
+            bad_words_ids=[[decoder.tokenizer.unk_token_id]],
+            return_dict_in_generate=True,
+            output_scores=True,
+            do_sample=False,
+        )
+
+
+def verify(model, graphs: ExportedGraphs, batch_size: int = 2, steps: int = 32) -> Dict:
+    """
+    Decode `steps` tokens of synthetic pages with the modules and with the graphs.
+
+    Returns:
+        Dict: Whether the tokens are identical ("exact"), the largest difference of the
+        scores and the seconds of both backends.
+    """
+    image_tensors = synthetic_pages(model, batch_size).to(
+        model.device, module_dtype(model.encoder)
+    )
+    outputs, seconds = {}, {}
+    with torch.inference_mode():
+        for backend in BACKENDS:
+            backend_graphs = graphs if backend == "export" else None
+            # warm up, the first steps of either backend allocate and select kernels
+            _generate(model, image_tensors, 3, backend_graphs)
+            start = time.perf_counter()
+            outputs[backend] = _generate(model, image_tensors, steps, backend_graphs)
+            seconds[backend] = time.perf_counter() - start
+    difference = max(
+        (a.float() - b.float()).abs().nan_to_num(0).max().item()
+        for a, b in zip(outputs["eager"].scores, outputs["export"].scores)
+    )
+    return {
+        "exact": torch.equal(outputs["eager"].sequences, outputs["export"].sequences),
+        "steps": steps,
+        "max_difference": difference,
+        "seconds": seconds,
+    }
+
+
+def load_or_export(
+    checkpoint: Path, model, steps: int = 32
+) -> Optional[ExportedGraphs]:
+    """
+    The graphs of `model` stored with the checkpoint. If there are none, the model is
+    exported, verified against the modules and saved for the next time.
+
+    Returns:
+        Optional[ExportedGraphs]: The graphs, or None if they don't produce the same
+        tokens as the modules.
+    """
+    path = graph_dir(checkpoint, model)
+    graphs = load_graphs(path, model)
+    if graphs is not None:
+        return graphs
+    logging.info(f"Exporting the model graphs to {path}, this takes a while once.")
+    encoder, decoder_step = export_graphs(model)
+    graphs = ExportedGraphs.bind(model, encoder, decoder_step)
+    verification = verify(model, graphs, steps=steps)
+    if not verification["exact"]:
+        logging.warning(
+            "The exported graphs don't decode the same tokens as the model "
+            f"(score difference {verification['max_difference']:.3g}), running eagerly."
+        )
+        return None
+    try:
+        save_graphs(path, model, encoder, decoder_step, verification)
+    except OSError as e:
+        logging.warning(f"Could not save the graphs to {path}: {e}")
+    return graphs
+
+
+def main():
+    from nougat import NougatModel
+    from nougat.utils.device import move_to_device
+
+    parser = argparse.ArgumentParser(
+        description="Export the encoder and the decoder step as graphs with torch.export "
+        "and verify that they decode the same tokens. `nougat --backend export` and the "
+        "API with NOUGAT_BACKEND=export use them."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        "-c",
+        type=Path,
+        default=None,
+        help="Path to checkpoint directory.",
+    )
+    parser.add_argument(
+        "--model", "-m", type=str, default=MODEL_TAG, help="Model tag to export."
+    )
+    parser.add_argument(
+        "--full-precision",
+        action="store_true",
+        help="Export the model in float32 instead of bfloat16, like `nougat --full-precision`.",
+    )
+    parser.add_argument(
+        "--cpu",
+        action="store_true",
+        help="Export for the CPU even if a GPU is available, like `nougat --batchsize 0`.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=2,
+        help="Number of pages to verify the graphs with.",
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=64,
+        help="Number of tokens that have to be identical.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    checkpoint = get_checkpoint(args.checkpoint, model_tag=args.model)
+    model = NougatModel.from_pretrained(checkpoint)
+    model = move_to_device(
+        model, bf16=not args.full_precision, cuda=not args.cpu, model_tag=args.model
+    )
+    model.eval()
+    start = time.perf_counter()
+    encoder, decoder_step = export_graphs(model)
+    print(f"exported the graphs in {time.perf_counter() - start:.1f}s")
+    graphs = ExportedGraphs.bind(model, encoder, decoder_step)
+    verification = verify(model, graphs, batch_size=args.batch_size, steps=args.steps)
+    seconds = verification["seconds"]
+    print(
+        f"{args.steps} tokens of {args.batch_size} pages: eager {seconds['eager']:.2f}s, "
+        f"exported {seconds['export']:.2f}s, "
+        f"score difference {verification['max_difference']:.3g}"
+    )
+    if not verification["exact"]:
+        print("The graphs don't decode the same tokens as the model, not saving them.")
+        sys.exit(1)
+    path = graph_dir(checkpoint, model)
+    save_graphs(path, model, encoder, decoder_step, verification)
+    print("saved the graphs to", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import re
+import sys
+import argparse
+import subprocess
+from typing import Dict, List, NamedTuple, Tuple
+
+# modules that must not be imported by the light entry points
+HEAVY_MODULES = ["torch", "transformers", "timm", "albumentations", "cv2", "nltk"]
+
+
+class Check(NamedTuple):
+    name: str
+    code: str
+    budget: float
+
+
+CHECKS = [
+    Check(
+        "nougat --help",
+        "import sys; sys.argv[1:] = ['--help']; from predict import main; main()",
+        1.0,
+    ),
+    Check(
+        "from nougat.postprocessing import postprocess",
+        "from nougat.postprocessing import postprocess",
+        0.5,
+    ),
+]
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_times(code: str) -> Dict[str, Tuple[int, float]]:
+    """
+    Run `code` in a fresh interpreter with `-X importtime`.
+
+    Returns:
+        Dict[str, Tuple[int, float]]: The nesting level and cumulative import time in
+        seconds of every imported module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        _, cumulative, indent, module = match.groups()
+        modules[module] = ((len(indent) - 1) // 2, int(cumulative) / 1e6)
+    return modules
+
+
+def measure(check: Check, repeat: int) -> Tuple[float, List[str], List[str]]:
+    """
+    Returns:
+        Tuple[float, List[str], List[str]]: The fastest total import time in seconds, the
+        slowest top-level imports and the heavy modules that were imported.
+    """
+    best = None
+    for _ in range(repeat):
+        modules = import_times(check.code)
+        top = {m: t for m, (level, t) in modules.items() if level == 0}
+        total = sum(top.values())
+        if best is None or total < best[0]:
+            slowest = sorted(top, key=top.get, reverse=True)[:3]
+            best = (total, [f"{m} {top[m]:.3f}s" for m in slowest])
+    heavy = [m for m in HEAVY_MODULES if m in modules]
+    return best[0], best[1], heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the command line entry points against a budget."
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Measure every entry point this many times and keep the fastest run.",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply the budgets, e.g. for slow machines.",
+    )
+    args = parser.parse_args()
+    failed = False
+    for check in CHECKS:
+        total, slowest, heavy = measure(check, args.repeat)
+        budget = check.budget * args.scale
+        ok = total <= budget and len(heavy) == 0
+        failed = failed or not ok
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {check.name}: {total:.3f}s (budget {budget:.3f}s)"
+        )
+        print(f"     slowest imports: {', '.join(slowest)}")
+        if len(heavy) > 0:
+            print(f"     imports heavy modules: {', '.join(heavy)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
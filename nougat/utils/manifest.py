@@ -0,0 +1,123 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import logging
+from pathlib import Path
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+import pypdfium2
+from tqdm import tqdm
+
+logging.getLogger("pypdfium2").setLevel(logging.WARNING)
+
+
+def count_pages(pdf: str) -> Tuple[str, Optional[int], Optional[str]]:
+    """
+    Count the pages of a PDF file without parsing its content.
+
+    Args:
+        pdf (str): Path to the PDF file.
+
+    Returns:
+        Tuple[str, Optional[int], Optional[str]]: The path, the number of pages and an error
+        message if the file is broken or encrypted.
+    """
+    try:
+        doc = pypdfium2.PdfDocument(pdf)
+        try:
+            return pdf, len(doc), None
+        finally:
+            doc.close()
+    except Exception as e:
+        return pdf, None, str(e) or type(e).__name__
+
+
+class PageManifest:
+    """
+    Cache of the page counts of PDF files, keyed by path, size and modification time.
+
+    Files that changed since the last scan are counted again in parallel.
+
+    Args:
+        path (Optional[Path]): JSON file to persist the manifest in. If None, nothing is saved.
+        workers (Optional[int]): Number of processes used for counting. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, path: Optional[Path] = None, workers: Optional[int] = None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.entries: Dict[str, Dict] = {}
+        if self.path is not None and self.path.exists():
+            try:
+                self.entries = orjson.loads(self.path.read_bytes())
+            except orjson.JSONDecodeError:
+                logging.warning(f"Ignoring broken manifest {self.path}.")
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(orjson.dumps(self.entries))
+        os.replace(tmp, self.path)
+
+    def _update(self, results, total: int):
+        for key, pages, error in tqdm(results, total=total, disable=total < 100):
+            self.entries[key]["pages"] = pages
+            self.entries[key]["error"] = error
+
+    def scan(self, pdfs: List[Path]) -> Dict[Path, int]:
+        """
+        Get the number of pages of every readable PDF.
+
+        Args:
+            pdfs (List[Path]): PDF files to scan. Missing files are ignored.
+
+        Returns:
+            Dict[Path, int]: Number of pages for every PDF that could be opened, in input order.
+        """
+        stats = {}
+        todo = []
+        for pdf in pdfs:
+            try:
+                stat = pdf.stat()
+            except OSError:
+                continue
+            key = str(pdf.resolve())
+            stats[pdf] = key
+            entry = self.entries.get(key)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime_ns
+            ):
+                self.entries[key] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "pages": None,
+                    "error": None,
+                }
+                todo.append(key)
+        if len(todo) > 0:
+            logging.info(f"Counting pages of {len(todo)} files.")
+            if len(todo) == 1 or self.workers == 1:
+                self._update(map(count_pages, todo), len(todo))
+            else:
+                with Pool(min(self.workers, len(todo))) as pool:
+                    results = pool.imap_unordered(count_pages, todo, chunksize=16)
+                    self._update(results, len(todo))
+            self.save()
+        page_counts = {}
+        for pdf, key in stats.items():
+            entry = self.entries[key]
+            if entry["error"] is not None:
+                logging.info(f"Could not load file {str(pdf)}: {entry['error']}")
+                continue
+            page_counts[pdf] = entry["pages"]
+        return page_counts
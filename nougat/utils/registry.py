@@ -0,0 +1,259 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+
+from nougat import NougatModel
+from nougat.utils.checkpoint import (
+    PYTORCH_WEIGHTS,
+    SAFETENSORS_WEIGHTS,
+    get_checkpoint,
+    torch_hub,
+)
+from nougat.utils.device import default_batch_size, move_to_device
+from nougat.utils.scheduler import AdmissionController, InferenceScheduler
+
+WEIGHT_FILES = [SAFETENSORS_WEIGHTS, PYTORCH_WEIGHTS]
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    """
+    Raised when a model doesn't fit into the memory budget because the others are busy.
+
+    Args:
+        message (str): The error message.
+        retry_after (float): Estimated seconds until one of the busy models is idle.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def model_size(model: torch.nn.Module) -> int:
+    """Memory of the parameters and buffers of `model` in bytes."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ServedModel:
+    """
+    A loaded model together with its own inference scheduler and admission controller, so
+    that every model tag batches and queues its pages independently.
+
+    Args:
+        tag (str): The model tag.
+        model (NougatModel): The loaded model.
+        batch_size (int): Maximum number of pages per batch.
+        max_wait (float): Maximum estimated wait in seconds, see `AdmissionController`.
+    """
+
+    def __init__(self, tag: str, model, batch_size: int, max_wait: float):
+        self.tag = tag
+        self.model = model
+        self.size = model_size(model)
+        self.scheduler = InferenceScheduler(model, batch_size)
+        self.admission = AdmissionController(self.scheduler, max_wait=max_wait)
+        self.users = 0
+
+    def close(self):
+        self.scheduler.close()
+
+
+class ModelRegistry:
+    """
+    Serves several model tags from one process.
+
+    Models are loaded on their first request. When loading a model would exceed
+    `memory_budget`, the least recently used models without running requests are evicted
+    first. A request holds its model with `acquire` until it calls `release`, so a model is
+    never evicted while it converts pages. All models share the tokenizer if their
+    vocabularies are identical.
+
+    Models loaded with `preload` are kept in memory without a scheduler, so that a process
+    can load them once and fork workers which share the weights copy-on-write. The
+    schedulers are started by the first `acquire` in each worker.
+
+    Args:
+        checkpoints (Dict[str, Optional[os.PathLike]]): The served tags and their checkpoint
+            paths. Tags without a path are downloaded to the torch hub directory.
+        batch_size (Optional[int]): Maximum number of pages per batch of every model. None
+            uses the batch size tuned for each tag, see `default_batch_size`.
+        memory_budget (int): Maximum memory of all loaded models in bytes. 0 means unbounded.
+        max_wait (float): Maximum estimated wait of every model, see `AdmissionController`.
+        cuda (bool): Whether to move the models to the GPU.
+        backend (str): How the models run, see `NougatModel.set_backend`.
+    """
+
+    def __init__(
+        self,
+        checkpoints: Dict[str, Optional[os.PathLike]],
+        batch_size: Optional[int],
+        memory_budget: int = 0,
+        max_wait: float = 0,
+        cuda: bool = True,
+        backend: str = "eager",
+    ):
+        if len(checkpoints) == 0:
+            raise ValueError("No model tags to serve.")
+        self.checkpoints = checkpoints
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.max_wait = max_wait
+        self.cuda = cuda
+        self.backend = backend
+        # loaded models in the order of their last use
+        self.models: "OrderedDict[str, ServedModel]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.preloaded = {}
+        self.tokenizer = None
+        self.lock = threading.Lock()
+        self.loading = {tag: threading.Lock() for tag in checkpoints}
+
+    @property
+    def tags(self) -> List[str]:
+        return list(self.checkpoints)
+
+    @property
+    def default(self) -> str:
+        """The tag used by requests that don't select a model."""
+        return self.tags[0]
+
+    @property
+    def memory(self) -> int:
+        """Memory of the loaded models in bytes."""
+        return sum(served.size for served in self.models.values())
+
+    def get(self, tag: str) -> Optional[ServedModel]:
+        """The model of `tag` if it is loaded, without loading or holding it."""
+        return self.models.get(tag)
+
+    def acquire(self, tag: str = None) -> ServedModel:
+        """
+        Get the model of `tag` and hold it until `release` is called. The model is loaded
+        if necessary, which can take a while.
+
+        Args:
+            tag (str, optional): The model tag. Defaults to the first tag.
+
+        Returns:
+            ServedModel: The loaded model.
+
+        Raises:
+            ValueError: If the tag is not served.
+            MemoryBudgetExceeded: If the model doesn't fit into the memory budget.
+        """
+        tag = tag or self.default
+        if tag not in self.checkpoints:
+            raise ValueError(f"Unknown model {tag}. Choose from {self.tags}.")
+        with self.loading[tag]:
+            with self.lock:
+                served = self.models.get(tag)
+                if served is not None:
+                    self._hold(served)
+                    return served
+            checkpoint = get_checkpoint(
+                self.checkpoints[tag] or torch_hub(tag), model_tag=tag
+            )
+            with self.lock:
+                self._evict(self._estimate(tag, checkpoint))
+            model = self.preloaded.get(tag)
+            if model is None:
+                model = self._load(tag, checkpoint)
+            batch_size = max(self.batch_size or default_batch_size(tag), 1)
+            served = ServedModel(tag, model, batch_size, self.max_wait)
+            logging.info(
+                f"Loaded model {tag} ({served.size / 2**20:.0f} MB, batch size {batch_size})."
+            )
+            with self.lock:
+                self.models[tag] = served
+                self.sizes[tag] = served.size
+                self._hold(served)
+                # the estimate can be off, make room for the measured size
+                self._evict(0)
+            return served
+
+    def preload(self, tag: str = None):
+        """
+        Load the model of `tag` without starting its scheduler, before forking workers.
+        The model is never evicted from the preloaded models, workers that evict and
+        reacquire it reuse the shared weights.
+        """
+        tag = tag or self.default
+        if tag not in self.checkpoints:
+            raise ValueError(f"Unknown model {tag}. Choose from {self.tags}.")
+        checkpoint = get_checkpoint(
+            self.checkpoints[tag] or torch_hub(tag), model_tag=tag
+        )
+        self.preloaded[tag] = self._load(tag, checkpoint)
+
+    def release(self, served: ServedModel):
+        """Let go of a model held by `acquire`."""
+        with self.lock:
+            served.users -= 1
+
+    def _hold(self, served: ServedModel):
+        served.users += 1
+        self.models.move_to_end(served.tag)
+
+    def _estimate(self, tag: str, checkpoint: Path) -> int:
+        if tag in self.sizes:
+            return self.sizes[tag]
+        for name in WEIGHT_FILES:
+            if (checkpoint / name).exists():
+                return (checkpoint / name).stat().st_size
+        return 0
+
+    def _evict(self, required: int):
+        if self.memory_budget <= 0:
+            return
+        for tag, served in list(self.models.items()):
+            if self.memory + required <= self.memory_budget:
+                break
+            if served.users > 0:
+                continue
+            del self.models[tag]
+            served.close()
+            logging.info(f"Evicted model {tag}.")
+        if self.cuda and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        # a model that exceeds the budget on its own is still loaded on an idle server
+        if (
+            required > 0
+            and len(self.models) > 0
+            and self.memory + required > self.memory_budget
+        ):
+            raise MemoryBudgetExceeded(
+                "The model doesn't fit into the memory budget while the loaded models are busy.",
+                retry_after=max(
+                    1, min(m.admission.estimated_wait for m in self.models.values())
+                ),
+            )
+
+    def _load(self, tag: str, checkpoint: Path):
+        model = NougatModel.from_pretrained(checkpoint)
+        model = move_to_device(model, cuda=self.cuda, model_tag=tag)
+        model.set_backend(self.backend, checkpoint)
+        model.eval()
+        tokenizer = model.decoder.tokenizer
+        if self.tokenizer is None:
+            self.tokenizer = tokenizer
+        elif self.tokenizer.get_vocab() == tokenizer.get_vocab():
+            model.decoder.tokenizer = self.tokenizer
+        return model
+
+    def close(self):
+        with self.lock:
+            for served in self.models.values():
+                served.close()
+            self.models.clear()
@@ -0,0 +1,170 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import time
+import queue
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+
+def available_cores() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def timed_inference(model, image_tensors, early_stopping: bool = True) -> Dict:
+    """Run `model.inference` and add the elapsed time in seconds to the output."""
+    start = time.perf_counter()
+    if image_tensors is None:
+        output = {"predictions": [], "repeats": [], "repetitions": []}
+    else:
+        output = model.inference(
+            image_tensors=image_tensors, early_stopping=early_stopping
+        )
+    output["time"] = time.perf_counter() - start
+    return output
+
+
+def _replica_worker(
+    model,
+    cores: List[int],
+    inputs: mp.Queue,
+    outputs: mp.Queue,
+):
+    try:
+        os.sched_setaffinity(0, cores)
+    except (AttributeError, OSError):
+        pass
+    torch.set_num_threads(len(cores))
+    while True:
+        item = inputs.get()
+        if item is None:
+            break
+        index, image_tensors, early_stopping = item
+        with torch.inference_mode():
+            output = timed_inference(model, image_tensors, early_stopping)
+        outputs.put(
+            (
+                index,
+                {
+                    key: output[key]
+                    for key in ("predictions", "repeats", "repetitions", "time")
+                },
+            )
+        )
+
+
+class ReplicaPool:
+    """
+    Pool of CPU processes running inference with one shared copy of the model weights.
+
+    The weights are moved to shared memory before the workers are forked, so every
+    replica reads the same memory. Each replica is pinned to its own subset of cores and
+    uses as many intra-op threads as it has cores. Batches are distributed through a
+    shared queue and the results are returned in input order.
+
+    Args:
+        model (NougatModel): The model, on CPU.
+        replicas (int): Number of worker processes.
+        threads (Optional[int]): Cores per replica. Defaults to the available cores divided by `replicas`.
+    """
+
+    def __init__(
+        self,
+        model,
+        replicas: int,
+        threads: Optional[int] = None,
+    ):
+        if model.device.type != "cpu":
+            raise ValueError("Model replicas are only supported for CPU inference.")
+        cores = available_cores()
+        threads = threads or max(1, len(cores) // replicas)
+        if threads * replicas > len(cores):
+            logging.warning(
+                f"{replicas} replicas with {threads} threads each oversubscribe the {len(cores)} available cores."
+            )
+        model.share_memory()
+        ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+        self.inputs = ctx.Queue()
+        self.outputs = ctx.Queue()
+        self.max_pending = 2 * replicas
+        self.workers = []
+        for i in range(replicas):
+            replica_cores = [
+                cores[(i * threads + j) % len(cores)] for j in range(threads)
+            ]
+            worker = ctx.Process(
+                target=_replica_worker,
+                args=(model, replica_cores, self.inputs, self.outputs),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        logging.info(f"Started {replicas} model replicas with {threads} threads each.")
+
+    def imap(
+        self,
+        batches: Iterable[Tuple[Optional[torch.Tensor], Any]],
+        early_stopping: bool = True,
+    ) -> Iterator[Tuple[Any, Dict]]:
+        """
+        Run inference on batches in the replicas.
+
+        Args:
+            batches (Iterable[Tuple[Optional[torch.Tensor], Any]]): Image tensors and arbitrary
+                data that is passed through.
+            early_stopping (bool): Passed to `model.inference`.
+
+        Yields:
+            Tuple[Any, Dict]: The passed through data and the model output, in input order.
+        """
+        pending = {}
+        done = {}
+        next_index = 0
+        batches = enumerate(batches)
+        exhausted = False
+        while not exhausted or len(pending) > 0:
+            while not exhausted and len(pending) < self.max_pending:
+                try:
+                    index, (image_tensors, extra) = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[index] = extra
+                self.inputs.put((index, image_tensors, early_stopping))
+            if len(pending) == 0:
+                break
+            index, output = self._get()
+            done[index] = output
+            while next_index in done:
+                yield pending.pop(next_index), done.pop(next_index)
+                next_index += 1
+
+    def _get(self) -> Tuple[int, Dict]:
+        while True:
+            try:
+                return self.outputs.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A model replica died unexpectedly.")
+
+    def close(self):
+        for _ in self.workers:
+            self.inputs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,327 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import CancelledError, Future
+from typing import Callable, Deque, Dict, Hashable, List, Optional
+
+import torch
+
+from nougat.utils.telemetry import BATCH_FILL, PAGES, REPETITIONS, TOKENS
+
+# scheduling classes, in order of precedence
+PRIORITIES = ["interactive", "bulk"]
+
+
+class PageTask:
+    """
+    A single page waiting for inference.
+
+    Args:
+        image_tensor (torch.Tensor): The prepared page image, (num_channels, height, width).
+        on_text (Optional[Callable[[str], None]]): Called from the inference thread with the
+            text of every generated token.
+        priority (str): The scheduling class.
+        client (Hashable): The client for fair queuing.
+    """
+
+    def __init__(
+        self,
+        image_tensor: torch.Tensor,
+        on_text: Optional[Callable[[str], None]] = None,
+        priority: str = "bulk",
+        client: Hashable = None,
+    ):
+        self.image_tensor = image_tensor
+        self.on_text = on_text
+        self.priority = priority
+        self.client = client
+        self.cancelled = False
+        self.future: Future = Future()
+
+
+class InferenceScheduler:
+    """
+    Runs the model in a single background thread on batches of pages from all requests.
+
+    Pages submitted by concurrent requests are merged into batches of up to `batch_size`
+    pages. While a batch is decoded new pages queue up, so under load the batches are full.
+    The result of every page is delivered through its own future.
+
+    Every page belongs to a scheduling class from `PRIORITIES` and a client. Batches are
+    filled with interactive pages first and bulk pages take the remaining slots. Within a
+    class the clients are served round-robin, one page at a time, so a client with a large
+    backlog doesn't delay the others.
+
+    Pages can be cancelled with `cancel`. Queued pages are dropped, and pages in the batch
+    that is being decoded are ended at the next decoding step, so a batch of abandoned
+    pages finishes early.
+
+    The throughput is tracked as an exponential moving average of the seconds per page.
+
+    Args:
+        model (NougatModel): The model.
+        batch_size (int): Maximum number of pages per batch.
+        early_stopping (bool): Passed to `model.inference`.
+        seconds_per_page (float): Initial throughput estimate, until the first batch is done.
+    """
+
+    def __init__(
+        self,
+        model,
+        batch_size: int,
+        early_stopping: bool = True,
+        seconds_per_page: float = 2.0,
+    ):
+        self.model = model
+        self.batch_size = batch_size
+        self.early_stopping = early_stopping
+        self.seconds_per_page = seconds_per_page
+        self.measured = False
+        self.queues: Dict[str, "OrderedDict[Hashable, Deque[PageTask]]"] = {
+            priority: OrderedDict() for priority in PRIORITIES
+        }
+        self.size = 0
+        # the tasks of the batch that is being decoded
+        self.active: Dict[Future, PageTask] = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        image_tensor: torch.Tensor,
+        on_text: Optional[Callable[[str], None]] = None,
+        priority: str = "bulk",
+        client: Hashable = None,
+    ) -> Future:
+        """
+        Queue a prepared page for inference.
+
+        Args:
+            image_tensor (torch.Tensor): The prepared page image.
+            on_text (Optional[Callable[[str], None]]): Receives the generated text token by token.
+            priority (str): The scheduling class, one of `PRIORITIES`.
+            client (Hashable): Identifies the client for fair queuing.
+
+        Returns:
+            Future: Resolves to a dictionary with the keys "prediction", "repeats" and "repetition".
+        """
+        if priority not in self.queues:
+            raise ValueError(f"Unknown priority {priority}. Choose from {PRIORITIES}.")
+        task = PageTask(image_tensor, on_text, priority, client)
+        with self.condition:
+            self.queues[priority].setdefault(client, deque()).append(task)
+            self.size += 1
+            self.condition.notify()
+        task.future.add_done_callback(
+            lambda future: self._discard(task) if future.cancelled() else None
+        )
+        return task.future
+
+    def cancel(self, future: Future):
+        """
+        Cancel a page returned by `submit`. A queued page is dropped. A page that is being
+        decoded is ended at the next step and its future fails with `CancelledError`.
+        """
+        if future.cancel():
+            return
+        with self.condition:
+            task = self.active.get(future)
+            if task is not None:
+                task.cancelled = True
+
+    def _discard(self, task: PageTask):
+        with self.condition:
+            clients = self.queues[task.priority]
+            tasks = clients.get(task.client)
+            if tasks is None or task not in tasks:
+                # already taken for a batch
+                return
+            tasks.remove(task)
+            if len(tasks) == 0:
+                del clients[task.client]
+            self.size -= 1
+
+    @property
+    def pending(self) -> int:
+        """Number of pages waiting for a batch."""
+        return self.size
+
+    def pending_by_priority(self) -> Dict[str, int]:
+        with self.condition:
+            return {
+                priority: sum(len(tasks) for tasks in clients.values())
+                for priority, clients in self.queues.items()
+            }
+
+    def _pop(self) -> Optional[PageTask]:
+        for clients in self.queues.values():
+            if len(clients) == 0:
+                continue
+            # round-robin: take one page of the first client and move it to the back
+            client, tasks = clients.popitem(last=False)
+            task = tasks.popleft()
+            if len(tasks) > 0:
+                clients[client] = tasks
+            self.size -= 1
+            return task
+        return None
+
+    def _next_batch(self) -> Optional[List[PageTask]]:
+        with self.condition:
+            while self.size == 0 and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            batch = []
+            while self.size > 0 and len(batch) < self.batch_size:
+                task = self._pop()
+                if task.future.set_running_or_notify_cancel():
+                    batch.append(task)
+            self.active = {task.future: task for task in batch}
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if len(batch) == 0:
+                continue
+            streamer = None
+            if any(task.on_text is not None for task in batch):
+
+                def streamer(row: int, text: str, batch=batch):
+                    if batch[row].on_text is not None:
+                        batch[row].on_text(text)
+
+            start = time.perf_counter()
+            try:
+                with torch.inference_mode():
+                    output = self.model.inference(
+                        image_tensors=torch.stack([t.image_tensor for t in batch]),
+                        early_stopping=self.early_stopping,
+                        streamer=streamer,
+                        cancelled=lambda row, batch=batch: batch[row].cancelled,
+                    )
+            except Exception as e:
+                logging.exception(e)
+                with self.condition:
+                    self.active = {}
+                for task in batch:
+                    task.future.set_exception(e)
+                PAGES.inc(len(batch), status="error")
+                continue
+            self._update_throughput((time.perf_counter() - start) / len(batch))
+            with self.condition:
+                self.active = {}
+            self._record(batch, output)
+            for j, task in enumerate(batch):
+                if task.cancelled:
+                    task.future.set_exception(CancelledError())
+                    continue
+                task.future.set_result(
+                    {
+                        "prediction": output["predictions"][j],
+                        "repeats": output["repeats"][j],
+                        "repetition": output["repetitions"][j],
+                    }
+                )
+
+    def _record(self, batch: List[PageTask], output: Dict):
+        BATCH_FILL.observe(len(batch) / self.batch_size)
+        pad_token_id = self.model.decoder.tokenizer.pad_token_id
+        for j, task in enumerate(batch):
+            if task.cancelled:
+                PAGES.inc(status="cancelled")
+                continue
+            PAGES.inc(status="converted")
+            if "sequences" in output:
+                TOKENS.inc(int((output["sequences"][j] != pad_token_id).sum()))
+            repeats = output["repeats"][j]
+            if repeats is not None:
+                REPETITIONS.inc(kind="truncated" if repeats > 0 else "empty")
+
+    def _update_throughput(self, seconds_per_page: float, alpha: float = 0.2):
+        if self.measured:
+            seconds_per_page = (
+                alpha * seconds_per_page + (1 - alpha) * self.seconds_per_page
+            )
+        self.seconds_per_page = seconds_per_page
+        self.measured = True
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        queued = [
+            task
+            for clients in self.queues.values()
+            for tasks in clients.values()
+            for task in tasks
+        ]
+        for task in queued:
+            task.future.cancel()
+
+
+class AdmissionController:
+    """
+    Bounds the work accepted by the API by its estimated queueing delay.
+
+    The cost of a request is the number of pages it needs to convert. Admitted pages count
+    as outstanding until they are released, and the estimated wait is the outstanding
+    pages times the seconds per page measured by the scheduler. A request is rejected if
+    admitting it would push the estimated wait above `max_wait`, except when nothing is
+    outstanding, so that large documents are still accepted on an idle server.
+
+    Args:
+        scheduler (InferenceScheduler): The scheduler that converts the pages.
+        max_wait (float): Maximum estimated wait in seconds. 0 admits everything.
+    """
+
+    def __init__(self, scheduler: InferenceScheduler, max_wait: float):
+        self.scheduler = scheduler
+        self.max_wait = max_wait
+        self.outstanding = 0
+        self.lock = threading.Lock()
+
+    @property
+    def estimated_wait(self) -> float:
+        """Seconds until the outstanding pages are converted."""
+        return self.outstanding * self.scheduler.seconds_per_page
+
+    @property
+    def saturated(self) -> bool:
+        return self.max_wait > 0 and self.estimated_wait >= self.max_wait
+
+    def admit(self, pages: int) -> Optional[float]:
+        """
+        Reserve capacity for a request.
+
+        Args:
+            pages (int): Number of pages the request needs to convert.
+
+        Returns:
+            Optional[float]: None if the request is admitted, otherwise the seconds after which
+            it would fit into the queue.
+        """
+        with self.lock:
+            wait = (self.outstanding + pages) * self.scheduler.seconds_per_page
+            if self.max_wait > 0 and self.outstanding > 0 and wait > self.max_wait:
+                return min(wait - self.max_wait, self.estimated_wait)
+            self.outstanding += pages
+            return None
+
+    def release(self, pages: int = 1):
+        """Return the capacity of converted or abandoned pages."""
+        with self.lock:
+            self.outstanding = max(0, self.outstanding - pages)
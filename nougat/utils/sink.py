@@ -0,0 +1,283 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import os
+import re
+import time
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import orjson
+from tqdm import tqdm
+
+FORMATS = ["mmd", "jsonl", "parquet"]
+
+
+def join_pages(pages: List[str]) -> str:
+    """Concatenate the markdown of all pages of a document."""
+    out = "".join(pages).strip()
+    return re.sub(r"\n{3,}", "\n\n", out).strip()
+
+
+class PageSink:
+    """
+    Base class for writers that stream per-page records to rotating shard files.
+
+    Records are buffered and written in bulk. A shard is written under a temporary name
+    and only renamed to its final name once it is complete, so readers never see partial shards.
+
+    Args:
+        out (Path): Output directory for the shards.
+        shard_size (int): Maximum number of records per shard.
+        buffer_size (int): Number of records collected before they are written.
+        prefix (str): Prefix of the shard file names.
+    """
+
+    suffix = ""
+
+    def __init__(
+        self,
+        out: Path,
+        shard_size: int = 100000,
+        buffer_size: int = 1000,
+        prefix: str = "pages",
+    ):
+        self.out = Path(out)
+        self.out.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        self.prefix = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.buffer: List[Dict] = []
+        self.shard_index = 0
+        self.shard_records = 0
+        self.shard_path: Optional[Path] = None
+
+    def _open(self, path: Path):
+        raise NotImplementedError
+
+    def _write(self, records: List[Dict]):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+    def _rotate(self):
+        self._finish_shard()
+        self.shard_path = self.out / (
+            "%s-%05d%s" % (self.prefix, self.shard_index, self.suffix)
+        )
+        self._open(self.shard_path.with_name(self.shard_path.name + ".inprogress"))
+        self.shard_index += 1
+        self.shard_records = 0
+
+    def _finish_shard(self):
+        if self.shard_path is None:
+            return
+        self._close()
+        os.replace(
+            self.shard_path.with_name(self.shard_path.name + ".inprogress"),
+            self.shard_path,
+        )
+        self.shard_path = None
+
+    def flush(self):
+        while len(self.buffer) > 0:
+            if self.shard_path is None or self.shard_records >= self.shard_size:
+                self._rotate()
+            n = self.shard_size - self.shard_records
+            self._write(self.buffer[:n])
+            self.shard_records += len(self.buffer[:n])
+            self.buffer = self.buffer[n:]
+
+    def write(self, record: Dict):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self._finish_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONLSink(PageSink):
+    """Write page records as JSON lines."""
+
+    suffix = ".jsonl"
+
+    def _open(self, path: Path):
+        self.file = open(path, "wb", buffering=1 << 20)
+
+    def _write(self, records: List[Dict]):
+        self.file.write(b"".join(orjson.dumps(r) + b"\n" for r in records))
+
+    def _close(self):
+        self.file.close()
+
+
+class ParquetSink(PageSink):
+    """
+    Write page records to Parquet files, one row group per flushed buffer.
+
+    All shards share the same declared schema, a buffer in which a column is always
+    missing (e.g. `repeats`) doesn't change its type.
+    """
+
+    suffix = ".parquet"
+
+    def __init__(self, *args, **kwargs):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                'Parquet output requires pyarrow. Install it with `pip install "nougat-ocr[parquet]"`.'
+            )
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.schema = pyarrow.schema(
+            [
+                ("document", pyarrow.string()),
+                ("md5", pyarrow.string()),
+                ("page", pyarrow.int64()),
+                ("markdown", pyarrow.string()),
+                ("repeats", pyarrow.int64()),
+                ("truncated", pyarrow.bool_()),
+                ("render_failed", pyarrow.bool_()),
+                ("timings", pyarrow.string()),
+            ]
+        )
+        super().__init__(*args, **kwargs)
+
+    def _open(self, path: Path):
+        self.writer = self.pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def _write(self, records: List[Dict]):
+        rows = [dict(r, timings=orjson.dumps(r["timings"]).decode()) for r in records]
+        self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def _close(self):
+        self.writer.close()
+
+
+def get_sink(format: str, out: Path, **kwargs) -> Optional[PageSink]:
+    """Create the page sink for an output format. Returns None for per-document `.mmd` output."""
+    if format == "jsonl":
+        return JSONLSink(out, **kwargs)
+    elif format == "parquet":
+        return ParquetSink(out, **kwargs)
+    elif format == "mmd":
+        return None
+    raise ValueError(f"Unknown output format {format}. Choose from {FORMATS}.")
+
+
+def file_md5(path: Path) -> str:
+    """The md5 of a file, read in chunks."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def recorded_pages(out: Path) -> Dict[str, Set[int]]:
+    """
+    The pages of every document in the finished shards of `out`, by the md5 of the PDF.
+    Shards that are still in progress and records without md5 are ignored.
+    """
+    pages: Dict[str, Set[int]] = {}
+    if not Path(out).is_dir():
+        return pages
+    for shard in sorted(Path(out).iterdir()):
+        if shard.suffix == ".jsonl":
+            with shard.open("rb") as f:
+                records = [orjson.loads(line) for line in f]
+        elif shard.suffix == ".parquet":
+            import pyarrow.parquet as pq
+
+            parquet = pq.ParquetFile(shard)
+            if "md5" not in parquet.schema_arrow.names:
+                continue
+            records = parquet.read(columns=["md5", "page"]).to_pylist()
+        else:
+            continue
+        for record in records:
+            if record.get("md5") is not None:
+                pages.setdefault(record["md5"], set()).add(record["page"])
+    return pages
+
+
+def read_records(shards: List[Path]) -> Iterator[Dict]:
+    """Read page records from JSONL or Parquet shards in order."""
+    for shard in shards:
+        if shard.suffix == ".jsonl":
+            with shard.open("rb") as f:
+                for line in f:
+                    yield orjson.loads(line)
+        elif shard.suffix == ".parquet":
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(shard).iter_batches():
+                for record in batch.to_pylist():
+                    record["timings"] = orjson.loads(record["timings"])
+                    yield record
+
+
+def assemble_documents(records: Iterator[Dict]) -> Iterator[Tuple[str, str]]:
+    """
+    Group consecutive page records by document and join their markdown.
+
+    Yields:
+        Tuple[str, str]: The document name and its markdown.
+    """
+    document = None
+    pages = {}
+    for record in records:
+        if record["document"] != document:
+            if document is not None:
+                yield document, join_pages([pages[p] for p in sorted(pages)])
+            document = record["document"]
+            pages = {}
+        pages[record["page"]] = record["markdown"]
+    if document is not None:
+        yield document, join_pages([pages[p] for p in sorted(pages)])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assemble .mmd files from JSONL/Parquet page shards."
+    )
+    parser.add_argument(
+        "shards", nargs="+", type=Path, help="Shard files or directories with shards."
+    )
+    parser.add_argument(
+        "--out", "-o", type=Path, required=True, help="Output directory."
+    )
+    args = parser.parse_args()
+    shards = []
+    for path in args.shards:
+        if path.is_dir():
+            shards.extend(
+                sorted(p for p in path.iterdir() if p.suffix in (".jsonl", ".parquet"))
+            )
+        else:
+            shards.append(path)
+    args.out.mkdir(parents=True, exist_ok=True)
+    for name, out in tqdm(assemble_documents(read_records(shards))):
+        out_path = args.out / Path(name).with_suffix(".mmd").name
+        out_path.write_text(out, encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import time
+import zlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    md5 TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (md5, page, kind)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE stats SET size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+    UPDATE stats SET size = size - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE stats SET size = size - old.size;
+END;
+"""
+
+
+class ResultStore:
+    """
+    Size-bounded store for converted pages, rendered page images and thumbnails in SQLite.
+
+    Every entry is addressed by the md5 of its document, the page number and its kind, so
+    lookups go through the primary key index. Converted pages are stored per model tag,
+    page images and thumbnails are shared by all models. Payloads are compressed with zlib. The total
+    size is kept up to date by triggers, and when it exceeds `max_size` the least recently
+    used entries are evicted. The database can be shared by several processes.
+
+    Args:
+        path (Path): The database file.
+        max_size (int): Maximum size of all payloads in bytes. 0 means unbounded.
+    """
+
+    PAGE = "mmd"
+    IMAGE = "image"
+    THUMB = "thumb"
+
+    def __init__(self, path: Path, max_size: int = 0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.local = threading.local()
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """Connection of the calling thread."""
+        # connections must not be used across fork, a forked worker opens its own
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _get(self, md5: str, pages: Iterable[int], kind: str) -> Dict[int, bytes]:
+        pages = list(pages)
+        if len(pages) == 0:
+            return {}
+        placeholders = ",".join("?" * len(pages))
+        rows = self.connection.execute(
+            f"SELECT page, data FROM entries WHERE md5 = ? AND kind = ? AND page IN ({placeholders})",
+            (md5, kind, *pages),
+        ).fetchall()
+        if len(rows) > 0:
+            found = ",".join("?" * len(rows))
+            self.connection.execute(
+                f"UPDATE entries SET accessed = ? WHERE md5 = ? AND kind = ? AND page IN ({found})",
+                (time.time(), md5, kind, *(page for page, _ in rows)),
+            )
+        return {page: zlib.decompress(data) for page, data in rows}
+
+    def _put(self, md5: str, items: Dict[int, bytes], kind: str, level: int = 6):
+        if len(items) == 0:
+            return
+        now = time.time()
+        rows = []
+        for page, data in items.items():
+            data = zlib.compress(data, level)
+            rows.append((md5, page, kind, data, len(data), now))
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (md5, page, kind) DO UPDATE SET "
+                "data = excluded.data, size = excluded.size, accessed = excluded.accessed",
+                rows,
+            )
+            self._evict()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        if self.max_size <= 0 or self.size <= self.max_size:
+            return
+        # evict down to 90% so that not every insert has to evict
+        excess = self.size - int(0.9 * self.max_size)
+        victims = []
+        for rowid, size in self.connection.execute(
+            "SELECT rowid, size FROM entries ORDER BY accessed"
+        ):
+            victims.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM entries WHERE rowid = ?", victims)
+
+    @property
+    def size(self) -> int:
+        """Total size of the stored payloads in bytes."""
+        return self.connection.execute("SELECT size FROM stats").fetchone()[0]
+
+    def _page_kind(self, model: Optional[str]) -> str:
+        return self.PAGE if model is None else f"{self.PAGE}:{model}"
+
+    def get_pages(
+        self, md5: str, pages: Iterable[int], model: str = None
+    ) -> Dict[int, str]:
+        """
+        Look up the markdown of converted pages.
+
+        Args:
+            md5 (str): The md5 of the document.
+            pages (Iterable[int]): The pages to look up.
+            model (str, optional): The model tag that converted the pages.
+
+        Returns:
+            Dict[int, str]: The markdown by page for all pages that are stored.
+        """
+        return {
+            page: data.decode("utf-8")
+            for page, data in self._get(md5, pages, self._page_kind(model)).items()
+        }
+
+    def count_pages(self, md5: str, pages: Iterable[int], model: str = None) -> int:
+        """Number of `pages` whose markdown is stored, without loading it."""
+        pages = list(pages)
+        if len(pages) == 0:
+            return 0
+        placeholders = ",".join("?" * len(pages))
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM entries WHERE md5 = ? AND kind = ? AND page IN ({placeholders})",
+            (md5, self._page_kind(model), *pages),
+        ).fetchone()[0]
+
+    def put_pages(self, md5: str, pages: Dict[int, str], model: str = None):
+        self._put(
+            md5,
+            {page: mmd.encode("utf-8") for page, mmd in pages.items()},
+            self._page_kind(model),
+        )
+
+    def get_images(self, md5: str, pages: Iterable[int]) -> Dict[int, bytes]:
+        """Look up rendered page images. Returns the image file by page for all stored pages."""
+        return self._get(md5, pages, self.IMAGE)
+
+    def put_images(self, md5: str, images: Dict[int, bytes]):
+        self._put(md5, images, self.IMAGE, level=1)
+
+    def get_thumbnail(self, md5: str) -> Optional[bytes]:
+        return self._get(md5, [0], self.THUMB).get(0)
+
+    def put_thumbnail(self, md5: str, thumb: bytes):
+        self._put(md5, {0: thumb}, self.THUMB)
+
+    def delete(self, md5: str):
+        """Remove all entries of a document."""
+        self.connection.execute("DELETE FROM entries WHERE md5 = ?", (md5,))
+
+    def documents(self) -> List[str]:
+        return [
+            row[0]
+            for row in self.connection.execute("SELECT DISTINCT md5 FROM entries")
+        ]
@@ -0,0 +1,187 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import bisect
+import threading
+import time
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+REGISTRY: List["Metric"] = []
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for key, value in labels.items()
+    }
+    return "{%s}" % ",".join(f'{key}="{value}"' for key, value in escaped.items())
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics, which are collected in memory and rendered in the
+    Prometheus text exposition format.
+
+    Args:
+        name (str): Name of the metric.
+        documentation (str): Help text.
+        labelnames (Sequence[str]): Names of the labels.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            for name, labels, value in self._samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self):
+        for key, value in self.values.items():
+            yield self.name + "_total", dict(zip(self.labelnames, key)), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = state = self.values[key]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        for key, (counts, total, count) in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                bucket = dict(labels, le=_format_value(bound))
+                yield self.name + "_bucket", bucket, cumulative
+            yield self.name + "_bucket", dict(labels, le="+Inf"), count
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "nougat_stage_seconds",
+    "Time spent in each stage of the conversion.",
+    ["stage"],
+)
+PAGES = Counter("nougat_pages", "Pages by outcome.", ["status"])
+TOKENS = Counter("nougat_tokens", "Tokens in the generated page sequences.")
+REPETITIONS = Counter(
+    "nougat_repetitions",
+    "Pages with detected repetitions, truncated or without any output.",
+    ["kind"],
+)
+BATCH_FILL = Histogram(
+    "nougat_batch_fill_ratio",
+    "Pages per batch divided by the batch size.",
+    buckets=(0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1),
+)
+QUEUE_DEPTH = Gauge(
+    "nougat_queue_depth", "Pages waiting for inference.", ["model", "priority"]
+)
+ESTIMATED_WAIT = Gauge(
+    "nougat_estimated_wait_seconds",
+    "Estimated time until admitted work is done.",
+    ["model"],
+)
+SECONDS_PER_PAGE = Gauge(
+    "nougat_seconds_per_page",
+    "Moving average of the inference time per page.",
+    ["model"],
+)
+MODEL_MEMORY = Gauge(
+    "nougat_model_memory_bytes",
+    "Memory of the loaded models, 0 if not loaded.",
+    ["model"],
+)
+
+
+class StageTimer:
+    """Measures consecutive stages: every `lap` records the time since the previous one."""
+
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def lap(self, name: str):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self.last, stage=name)
+        self.last = now
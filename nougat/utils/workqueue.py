@@ -0,0 +1,223 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, Set, Union
+
+
+def atomic_write(path: Path, data: Union[str, bytes]):
+    """Write a file so that readers only ever see the complete content."""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    if isinstance(data, str):
+        tmp.write_text(data, encoding="utf-8")
+    else:
+        tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class WorkQueue:
+    """
+    Work queue coordinated through a shared directory, without a broker.
+
+    A worker owns a unit of work while it holds its lease file, which is created atomically
+    with `O_EXCL`. Leases are renewed by a heartbeat thread that touches the files. A lease
+    that was not renewed for `lease_timeout` seconds belongs to a dead worker and can be
+    reclaimed by anybody. Finished units get a marker in the `done` directory.
+
+    Failed attempts are counted in a marker in the `failed` directory. A failed unit is only
+    claimed again after `retry_delay` seconds, doubled with every attempt, and is given up
+    after `max_attempts` attempts.
+
+    Args:
+        root (Path): Shared directory, e.g. on NFS.
+        lease_timeout (float): Seconds after which a lease is considered stale.
+        heartbeat_interval (Optional[float]): Seconds between lease renewals. Defaults to a
+            tenth of `lease_timeout`.
+        max_attempts (int): Number of failed attempts after which a unit is given up.
+        retry_delay (float): Seconds before a failed unit is retried the first time.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        lease_timeout: float = 600,
+        heartbeat_interval: Optional[float] = None,
+        max_attempts: int = 3,
+        retry_delay: float = 30,
+    ):
+        self.root = Path(root)
+        self.leases = self.root / "leases"
+        self.done = self.root / "done"
+        self.failed = self.root / "failed"
+        self.leases.mkdir(parents=True, exist_ok=True)
+        self.done.mkdir(parents=True, exist_ok=True)
+        self.failed.mkdir(parents=True, exist_ok=True)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.heartbeat_interval = heartbeat_interval or lease_timeout / 10
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held: Set[str] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def _lease_path(self, key: str) -> Path:
+        return self.leases / f"{key}.lease"
+
+    def _owns(self, key: str) -> bool:
+        try:
+            return self._lease_path(key).read_text() == self.worker_id
+        except OSError:
+            return False
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                for key in list(self.held):
+                    if self._owns(key):
+                        os.utime(self._lease_path(key))
+                    else:
+                        logging.warning(f"Lost lease for {key} to another worker.")
+                        self.held.discard(key)
+
+    def is_done(self, key: str) -> bool:
+        return (self.done / key).exists()
+
+    def attempts(self, key: str) -> int:
+        """Number of failed attempts at `key`."""
+        try:
+            return int((self.failed / key).read_text())
+        except (OSError, ValueError):
+            return 0
+
+    def is_failed(self, key: str) -> bool:
+        """Whether `key` failed too often and is given up."""
+        return self.attempts(key) >= self.max_attempts
+
+    def _backing_off(self, key: str) -> bool:
+        attempts = self.attempts(key)
+        if attempts == 0:
+            return False
+        try:
+            failed_at = (self.failed / key).stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - failed_at < self.retry_delay * 2 ** (attempts - 1)
+
+    def is_leased(self, key: str) -> bool:
+        """Whether somebody holds a lease on `key` that is not stale."""
+        try:
+            age = time.time() - self._lease_path(key).stat().st_mtime
+        except FileNotFoundError:
+            return False
+        return age < self.lease_timeout
+
+    def claim(self, key: str) -> bool:
+        """
+        Try to take the lease for a unit of work.
+
+        Returns:
+            bool: True if this worker now owns the unit.
+        """
+        if self.is_done(key) or self.is_failed(key) or self._backing_off(key):
+            return False
+        lease = self._lease_path(key)
+        for _ in range(2):
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._reclaim(key):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.worker_id)
+            if self.is_done(key):
+                # finished by the previous owner just before its lease expired
+                lease.unlink()
+                return False
+            with self.lock:
+                self.held.add(key)
+            return True
+        return False
+
+    def _reclaim(self, key: str) -> bool:
+        """
+        Remove the lease of `key` if it is stale. Returns False if somebody holds it.
+
+        Only one worker can rename the stale lease away, everybody else fails and retries
+        the exclusive create. Between the check and the rename another worker may have
+        reclaimed the lease and created a fresh one, so the moved file is checked again and
+        put back if it is not the stale lease.
+        """
+        lease = self._lease_path(key)
+        try:
+            checked = lease.stat()
+            owner = lease.read_text()
+        except FileNotFoundError:
+            return True
+        if time.time() - checked.st_mtime < self.lease_timeout:
+            return False
+        stale = lease.with_name(f"{lease.name}.{self.worker_id}.stale")
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return True
+        moved = stale.stat()
+        if (
+            moved.st_ino != checked.st_ino
+            or stale.read_text() != owner
+            or time.time() - moved.st_mtime < self.lease_timeout
+        ):
+            try:
+                # never replaces a lease that was created in the meantime
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            stale.unlink()
+            return False
+        stale.unlink()
+        logging.info(f"Reclaimed stale lease for {key}.")
+        return True
+
+    def release(self, key: str):
+        """Give up the lease without marking the unit as done."""
+        with self.lock:
+            self.held.discard(key)
+            if self._owns(key):
+                self._lease_path(key).unlink()
+
+    def fail(self, key: str):
+        """Record a failed attempt and release the lease, so the unit is retried later."""
+        attempts = self.attempts(key) + 1
+        # only the lease holder writes the marker, the count can't be lost to another worker
+        atomic_write(self.failed / key, str(attempts))
+        if attempts >= self.max_attempts:
+            logging.error(f"Giving up {key} after {attempts} failed attempts.")
+        self.release(key)
+
+    def complete(self, key: str):
+        """Mark a unit as done and release its lease. Call after the output is written."""
+        atomic_write(self.done / key, self.worker_id)
+        self.release(key)
+
+    def close(self):
+        self.stopped.set()
+        for key in list(self.held):
+            self.release(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
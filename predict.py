@@ -11,16 +11,38 @@ import re
 import argparse
 import re
 import os
+import time
+import hashlib
+from contextlib import ExitStack, contextmanager
 from functools import partial
-import torch
-from torch.utils.data import ConcatDataset
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
 from tqdm import tqdm
-from nougat import NougatModel
-from nougat.utils.dataset import LazyDataset
-from nougat.utils.device import move_to_device, default_batch_size
-from nougat.utils.checkpoint import get_checkpoint
+import orjson
+from nougat.dataset.rasterize import rasterize_paper, rasterize_paper_supervised
+from nougat.utils.manifest import PageManifest
+from nougat.utils.sink import (
+    FORMATS,
+    PageSink,
+    file_md5,
+    get_sink,
+    join_pages,
+    recorded_pages,
+)
+from nougat.utils.workqueue import WorkQueue, atomic_write
+from nougat.utils.daemon import (
+    NougatDaemon,
+    daemon_available,
+    default_socket_path,
+    submit_job,
+)
 from nougat.postprocessing import markdown_compatible
-import pypdf
+
+# torch and the model are imported when they are needed, so that `--help` and jobs
+# handed to a daemon start quickly
+if TYPE_CHECKING:
+    from nougat import NougatModel
+    from nougat.utils.dataset import LazyDataset
+    from nougat.utils.replicas import ReplicaPool
 
 logging.basicConfig(level=logging.INFO)
 
@@ -31,8 +53,8 @@ def get_args():
         "--batchsize",
         "-b",
         type=int,
-        default=default_batch_size(),
-        help="Batch size to use.",
+        default=None,
+        help="Batch size to use. Defaults to the size tuned with `python -m nougat.utils.autotune` or a size that fits the GPU memory, 0 runs on CPU.",
     )
     parser.add_argument(
         "--checkpoint",
@@ -57,7 +79,13 @@ def get_args():
     parser.add_argument(
         "--full-precision",
         action="store_true",
-        help="Use float32 instead of bfloat16. Can speed up CPU conversion for some setups.",
+        help="Use float32 instead of bfloat16. On CPU, bfloat16 is only used for the modules it speeds up.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["eager", "export"],
+        default="eager",
+        help="Run the model modules eagerly or as graphs exported with `python -m nougat.utils.export` (exported and verified on first use).",
     )
     parser.add_argument(
         "--no-markdown",
@@ -82,12 +110,114 @@ def get_args():
         type=str,
         help="Provide page numbers like '1-4,7' for pages 1 through 4 and page 7. Only works for single PDF input.",
     )
-    parser.add_argument("pdf", nargs="+", type=Path, help="PDF(s) to process.")
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="mmd",
+        help="Output format. 'jsonl' and 'parquet' write per-page records to rotating shards in the output directory.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=100000,
+        help="Maximum number of pages per shard for 'jsonl' and 'parquet' output.",
+    )
+    parser.add_argument(
+        "--page-timeout",
+        type=float,
+        default=120,
+        help="Maximum seconds to render a single page before it is skipped. 0 renders pages without supervision.",
+    )
+    parser.add_argument(
+        "--page-max-memory",
+        type=int,
+        default=4096,
+        help="Maximum memory in MB to render a single page before it is skipped.",
+    )
+    parser.add_argument(
+        "--raster-workers",
+        type=int,
+        default=1,
+        help="Number of processes rendering pages.",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="CPU only: number of processes running the model on a shared copy of the weights.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="CPU only: threads (and pinned cores) per replica. Defaults to the tuned number of threads for a single replica, otherwise the available cores divided by --replicas.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="File to cache page counts of the input PDFs in. Defaults to '.nougat_manifest.json' in the output directory.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes used to count the pages of the input PDFs.",
+    )
+    parser.add_argument(
+        "--queue",
+        type=Path,
+        default=None,
+        help="Shared directory coordinating several workers converting the same inputs. Each PDF is processed by exactly one worker.",
+    )
+    parser.add_argument(
+        "--queue-chunk",
+        type=int,
+        default=None,
+        help="Split documents into units of this many pages for --queue. Default is one unit per document.",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=600,
+        help="Seconds without heartbeat after which the work of a --queue worker is reclaimed by others.",
+    )
+    parser.add_argument(
+        "--queue-attempts",
+        type=int,
+        default=3,
+        help="Number of failed attempts after which a --queue unit is given up.",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep the model loaded and serve conversion jobs from other `nougat` calls.",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=default_socket_path(),
+        help="Unix socket of the daemon. Can also be set with NOUGAT_SOCKET.",
+    )
+    parser.add_argument(
+        "--watch",
+        type=Path,
+        default=None,
+        help="Daemon only: convert PDFs placed in this directory. Output goes to --out or the directory itself.",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="use_daemon",
+        action="store_false",
+        help="Don't send the job to a running daemon, always load the model in this process.",
+    )
+    parser.add_argument("pdf", nargs="*", type=Path, help="PDF(s) to process.")
     args = parser.parse_args()
-    if args.checkpoint is None or not args.checkpoint.exists():
-        args.checkpoint = get_checkpoint(args.checkpoint, model_tag=args.model)
+    if not args.daemon and len(args.pdf) == 0:
+        parser.error("the following arguments are required: pdf")
     if args.out is None:
-        logging.warning("No output directory. Output will be printed to console.")
+        if not args.daemon:
+            logging.warning("No output directory. Output will be printed to console.")
     else:
         if not args.out.exists():
             logging.info("Output directory does not exist. Creating output directory.")
@@ -95,6 +225,12 @@ def get_args():
         if not args.out.is_dir():
             logging.error("Output has to be directory.")
             sys.exit(1)
+    if args.format != "mmd" and args.out is None:
+        logging.error(f"Output format {args.format} requires an output directory.")
+        sys.exit(1)
+    if args.queue is not None and (args.out is None or args.format != "mmd"):
+        logging.error("--queue requires an output directory and the 'mmd' format.")
+        sys.exit(1)
     if len(args.pdf) == 1 and not args.pdf[0].suffix == ".pdf":
         # input is a list of pdfs
         try:
@@ -109,28 +245,87 @@ def get_args():
         except:
             pass
     if args.pages and len(args.pdf) == 1:
-        pages = []
-        for p in args.pages.split(","):
-            if "-" in p:
-                start, end = p.split("-")
-                pages.extend(range(int(start) - 1, int(end)))
-            else:
-                pages.append(int(p) - 1)
-        args.pages = pages
+        args.pages = parse_pages(args.pages)
     else:
         args.pages = None
     return args
 
 
-def main():
-    args = get_args()
+def parse_pages(pages: str) -> List[int]:
+    """Convert a page selection like '1-4,7' to a list of zero-based page indices."""
+    indices = []
+    for p in pages.split(","):
+        if "-" in p:
+            start, end = p.split("-")
+            indices.extend(range(int(start) - 1, int(end)))
+        else:
+            indices.append(int(p) - 1)
+    return indices
+
+
+def load_model(args) -> "NougatModel":
+    from nougat import NougatModel
+    from nougat.utils.checkpoint import get_checkpoint
+    from nougat.utils.autotune import load_tuning
+    from nougat.utils.device import default_batch_size, move_to_device
+
+    if args.batchsize is None:
+        args.batchsize = default_batch_size(args.model, bf16=not args.full_precision)
+    if args.threads is None and args.replicas <= 1:
+        tuning = load_tuning(args.model, bf16=not args.full_precision)
+        if tuning is not None and tuning["threads"]:
+            args.threads = tuning["threads"]
+    if args.checkpoint is None or not args.checkpoint.exists():
+        args.checkpoint = get_checkpoint(args.checkpoint, model_tag=args.model)
     model = NougatModel.from_pretrained(args.checkpoint)
-    model = move_to_device(model, bf16=not args.full_precision, cuda=args.batchsize > 0)
+    model = move_to_device(
+        model,
+        bf16=not args.full_precision,
+        cuda=args.batchsize > 0,
+        model_tag=args.model,
+    )
+    model.set_backend(args.backend, args.checkpoint)
     if args.batchsize <= 0:
         # set batch size to 1. Need to check if there are benefits for CPU conversion for >1
         args.batchsize = 1
     model.eval()
-    datasets = []
+    return model
+
+
+def get_rasterizer(args) -> Callable:
+    if args.page_timeout <= 0:
+        return rasterize_paper
+    return partial(
+        rasterize_paper_supervised,
+        timeout=args.page_timeout,
+        max_memory=args.page_max_memory * 1024 * 1024 if args.page_max_memory else None,
+        processes=args.raster_workers,
+    )
+
+
+@contextmanager
+def start_replicas(model: "NougatModel", args) -> Iterator[Optional["ReplicaPool"]]:
+    """Run the model replicas for `--replicas`, or yield None to run a single model."""
+    import torch
+    from nougat.utils.replicas import ReplicaPool
+
+    if args.replicas <= 1:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        yield None
+        return
+    if model.device.type != "cpu":
+        logging.warning("Model replicas are only supported on CPU. Running a single model.")
+        yield None
+        return
+    with ReplicaPool(model, args.replicas, args.threads) as pool:
+        yield pool
+
+
+def build_datasets(model: "NougatModel", args) -> List["LazyDataset"]:
+    from nougat.utils.dataset import LazyDataset
+
+    pdfs = []
     for pdf in args.pdf:
         if not pdf.exists():
             continue
@@ -141,18 +336,62 @@ def main():
                     f"Skipping {pdf.name}, already computed. Run with --recompute to convert again."
                 )
                 continue
-        try:
-            dataset = LazyDataset(
-                pdf,
-                partial(model.encoder.prepare_input, random_padding=False),
-                args.pages,
+        pdfs.append(pdf)
+    if args.pages is None:
+        manifest_path = args.manifest
+        if manifest_path is None and args.out:
+            manifest_path = args.out / ".nougat_manifest.json"
+        page_counts = PageManifest(manifest_path, args.workers).scan(pdfs)
+    # documents are identified by their md5 in the shards of the page sinks
+    sink = args.out is not None and args.format != "mmd"
+    recorded = recorded_pages(args.out) if sink and not args.recompute else {}
+    datasets = []
+    for pdf in pdfs:
+        if args.pages is None and not page_counts.get(pdf):
+            continue
+        md5 = file_md5(pdf) if sink else None
+        pages = (
+            [page + 1 for page in args.pages]
+            if args.pages is not None
+            else range(1, page_counts[pdf] + 1)
+        )
+        if md5 in recorded and recorded[md5].issuperset(pages):
+            logging.info(
+                f"Skipping {pdf.name}, already in the shards. Run with --recompute to convert again."
             )
-        except pypdf.errors.PdfStreamError:
-            logging.info(f"Could not load file {str(pdf)}.")
             continue
+        dataset = LazyDataset(
+            pdf,
+            partial(model.encoder.prepare_input, random_padding=False),
+            args.pages,
+            size=page_counts[pdf] if args.pages is None else None,
+            rasterize=get_rasterizer(args),
+            md5=md5,
+        )
         datasets.append(dataset)
-    if len(datasets) == 0:
-        return
+    return datasets
+
+
+def predict_pages(
+    model: "NougatModel",
+    datasets: List["LazyDataset"],
+    args,
+    pool: Optional["ReplicaPool"] = None,
+) -> Iterator[Tuple[Dict, bool]]:
+    """
+    Run the model on all pages of the datasets.
+
+    Args:
+        pool (Optional[ReplicaPool]): Run the inference in these model replicas instead.
+
+    Yields:
+        Tuple[Dict, bool]: A record for every page and whether it is the last page of its document.
+    """
+    import torch
+    from torch.utils.data import ConcatDataset
+    from nougat.utils.dataset import LazyDataset
+    from nougat.utils.replicas import timed_inference
+
     dataloader = torch.utils.data.DataLoader(
         ConcatDataset(datasets),
         batch_size=args.batchsize,
@@ -160,51 +399,358 @@ def main():
         collate_fn=LazyDataset.ignore_none_collate,
     )
 
-    predictions = []
+    if pool is None:
+        results = (
+            (None, timed_inference(model, sample, args.skipping))
+            for sample, _ in dataloader
+        )
+    else:
+        results = pool.imap(dataloader, args.skipping)
+
     file_index = 0
     page_num = 0
-    for i, (sample, is_last_page) in enumerate(tqdm(dataloader)):
-        model_output = model.inference(
-            image_tensors=sample, early_stopping=args.skipping
-        )
-        # check if model output is faulty
-        for j, output in enumerate(model_output["predictions"]):
+
+    def page_record(output: str, repeats: Optional[int] = None, **timings) -> Dict:
+        return {
+            "document": datasets[file_index].name,
+            "md5": datasets[file_index].md5,
+            "page": args.pages[page_num - 1] + 1 if args.pages else page_num,
+            "markdown": output,
+            "repeats": repeats,
+            "truncated": repeats is not None and repeats > 0,
+            "render_failed": False,
+            "timings": timings,
+        }
+
+    def next_page() -> Iterator[Tuple[Dict, bool]]:
+        # Skip over pages that never reached the model because they could not be loaded
+        # and over finished documents. Afterwards `page_num` points to the next page to
+        # be predicted.
+        nonlocal file_index, page_num
+        while file_index < len(datasets):
+            dataset = datasets[file_index]
             if page_num == 0:
                 logging.info(
-                    "Processing file %s with %i pages"
-                    % (datasets[file_index].name, datasets[file_index].size)
+                    "Processing file %s with %i pages" % (dataset.name, dataset.size)
                 )
+            if page_num >= dataset.size:
+                file_index += 1
+                page_num = 0
+            elif page_num in dataset.failed_pages:
+                page_num += 1
+                page = args.pages[page_num - 1] + 1 if args.pages else page_num
+                logging.warning(f"Skipping page {page} because it could not be loaded.")
+                record = page_record(f"\n\n[MISSING_PAGE_FAIL:{page}]\n\n")
+                record["render_failed"] = True
+                yield record, page_num == dataset.size
+            else:
+                return
+
+    for i, (_, model_output) in enumerate(tqdm(results, total=len(dataloader))):
+        if len(model_output["predictions"]) > 0:
+            inference_time = model_output["time"] / len(model_output["predictions"])
+        # check if model output is faulty
+        for j, output in enumerate(model_output["predictions"]):
+            yield from next_page()
             page_num += 1
+            page = args.pages[page_num - 1] + 1 if args.pages else page_num
+            start = time.perf_counter()
             if output.strip() == "[MISSING_PAGE_POST]":
                 # uncaught repetitions -- most likely empty page
-                predictions.append(f"\n\n[MISSING_PAGE_EMPTY:{page_num}]\n\n")
+                output = f"\n\n[MISSING_PAGE_EMPTY:{page}]\n\n"
             elif args.skipping and model_output["repeats"][j] is not None:
                 if model_output["repeats"][j] > 0:
                     # If we end up here, it means the output is most likely not complete and was truncated.
-                    logging.warning(f"Skipping page {page_num} due to repetitions.")
-                    predictions.append(f"\n\n[MISSING_PAGE_FAIL:{page_num}]\n\n")
+                    logging.warning(f"Skipping page {page} due to repetitions.")
+                    output = f"\n\n[MISSING_PAGE_FAIL:{page}]\n\n"
                 else:
                     # If we end up here, it means the document page is too different from the training domain.
                     # This can happen e.g. for cover pages.
-                    predictions.append(
-                        f"\n\n[MISSING_PAGE_EMPTY:{i*args.batchsize+j+1}]\n\n"
+                    output = f"\n\n[MISSING_PAGE_EMPTY:{i*args.batchsize+j+1}]\n\n"
+            elif args.markdown:
+                output = markdown_compatible(output)
+            record = page_record(
+                output,
+                model_output["repeats"][j],
+                inference=inference_time,
+                postprocess=time.perf_counter() - start,
+            )
+            yield record, page_num == datasets[file_index].size
+    # trailing pages that could not be loaded
+    yield from next_page()
+
+
+def predict(
+    model: "NougatModel",
+    datasets: List["LazyDataset"],
+    args,
+    sink: Optional[PageSink] = None,
+    pool: Optional["ReplicaPool"] = None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Run the model on all pages of the datasets and join the pages of every document.
+
+    Args:
+        sink (Optional[PageSink]): Writer that receives every page record.
+        pool (Optional[ReplicaPool]): Run the inference in these model replicas instead.
+
+    Yields:
+        Tuple[str, str]: Name of the PDF and the markdown text, as soon as the last page
+        of a document has been processed.
+    """
+    predictions = []
+    for record, is_last_page in predict_pages(model, datasets, args, pool):
+        if sink is not None:
+            sink.write(record)
+        predictions.append(record["markdown"])
+        if is_last_page:
+            yield record["document"], join_pages(predictions)
+            predictions = []
+
+
+def write_prediction(name: str, out: str, out_dir: Optional[Path]) -> Optional[Path]:
+    if out_dir:
+        out_path = out_dir / Path(name).with_suffix(".mmd").name
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_text(out, encoding="utf-8")
+        return out_path
+    else:
+        print(out, "\n\n")
+
+
+def queue_units(args) -> List[Tuple[str, Path, Optional[List[int]], int]]:
+    """
+    Split the input PDFs into units of work for the shared work queue.
+
+    Returns:
+        List[Tuple[str, Path, Optional[List[int]], int]]: Key, PDF, page indices (None for the
+        whole document) and the number of pages in the document for every unit.
+    """
+    page_counts = PageManifest(args.queue / "manifest.json", args.workers).scan(args.pdf)
+    units = []
+    for pdf, size in page_counts.items():
+        if not size:
+            continue
+        digest = hashlib.sha1(str(pdf.resolve()).encode()).hexdigest()[:12]
+        key = f"{pdf.stem[:64]}-{digest}"
+        if args.queue_chunk is None:
+            units.append((key, pdf, None, size))
+            continue
+        for start in range(0, size, args.queue_chunk):
+            pages = list(range(start, min(start + args.queue_chunk, size)))
+            units.append((f"{key}.p{start + 1:05d}", pdf, pages, size))
+    return units
+
+
+def assemble_parts(
+    work_queue: WorkQueue, pdf: Path, keys: List[str], out_dir: Path
+) -> bool:
+    """Write the document once all of its page ranges are done. Returns True if it was written."""
+    if not all(work_queue.is_done(key) for key in keys):
+        return False
+    pages = []
+    for key in keys:
+        pages.extend(orjson.loads((work_queue.root / "parts" / f"{key}.json").read_bytes()))
+    atomic_write(out_dir / pdf.with_suffix(".mmd").name, join_pages(pages))
+    return True
+
+
+def run_queue(model: "NougatModel", args, pool: Optional["ReplicaPool"] = None):
+    """
+    Process the input PDFs together with other workers sharing the queue directory.
+
+    Every unit of work is claimed with a lease before it is processed, so each document or
+    page range is converted once, no matter how many workers join or leave. Outputs are
+    written atomically, so a unit that is processed twice after a lost lease is harmless.
+    A unit that fails is retried with a backoff and skipped after `--queue-attempts` attempts.
+    """
+    from nougat.utils.dataset import LazyDataset
+
+    units = queue_units(args)
+    documents = {}
+    for key, pdf, pages, _ in units:
+        documents.setdefault(pdf, []).append(key)
+    (args.queue / "parts").mkdir(parents=True, exist_ok=True)
+    with WorkQueue(
+        args.queue, lease_timeout=args.lease_timeout, max_attempts=args.queue_attempts
+    ) as work_queue:
+        remaining = units
+        while len(remaining) > 0:
+            claimed = False
+            for key, pdf, pages, size in remaining:
+                if not work_queue.claim(key):
+                    continue
+                claimed = True
+                try:
+                    unit_args = argparse.Namespace(**vars(args))
+                    unit_args.pages = pages
+                    dataset = LazyDataset(
+                        pdf,
+                        partial(model.encoder.prepare_input, random_padding=False),
+                        pages,
+                        size=size,
+                        rasterize=get_rasterizer(args),
                     )
-            else:
-                if args.markdown:
-                    output = markdown_compatible(output)
-                predictions.append(output)
-            if is_last_page[j]:
-                out = "".join(predictions).strip()
-                out = re.sub(r"\n{3,}", "\n\n", out).strip()
-                if args.out:
-                    out_path = args.out / Path(is_last_page[j]).with_suffix(".mmd").name
-                    out_path.parent.mkdir(parents=True, exist_ok=True)
-                    out_path.write_text(out, encoding="utf-8")
+                    markdown = [
+                        record["markdown"]
+                        for record, _ in predict_pages(model, [dataset], unit_args, pool)
+                    ]
+                    if pages is None:
+                        out_path = args.out / pdf.with_suffix(".mmd").name
+                        atomic_write(out_path, join_pages(markdown))
+                    else:
+                        part = args.queue / "parts" / f"{key}.json"
+                        atomic_write(part, orjson.dumps(markdown))
+                    work_queue.complete(key)
+                except Exception as e:
+                    logging.exception(e)
+                    work_queue.fail(key)
+                    continue
+                if pages is not None:
+                    assemble_parts(work_queue, pdf, documents[pdf], args.out)
+            remaining = [
+                unit
+                for unit in remaining
+                if not work_queue.is_done(unit[0]) and not work_queue.is_failed(unit[0])
+            ]
+            if len(remaining) > 0 and not claimed:
+                # the rest is leased by other workers or waits for a retry, wait for them,
+                # for their leases to expire or for the backoff to pass
+                time.sleep(min(work_queue.heartbeat_interval, work_queue.retry_delay))
+        for pdf, keys in documents.items():
+            out_path = args.out / pdf.with_suffix(".mmd").name
+            if args.queue_chunk is not None and not out_path.exists():
+                assemble_parts(work_queue, pdf, keys, args.out)
+
+
+def run_client(args) -> bool:
+    """
+    Hand the conversion over to a running daemon.
+
+    Returns:
+        bool: False if the daemon can't take the job and the conversion has to run locally.
+    """
+    checkpoint = args.checkpoint or os.environ.get("NOUGAT_CHECKPOINT")
+    job = {
+        "pdf": [str(p.resolve()) for p in args.pdf],
+        "out": str(args.out.resolve()) if args.out else None,
+        "recompute": args.recompute,
+        "markdown": args.markdown,
+        "skipping": args.skipping,
+        "pages": args.pages,
+        "model": args.model,
+        "format": args.format,
+        # the daemon rejects jobs for another model configuration
+        "checkpoint": str(Path(checkpoint).resolve()) if checkpoint else None,
+        "batchsize": args.batchsize,
+        "full_precision": args.full_precision,
+        "backend": args.backend,
+    }
+    for reply in submit_job(job, args.socket):
+        if reply.get("status") == "error":
+            logging.warning(f"Daemon could not process the job: {reply.get('error')}")
+            return False
+        elif "markdown" in reply:
+            print(reply["markdown"], "\n\n")
+        elif "path" in reply:
+            logging.info(f"Saved {reply['path']}")
+        elif "name" in reply:
+            logging.info(f"Converted {reply['name']}")
+    return True
+
+
+def check_daemon_job(job: Dict, args, device: str):
+    """
+    Raise a ValueError if `job` asks for another model configuration than the daemon
+    runs, so that the client converts the PDFs itself.
+
+    Args:
+        job (Dict): The job sent by `run_client`.
+        args: The arguments of the daemon, after the model was loaded.
+        device (str): The device type the daemon's model runs on.
+    """
+    from nougat.utils.checkpoint import get_checkpoint, torch_hub
+
+    if job.get("model", args.model) != args.model:
+        raise ValueError(f"Daemon serves model {args.model}, not {job['model']}.")
+    # without a checkpoint the client would load the default one of the model tag
+    checkpoint = get_checkpoint(
+        job.get("checkpoint") or torch_hub(args.model), args.model, download=False
+    )
+    if checkpoint.resolve() != args.checkpoint.resolve():
+        raise ValueError(f"Daemon serves checkpoint {args.checkpoint}, not {checkpoint}.")
+    if job.get("full_precision", args.full_precision) != args.full_precision:
+        precision = "float32" if args.full_precision else "bfloat16"
+        raise ValueError(f"Daemon runs the model in {precision}.")
+    if job.get("backend", args.backend) != args.backend:
+        raise ValueError(f"Daemon uses the {args.backend} backend, not {job['backend']}.")
+    batchsize = job.get("batchsize")
+    if batchsize is not None and batchsize <= 0 and device != "cpu":
+        raise ValueError(f"Daemon runs the model on {device}, not on the CPU.")
+    if batchsize is not None and batchsize > 0 and batchsize != args.batchsize:
+        raise ValueError(f"Daemon uses batch size {args.batchsize}, not {batchsize}.")
+
+
+def serve(args):
+    model = load_model(args)
+
+    def handle(job):
+        check_daemon_job(job, args, model.device.type)
+        job_args = argparse.Namespace(**vars(args))
+        for key in ("recompute", "markdown", "skipping", "pages", "format"):
+            if key in job:
+                setattr(job_args, key, job[key])
+        job_args.pdf = [Path(p) for p in job["pdf"]]
+        job_args.out = Path(job["out"]) if job.get("out") else None
+        if job_args.out is None:
+            job_args.format = "mmd"
+        datasets = build_datasets(model, job_args)
+        if len(datasets) == 0:
+            return
+        with ExitStack() as stack:
+            sink = get_sink(job_args.format, job_args.out, shard_size=args.shard_size)
+            if sink is not None:
+                stack.enter_context(sink)
+            for name, out in predict(model, datasets, job_args, sink, pool):
+                if sink is not None:
+                    yield {"name": name}
+                elif job_args.out is None:
+                    yield {"name": name, "markdown": out}
                 else:
-                    print(out, "\n\n")
-                predictions = []
-                page_num = 0
-                file_index += 1
+                    out_path = write_prediction(name, out, job_args.out)
+                    yield {"name": name, "path": str(out_path)}
+
+    with start_replicas(model, args) as pool:
+        NougatDaemon(handle, args.socket, watch=args.watch, watch_out=args.out).serve()
+
+
+def main():
+    args = get_args()
+    if args.daemon:
+        serve(args)
+        return
+    if args.use_daemon and args.queue is None and daemon_available(args.socket):
+        try:
+            if run_client(args):
+                return
+        except OSError as e:
+            logging.warning(f"Lost connection to daemon: {e}")
+    model = load_model(args)
+    if args.queue is not None:
+        with start_replicas(model, args) as pool:
+            run_queue(model, args, pool)
+        return
+    datasets = build_datasets(model, args)
+    if len(datasets) == 0:
+        return
+    with ExitStack() as stack:
+        sink = get_sink(args.format, args.out, shard_size=args.shard_size)
+        if sink is not None:
+            stack.enter_context(sink)
+        pool = stack.enter_context(start_replicas(model, args))
+        for name, out in predict(model, datasets, args, sink, pool):
+            if sink is None:
+                write_prediction(name, out, args.out)
 
 
 if __name__ == "__main__":
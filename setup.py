@@ -75,6 +75,12 @@ setup(
             "htmlmin",
             "pdfminer.six>=20221105",
         ],
+        "safetensors": [
+            "safetensors",
+        ],
+        "parquet": [
+            "pyarrow",
+        ],
     },
     entry_points={
         "console_scripts": [
@@ -0,0 +1,74 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import hashlib
+import importlib
+import os
+
+import pytest
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    # the app keeps its results in ./pdfs
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    try:
+        yield importlib.import_module("app")
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def upload(server):
+    """An endpoint that answers with the size and md5 of the received upload."""
+    echo = FastAPI()
+
+    @echo.websocket("/upload")
+    async def receive(websocket: WebSocket):
+        await websocket.accept()
+        path, md5 = await server.receive_websocket_upload(websocket)
+        await websocket.send_json({"size": path.stat().st_size, "md5": md5})
+        path.unlink()
+        await websocket.close()
+
+    return TestClient(echo)
+
+
+def test_upload_in_chunks(upload):
+    data = os.urandom(3 * 2**20 + 5)
+    with upload.websocket_connect("/upload") as websocket:
+        for i in range(0, len(data), 2**20):
+            websocket.send_bytes(data[i : i + 2**20])
+        websocket.send_bytes(b"")
+        assert websocket.receive_json() == {
+            "size": len(data),
+            "md5": hashlib.md5(data).hexdigest(),
+        }
+
+
+def test_upload_too_large(server, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 2**20)
+    client = TestClient(server.app)
+    with client.websocket_connect("/predict/page?page=1") as websocket:
+        websocket.send_bytes(b"0" * 2**19)
+        websocket.send_bytes(b"0" * (2**19 + 1))
+        assert websocket.receive_json() == {
+            "type": "error",
+            "error": "The upload exceeds 1 MB.",
+        }
+
+
+def test_upload_as_text(server):
+    client = TestClient(server.app)
+    with client.websocket_connect("/predict/page?page=1") as websocket:
+        websocket.send_text("%PDF")
+        assert websocket.receive_json() == {
+            "type": "error",
+            "error": "Send the PDF as binary messages.",
+        }
@@ -0,0 +1,156 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import re
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from nougat.utils import checkpoint
+from nougat.utils.checkpoint import DownloadError, download_checkpoint
+
+TAG = "test"
+FILES = {"model.bin": os.urandom(10000), "config.json": b'{"a": 1}'}
+
+
+class ReleaseServer(ThreadingHTTPServer):
+    """
+    Serves `files` under `/<TAG>/<name>` with range support, like a release page.
+
+    Args:
+        files: The file contents by name, a `SHA256SUMS` is published if `checksums` is set.
+        ranges (bool): Whether `Range` headers are honored. `Accept-Ranges` is always sent.
+    """
+
+    def __init__(self, files, checksums=None, ranges=True):
+        self.files = dict(files)
+        if checksums is not None:
+            self.files["SHA256SUMS"] = "".join(
+                f"{digest}  {name}\n" for name, digest in checksums.items()
+            ).encode()
+        self.ranges = ranges
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), ReleaseHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        name = self.path.rsplit("/", 1)[-1]
+        if not self.path.startswith(f"/{TAG}/") or name not in self.server.files:
+            self.send_error(404)
+            return None, None
+        return name, self.server.files[name]
+
+    def do_HEAD(self):
+        name, data = self._file()
+        if data is None:
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        name, data = self._file()
+        if data is None:
+            return
+        header = self.headers.get("Range")
+        self.server.requests.append((name, header))
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", header or "")
+        if match is None or not self.server.ranges:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        start, end = int(match[1]), min(int(match[2]), len(data) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start : end + 1])
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    servers = []
+
+    def start(*args, **kwargs) -> ReleaseServer:
+        server = ReleaseServer(*args, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setenv("NOUGAT_BASE_URL", server.url)
+        return server
+
+    # several ranges per file
+    monkeypatch.setattr(checkpoint, "CHUNK_SIZE", 3000)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def checksums(files):
+    return {name: hashlib.sha256(data).hexdigest() for name, data in files.items()}
+
+
+def download(path):
+    download_checkpoint(path, model_tag=TAG, files=list(FILES), workers=4)
+
+
+def test_full_download(serve, tmp_path):
+    server = serve(FILES, checksums=checksums(FILES))
+    download(tmp_path)
+    for name, data in FILES.items():
+        assert (tmp_path / name).read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == sorted(FILES)
+    # 10000 bytes in ranges of 3000
+    assert len([r for r in server.requests if r[0] == "model.bin"]) == 4
+
+
+def test_resume_from_partial_file(serve, tmp_path):
+    server = serve(FILES, checksums=checksums(FILES))
+    (tmp_path / "model.bin.part0").write_bytes(FILES["model.bin"][:1000])
+    (tmp_path / "model.bin.part1").write_bytes(FILES["model.bin"][3000:6000])
+    download(tmp_path)
+    assert (tmp_path / "model.bin").read_bytes() == FILES["model.bin"]
+    ranges = sorted(r[1] for r in server.requests if r[0] == "model.bin")
+    # the complete range is skipped, the partial one continues where it stopped
+    assert ranges == ["bytes=1000-2999", "bytes=6000-8999", "bytes=9000-9999"]
+
+
+def test_server_ignoring_ranges(serve, tmp_path):
+    serve(FILES, checksums=checksums(FILES), ranges=False)
+    download(tmp_path)
+    for name, data in FILES.items():
+        assert (tmp_path / name).read_bytes() == data
+    assert sorted(os.listdir(tmp_path)) == sorted(FILES)
+
+
+def test_checksum_mismatch(serve, tmp_path):
+    wrong = checksums(FILES)
+    wrong["model.bin"] = "0" * 64
+    serve(FILES, checksums=wrong)
+    with pytest.raises(DownloadError, match="model.bin is corrupted"):
+        download(tmp_path)
+    # the other file is complete, nothing of the corrupted one is left behind
+    assert os.listdir(tmp_path) == ["config.json"]
+
+
+def test_size_is_verified_without_checksums(serve, tmp_path):
+    serve(FILES)
+    download(tmp_path)
+    assert (tmp_path / "model.bin").read_bytes() == FILES["model.bin"]
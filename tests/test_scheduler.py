@@ -0,0 +1,140 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import threading
+from concurrent.futures import CancelledError
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from nougat.utils.scheduler import InferenceScheduler
+
+
+class FakeModel:
+    """
+    Stands in for `NougatModel.inference`. A page is a tensor holding its id, and its
+    prediction is the id as text. The first batch waits until `release` is called, so the
+    test can queue pages behind it.
+    """
+
+    def __init__(self):
+        self.decoder = SimpleNamespace(tokenizer=SimpleNamespace(pad_token_id=1))
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.batches = []
+
+    def release(self):
+        self.gate.set()
+
+    def inference(self, image_tensors, early_stopping, streamer, cancelled):
+        ids = [int(t.flatten()[0]) for t in image_tensors]
+        self.started.set()
+        # decoding steps, a row ends as soon as its page is cancelled
+        while not self.gate.wait(0.01):
+            if all(cancelled(row) for row in range(len(ids))):
+                break
+        self.batches.append(ids)
+        return {
+            "predictions": [str(i) for i in ids],
+            "repeats": [None] * len(ids),
+            "repetitions": [None] * len(ids),
+        }
+
+
+def page(i: int) -> torch.Tensor:
+    return torch.full((1, 2, 2), float(i))
+
+
+@pytest.fixture
+def model():
+    return FakeModel()
+
+
+@pytest.fixture
+def scheduler(model):
+    scheduler = InferenceScheduler(model, batch_size=1)
+    yield scheduler
+    model.release()
+    scheduler.close()
+
+
+def block(scheduler, model):
+    """Keep the inference thread busy with page 0 until the model is released."""
+    future = scheduler.submit(page(0), client="blocker")
+    assert model.started.wait(5)
+    return future
+
+
+def test_interactive_before_bulk_and_round_robin_clients(scheduler, model):
+    block(scheduler, model)
+    futures = [
+        scheduler.submit(page(1), client="a"),
+        scheduler.submit(page(2), client="a"),
+        scheduler.submit(page(3), client="a"),
+        scheduler.submit(page(4), client="b"),
+        scheduler.submit(page(5), priority="interactive", client="c"),
+    ]
+    assert scheduler.pending == 5
+    assert scheduler.pending_by_priority() == {"interactive": 1, "bulk": 4}
+    model.release()
+    for future in futures:
+        future.result(timeout=5)
+    # the backlog of client a doesn't delay client b
+    assert model.batches == [[0], [5], [1], [4], [2], [3]]
+    assert futures[3].result()["prediction"] == "4"
+
+
+def test_batches_are_filled_from_the_queue(model):
+    scheduler = InferenceScheduler(model, batch_size=4)
+    try:
+        block(scheduler, model)
+        futures = [scheduler.submit(page(i), client=i % 2) for i in range(1, 7)]
+        model.release()
+        for future in futures:
+            future.result(timeout=5)
+        assert [len(batch) for batch in model.batches] == [1, 4, 2]
+    finally:
+        scheduler.close()
+
+
+def test_unknown_priority(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.submit(page(1), priority="urgent")
+
+
+def test_cancel_queued_page(scheduler, model):
+    block(scheduler, model)
+    kept = scheduler.submit(page(1), client="a")
+    dropped = scheduler.submit(page(2), client="a")
+    scheduler.cancel(dropped)
+    assert dropped.cancelled()
+    assert scheduler.pending == 1
+    model.release()
+    assert kept.result(timeout=5)["prediction"] == "1"
+    assert model.batches == [[0], [1]]
+
+
+def test_cancel_page_being_decoded(scheduler, model):
+    active = block(scheduler, model)
+    queued = scheduler.submit(page(1), client="a")
+    scheduler.cancel(active)
+    # the batch ends at the next step without releasing the model
+    with pytest.raises(CancelledError):
+        active.result(timeout=5)
+    model.release()
+    assert queued.result(timeout=5)["prediction"] == "1"
+
+
+def test_close_cancels_queued_pages(model):
+    scheduler = InferenceScheduler(model, batch_size=1)
+    block(scheduler, model)
+    queued = scheduler.submit(page(1), client="a")
+    # the current batch finishes after close, the queued page is not started anymore
+    threading.Timer(0.2, model.release).start()
+    scheduler.close()
+    assert queued.cancelled()
+    assert model.batches == [[0]]
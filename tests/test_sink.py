@@ -0,0 +1,127 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import pypdfium2
+import pytest
+
+import predict
+from nougat.utils.sink import (
+    JSONLSink,
+    ParquetSink,
+    assemble_documents,
+    file_md5,
+    read_records,
+    recorded_pages,
+)
+
+
+def record(document: str, page: int, repeats=None, md5=None):
+    return {
+        "document": document,
+        "md5": md5,
+        "page": page,
+        "markdown": f"{document} page {page}\n\n",
+        "repeats": repeats,
+        "truncated": repeats is not None and repeats > 0,
+        "render_failed": False,
+        "timings": {"decode": 0.5},
+    }
+
+
+def shards(out):
+    return sorted(out.iterdir())
+
+
+@pytest.mark.parametrize("sink_class", [JSONLSink, ParquetSink])
+def test_shards_rotate_and_round_trip(tmp_path, sink_class):
+    if sink_class is ParquetSink:
+        pytest.importorskip("pyarrow")
+    records = [record("a.pdf", page) for page in range(1, 6)]
+    # a column that is empty in the first buffer doesn't change the schema
+    records += [record("b.pdf", page, repeats=page) for page in range(1, 4)]
+    with sink_class(tmp_path, shard_size=3, buffer_size=2) as sink:
+        for r in records:
+            sink.write(r)
+    assert len(shards(tmp_path)) == 3
+    assert not any(path.name.endswith(".inprogress") for path in shards(tmp_path))
+    assert list(read_records(shards(tmp_path))) == records
+
+
+def test_shard_is_only_visible_when_complete(tmp_path):
+    sink = JSONLSink(tmp_path, shard_size=10, buffer_size=1)
+    sink.write(record("a.pdf", 1))
+    assert [path.suffix for path in shards(tmp_path)] == [".inprogress"]
+    sink.close()
+    assert [path.suffix for path in shards(tmp_path)] == [".jsonl"]
+
+
+def test_assemble_documents():
+    records = [record("a.pdf", 2), record("a.pdf", 1), record("b.pdf", 1)]
+    assert list(assemble_documents(iter(records))) == [
+        ("a.pdf", "a.pdf page 1\n\na.pdf page 2"),
+        ("b.pdf", "b.pdf page 1"),
+    ]
+
+
+def test_recorded_pages_ignores_unfinished_shards(tmp_path):
+    with JSONLSink(tmp_path) as sink:
+        sink.write(record("a.pdf", 1, md5="a"))
+        sink.write(record("a.pdf", 2, md5="a"))
+        sink.write(record("old.pdf", 1))
+    unfinished = JSONLSink(tmp_path, buffer_size=1, prefix="unfinished")
+    unfinished.write(record("b.pdf", 1, md5="b"))
+    assert recorded_pages(tmp_path) == {"a": {1, 2}}
+    unfinished.close()
+    assert recorded_pages(tmp_path) == {"a": {1, 2}, "b": {1}}
+
+
+def write_pdf(path, pages: int):
+    pdf = pypdfium2.PdfDocument.new()
+    for _ in range(pages):
+        pdf.new_page(612, 792)
+    pdf.save(str(path))
+    pdf.close()
+
+
+def datasets(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["nougat", *map(str, argv)])
+    model = SimpleNamespace(
+        encoder=SimpleNamespace(prepare_input=lambda image, random_padding: image)
+    )
+    return predict.build_datasets(model, predict.get_args())
+
+
+def test_documents_in_the_shards_are_skipped(tmp_path, monkeypatch):
+    out = tmp_path / "out"
+    write_pdf(tmp_path / "done.pdf", 2)
+    write_pdf(tmp_path / "partial.pdf", 3)
+    write_pdf(tmp_path / "new.pdf", 1)
+    with JSONLSink(out) as sink:
+        done = file_md5(tmp_path / "done.pdf")
+        sink.write(record("done.pdf", 1, md5=done))
+        sink.write(record("done.pdf", 2, md5=done))
+        sink.write(record("partial.pdf", 1, md5=file_md5(tmp_path / "partial.pdf")))
+    found = datasets(monkeypatch, tmp_path, "-o", out, "--format", "jsonl")
+    names = sorted(os.path.basename(dataset.name) for dataset in found)
+    assert names == ["new.pdf", "partial.pdf"]
+    assert {dataset.md5 for dataset in found} == {
+        file_md5(tmp_path / "new.pdf"),
+        file_md5(tmp_path / "partial.pdf"),
+    }
+    # only the requested pages have to be in the shards
+    found = datasets(
+        monkeypatch, tmp_path / "partial.pdf", "-o", out, "--format", "jsonl", "-p", "1"
+    )
+    assert found == []
+    found = datasets(
+        monkeypatch, tmp_path, "-o", out, "--format", "jsonl", "--recompute"
+    )
+    assert len(found) == 3
@@ -0,0 +1,77 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import itertools
+
+import pytest
+
+from nougat.utils import store as store_module
+from nougat.utils.store import ResultStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Every call of `time.time` in the store is one second later than the last one."""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(store_module.time, "time", lambda: float(next(ticks)))
+
+
+def test_full_hit(tmp_path):
+    store = ResultStore(tmp_path / "store.sqlite3")
+    store.put_pages("abc", {0: "a", 1: "b"})
+    assert store.get_pages("abc", [0, 1]) == {0: "a", 1: "b"}
+
+
+def test_partial_hit(tmp_path):
+    store = ResultStore(tmp_path / "store.sqlite3")
+    store.put_pages("abc", {1: "x", 2: "y"})
+    assert store.get_pages("abc", [0, 1, 2, 3]) == {1: "x", 2: "y"}
+    assert store.count_pages("abc", [0, 1, 2, 3]) == 2
+
+
+def test_empty_hit(tmp_path):
+    store = ResultStore(tmp_path / "store.sqlite3")
+    store.put_pages("abc", {0: "a"})
+    assert store.get_pages("abc", [1, 2]) == {}
+    assert store.get_pages("other", [0]) == {}
+    assert store.get_pages("abc", []) == {}
+
+
+def test_pages_per_model(tmp_path):
+    store = ResultStore(tmp_path / "store.sqlite3")
+    store.put_pages("abc", {0: "small"}, model="small")
+    store.put_pages("abc", {0: "base"}, model="base")
+    assert store.get_pages("abc", [0], model="small") == {0: "small"}
+    assert store.get_pages("abc", [0], model="base") == {0: "base"}
+    assert store.get_pages("abc", [0]) == {}
+
+
+def test_eviction_of_least_recently_used(tmp_path, clock):
+    store = ResultStore(tmp_path / "store.sqlite3", max_size=3500)
+    # random bytes don't compress, every entry takes about 1000 bytes
+    store.put_images("a", {0: os.urandom(1000)})
+    store.put_images("b", {0: os.urandom(1000)})
+    store.put_images("c", {0: os.urandom(1000)})
+    # reading "a" makes "b" the least recently used entry
+    assert 0 in store.get_images("a", [0])
+    store.put_images("d", {0: os.urandom(1000)})
+    assert store.get_images("b", [0]) == {}
+    for md5 in ("a", "c", "d"):
+        assert 0 in store.get_images(md5, [0])
+    assert store.size <= 3500
+    assert store.size == sum(
+        row[0] for row in store.connection.execute("SELECT size FROM entries")
+    )
+
+
+def test_delete(tmp_path):
+    store = ResultStore(tmp_path / "store.sqlite3")
+    store.put_pages("abc", {0: "a"})
+    store.put_images("abc", {0: b"png"})
+    store.delete("abc")
+    assert store.documents() == []
+    assert store.size == 0
@@ -0,0 +1,104 @@
+"""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+
+This source code is licensed under the MIT license found in the
+LICENSE file in the root directory of this source tree.
+"""
+import os
+import time
+
+import pytest
+
+from nougat.utils import workqueue
+from nougat.utils.workqueue import WorkQueue
+
+
+@pytest.fixture
+def queues(tmp_path):
+    """Two workers sharing a queue directory, with a heartbeat that never runs."""
+    created = []
+
+    def create(**kwargs) -> WorkQueue:
+        kwargs.setdefault("lease_timeout", 10)
+        queue = WorkQueue(tmp_path, heartbeat_interval=3600, **kwargs)
+        created.append(queue)
+        return queue
+
+    yield create
+    for queue in created:
+        queue.close()
+
+
+def expire(queue: WorkQueue, key: str):
+    """Let the lease of `key` look like its owner died `lease_timeout` seconds ago."""
+    old = time.time() - queue.lease_timeout - 1
+    os.utime(queue._lease_path(key), (old, old))
+
+
+def test_lease_is_exclusive(queues):
+    a, b = queues(), queues()
+    assert a.claim("unit")
+    assert not b.claim("unit")
+    a.release("unit")
+    assert b.claim("unit")
+
+
+def test_done_units_are_not_claimed(queues):
+    a, b = queues(), queues()
+    assert a.claim("unit")
+    a.complete("unit")
+    assert not b.claim("unit")
+    assert not a.claim("unit")
+
+
+def test_stale_lease_is_reclaimed(queues):
+    a, b = queues(), queues()
+    assert a.claim("unit")
+    expire(a, "unit")
+    assert b.claim("unit")
+    assert b._owns("unit")
+    assert not a._owns("unit")
+    assert os.listdir(b.leases) == ["unit.lease"]
+
+
+def test_fresh_lease_survives_a_late_reclaim(queues, monkeypatch):
+    a, b, c = queues(), queues(), queues()
+    assert a.claim("unit")
+    expire(a, "unit")
+    rename = os.rename
+
+    def reclaimed_in_between(src, dst):
+        # c reclaims the stale lease after b checked it and before b renames it
+        monkeypatch.setattr(workqueue.os, "rename", rename)
+        assert c.claim("unit")
+        rename(src, dst)
+
+    monkeypatch.setattr(workqueue.os, "rename", reclaimed_in_between)
+    assert not b.claim("unit")
+    assert c._owns("unit")
+    assert os.listdir(c.leases) == ["unit.lease"]
+
+
+def test_heartbeat_renews_the_lease(tmp_path):
+    queue = WorkQueue(tmp_path, lease_timeout=1, heartbeat_interval=0.05)
+    try:
+        assert queue.claim("unit")
+        time.sleep(1.5)
+        assert queue.is_leased("unit")
+    finally:
+        queue.close()
+
+
+def test_failed_units_back_off_and_are_given_up(queues):
+    a = queues(max_attempts=2, retry_delay=0.2)
+    assert a.claim("unit")
+    a.fail("unit")
+    assert a.attempts("unit") == 1
+    # retried only after the backoff
+    assert not a.claim("unit")
+    time.sleep(0.3)
+    assert a.claim("unit")
+    a.fail("unit")
+    assert a.is_failed("unit")
+    time.sleep(0.5)
+    assert not a.claim("unit")